@@ -0,0 +1,77 @@
+"""
+Benchmark of populating an empty working tree from the object store, as a checkout
+to a new directory does, compared with the previous serial writer.
+
+The blobs are written once in a temporary repository (packed with --packed), then
+each writer fills its own empty directory, with a new Repository so no object cache
+is shared between runs. The file system is synced before each run.
+
+> python -m benchmarks.bench_checkout
+> python -m benchmarks.bench_checkout --files 10000 --packed
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from src.algorithms import read_object
+from src.objects.tree import FILE_MODE
+from src.plumbing import checkout_files, hash_object_data, repack
+from src.repository import Repository, create_repository
+
+
+def create_objects(repo, count, files_per_directory):
+    files = []
+    for i in range(count):
+        path = f"dir{i // files_per_directory:05d}/file{i:07d}.txt"
+        # Sizes from a few bytes to a few KB, like source files
+        data = f"line {i}\n".encode("ascii") * (1 + i % 400)
+        files.append((path, FILE_MODE, hash_object_data("blob", data, True, repo)))
+    return files
+
+
+def checkout_legacy(files, repo):
+    # update_working_directory before the materializer: one file at a time
+    for path, _, sha in files:
+        absolute_path = os.path.join(repo.worktree, path)
+        os.makedirs(os.path.dirname(absolute_path), exist_ok=True)
+        content = read_object(repo, sha).serialize().decode("ascii")
+        with open(absolute_path, "w") as file:
+            file.write(content)
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=100_000)
+    parser.add_argument("--files-per-directory", type=int, default=1_000)
+    parser.add_argument("--packed", action="store_true")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        repo = create_repository(os.path.join(directory, "source"))
+        files = create_objects(repo, args.files, args.files_per_directory)
+        if args.packed:
+            repack(all_objects=True, delete=True, repo=repo)
+
+        writers = [("legacy", checkout_legacy)]
+        for jobs in args.jobs:
+            writers.append(
+                (f"jobs={jobs}", lambda files, repo, jobs=jobs: checkout_files(files, jobs, repo))
+            )
+
+        print(f"{'writer':>10} {'seconds':>10} {'files/s':>10}")
+        for name, writer in writers:
+            worktree = os.path.join(directory, name)
+            os.mkdir(worktree)
+            # Dirty pages of the previous run are not written back during this one
+            os.sync()
+            start = time.perf_counter()
+            writer(files, Repository(worktree, gitdir=repo.gitdir))
+            seconds = time.perf_counter() - start
+            print(f"{name:>10} {seconds:>10.3f} {args.files / seconds:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
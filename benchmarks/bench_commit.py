@@ -0,0 +1,103 @@
+"""
+Benchmark of the commit parser over synthetic commits, some of them signed (a long
+multi-line gpgsig header), compared with the previous recursive parser.
+
+Each parser reads the fields a history walk needs: parents and commit time.
+
+> python -m benchmarks.bench_commit
+> python -m benchmarks.bench_commit --count 10000
+"""
+import argparse
+import collections
+import hashlib
+import sys
+import time
+
+from src.objects.commit import Commit
+
+SIGNATURE = (
+    b"gpgsig -----BEGIN PGP SIGNATURE-----\n"
+    + b"".join(b" " + b"A" * 64 + b"\n" for _ in range(12))
+    + b" -----END PGP SIGNATURE-----\n"
+)
+
+
+def synthetic_commits(count):
+    commits = []
+    for i in range(count):
+        sha = hashlib.sha1(str(i).encode("ascii")).hexdigest().encode("ascii")
+        data = b"tree " + sha + b"\n"
+        # A merge every 10 commits
+        for parent in range(2 if i % 10 == 0 else 1):
+            data += b"parent " + sha[parent:] + sha[:parent] + b"\n"
+        data += b"author calp <calp@example.com> %d +0000\n" % (1_600_000_000 + i)
+        data += b"committer calp <calp@example.com> %d +0000\n" % (1_600_000_000 + i)
+        if i % 4 == 0:
+            data += SIGNATURE
+        data += b"\ncommit %d\n" % i
+        commits.append(data)
+    return commits
+
+
+def legacy_parse_commit(raw, start=0, commit_data=None):
+    # Commit.parse_commit before the loop-based parser, one recursion per header
+    if not commit_data:
+        commit_data = collections.OrderedDict()
+
+    space = raw.find(b" ", start)
+    new_line = raw.find(b"\n", start)
+    if (space < 0) or (new_line < space):
+        commit_data[b""] = raw[start + 1 :]
+        return commit_data
+
+    key = raw[start:space]
+    end = start
+    while True:
+        end = raw.find(b"\n", end + 1)
+        if raw[end + 1] != ord(" "):
+            break
+
+    value = raw[space + 1 : end]
+    if key in commit_data:
+        if isinstance(commit_data[key], list):
+            commit_data[key].append(value)
+        else:
+            commit_data[key] = [commit_data[key], value]
+    else:
+        commit_data[key] = value
+    return legacy_parse_commit(raw, start=end + 1, commit_data=commit_data)
+
+
+def walk_legacy(commits):
+    for data in commits:
+        commit_data = legacy_parse_commit(data)
+        parents = commit_data.get(b"parent", [])
+        if not isinstance(parents, list):
+            parents = [parents]
+        [parent.decode("ascii") for parent in parents]
+        int(commit_data[b"committer"].rsplit(b" ", 2)[1])
+
+
+def walk_current(commits):
+    for data in commits:
+        commit = Commit(None, data)
+        commit.get_parents()
+        commit.get_commit_time()
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=100_000)
+    args = parser.parse_args(argv)
+
+    commits = synthetic_commits(args.count)
+    print(f"{'parser':>10} {'seconds':>10} {'us/commit':>10}")
+    for name, walk in [("legacy", walk_legacy), ("current", walk_current)]:
+        start = time.perf_counter()
+        walk(commits)
+        seconds = time.perf_counter() - start
+        print(f"{name:>10} {seconds:>10.4f} {seconds / args.count * 1e6:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
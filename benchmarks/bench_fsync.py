@@ -0,0 +1,57 @@
+"""
+Benchmark of the object writes of commits for each durability level of core.fsync.
+
+Each commit writes --files blobs, their tree and the commit object in one transaction,
+as calp add and calp commit do. none is the behavior before the transactions: objects
+renamed into place as they are written, never synced.
+
+> python -m benchmarks.bench_fsync
+> python -m benchmarks.bench_fsync --commits 50 --files 100
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from src.plumbing import hash_object_data, write_commit
+from src.repository import create_repository
+from src.transaction import FSYNC_MODES, object_transaction
+
+
+def write_commits(repo, commits, files):
+    for i in range(commits):
+        with object_transaction(repo):
+            entries = []
+            for j in range(files):
+                sha = hash_object_data("blob", f"commit {i} file {j}\n".encode(), True, repo)
+                entries.append(b"100644 file%05d\0" % j + bytes.fromhex(sha))
+            tree_sha = hash_object_data("tree", b"".join(entries), True, repo)
+            write_commit(tree_sha, f"commit {i}", repo=repo)
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commits", type=int, default=20)
+    parser.add_argument("--files", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    objects = args.commits * (args.files + 2)
+    print(f"{'core.fsync':>10} {'seconds':>10} {'objects/s':>10} {'ms/commit':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in FSYNC_MODES:
+            repo = create_repository(os.path.join(directory, mode))
+            repo.conf.read_dict({"core": {"fsync": mode}})
+            # Dirty pages of the previous run are not written back during this one
+            os.sync()
+            start = time.perf_counter()
+            write_commits(repo, args.commits, args.files)
+            seconds = time.perf_counter() - start
+            print(
+                f"{mode:>10} {seconds:>10.3f} {objects / seconds:>10.0f}"
+                f" {seconds / args.commits * 1e3:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark of repack on medium-sized blobs: --files files of --size bytes of text,
+each with --versions versions changed in a few places, so most objects have a good
+delta base in the window and many bases share nothing with the object.
+
+> python -m benchmarks.bench_repack
+> python -m benchmarks.bench_repack --files 50 --size 200000
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from src.plumbing import hash_object_data, repack
+from src.repository import create_repository
+
+
+def create_objects(repo, files, size, versions):
+    rng = random.Random(0)
+    words = [b"%x" % rng.getrandbits(32) for _ in range(5000)]
+    for _ in range(files):
+        lines = [b" ".join(rng.choices(words, k=8)) for _ in range(size // 72)]
+        for _ in range(versions):
+            for _ in range(5):
+                lines[rng.randrange(len(lines))] = b" ".join(rng.choices(words, k=8))
+            lines.insert(rng.randrange(len(lines)), b"inserted line")
+            hash_object_data("blob", b"\n".join(lines), True, repo)
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--size", type=int, default=100_000)
+    parser.add_argument("--versions", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        repo = create_repository(directory)
+        create_objects(repo, args.files, args.size, args.versions)
+        objects = args.files * args.versions
+
+        start = time.perf_counter()
+        pack_path = repack(all_objects=True, delete=True, repo=repo)
+        seconds = time.perf_counter() - start
+
+        total = args.files * args.versions * args.size
+        pack_size = os.path.getsize(pack_path)
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+        print(f"{objects} objects, {total / 2**20:.1f} MiB")
+        print(f"repack: {seconds:.2f} s, {objects / seconds:.0f} objects/s")
+        print(f"pack: {pack_size / 2**20:.2f} MiB, max RSS {max_rss} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark of the startup of short calp commands, the ones hooks run many times.
+
+Each command runs in a small repository created in a temporary directory. The wall
+time is the best of --repeat runs, the import time is the total reported by
+python -X importtime (interpreter startup included). Bytecode is written on a first
+run, so the timings don't include compiling the sources.
+
+> python -m benchmarks.bench_startup
+> python -m benchmarks.bench_startup --repeat 50
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+CALP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "calp")
+COMMANDS = [[], ["status"], ["log", "-n", "1"], ["cat-file", "-t", "HEAD_COMMIT"]]
+
+
+def create_repository(directory):
+    subprocess.run([CALP, "init", "--path", directory], check=True, stdout=subprocess.DEVNULL)
+    with open(os.path.join(directory, "file.txt"), "w") as file:
+        file.write("file\n")
+    run = {"cwd": directory, "check": True, "stdout": subprocess.DEVNULL}
+    subprocess.run([CALP, "add", "file.txt"], **run)
+    subprocess.run([CALP, "commit", "-m", "first"], **run)
+    with open(os.path.join(directory, ".calp", "refs", "heads", "master")) as file:
+        return file.read().strip()
+
+
+def import_time(command, directory, env):
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", CALP, *command],
+        cwd=directory,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    ).stderr.decode("utf-8")
+    # Cumulative times of the top-level imports, the nested ones are included
+    top_level = re.findall(r"^import time:\s+\d+ \|\s+(\d+) \| \S", output, re.MULTILINE)
+    return sum(int(us) for us in top_level) / 1e6
+
+
+def wall_time(argv, directory, env, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(argv, cwd=directory, env=env, stdout=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    interpreter = wall_time([sys.executable, "-c", "pass"], None, env, args.repeat)
+    print(f"python -c pass: {interpreter * 1e3:.1f} ms")
+
+    with tempfile.TemporaryDirectory() as directory:
+        commit_sha = create_repository(directory)
+        print(f"{'command':>20} {'wall ms':>10} {'import ms':>10}")
+        for command in COMMANDS:
+            command = [commit_sha if arg == "HEAD_COMMIT" else arg for arg in command]
+            # Writes the bytecode
+            wall_time([sys.executable, CALP, *command], directory, env, 1)
+
+            seconds = wall_time([sys.executable, CALP, *command], directory, env, args.repeat)
+            imports = import_time(command, directory, env)
+            name = " ".join(command)[:20] or "(usage)"
+            print(f"{name:>20} {seconds * 1e3:>10.1f} {imports * 1e3:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
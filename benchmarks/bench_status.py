@@ -0,0 +1,75 @@
+"""
+Benchmark of the status diff between the index and the worktree.
+
+The diff is timed over synthetic entries, so it can scale to 100k tracked files
+without touching the disk. With --disk, a real repository is created in a temporary
+directory and the whole status command is timed.
+
+> python -m benchmarks.bench_status
+> python -m benchmarks.bench_status --disk --sizes 1000 10000
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from src.algorithms import diff_index_worktree
+from src.index import IndexEntry
+
+CALP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "calp")
+
+
+def synthetic_paths(count):
+    # Spread the files over directories, like a real tree
+    return [f"dir{i % 100}/sub{i % 7}/file{i}.txt" for i in range(count)]
+
+
+def bench_diff(count):
+    paths = synthetic_paths(count)
+    entries = {path: IndexEntry(path, "0" * 40) for path in paths}
+    # 1% untracked files, 1% deleted entries, 1% modified files
+    worktree = paths[count // 100 :] + [f"new/file{i}.txt" for i in range(count // 100)]
+    modified = set(paths[-(count // 100) :])
+
+    start = time.perf_counter()
+    diff_index_worktree(entries, worktree, lambda entry, path: path in modified)
+    return time.perf_counter() - start
+
+
+def bench_disk(count):
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run([CALP, "init", "--path", directory], check=True)
+        for i, path in enumerate(synthetic_paths(count)):
+            path = os.path.join(directory, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as file:
+                file.write(f"{i}\n")
+
+        subprocess.run([CALP, "add", *synthetic_paths(count)], cwd=directory, check=True)
+        # First status refreshes the racy entries, measure the next one
+        subprocess.run([CALP, "status"], cwd=directory, check=True, stdout=subprocess.DEVNULL)
+
+        start = time.perf_counter()
+        subprocess.run([CALP, "status"], cwd=directory, check=True, stdout=subprocess.DEVNULL)
+        return time.perf_counter() - start
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--disk", action="store_true", help="Time calp status on disk.")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000]
+    )
+    args = parser.parse_args(argv)
+
+    bench = bench_disk if args.disk else bench_diff
+    print(f"{'files':>10} {'seconds':>10} {'us/file':>10}")
+    for count in args.sizes:
+        seconds = bench(count)
+        print(f"{count:>10} {seconds:>10.4f} {seconds / count * 1e6:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
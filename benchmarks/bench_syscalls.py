@@ -0,0 +1,89 @@
+"""
+Benchmark of the file system calls made by calp commands.
+
+Each command runs in its own process, with the os functions that make a system call
+(stat, lstat, getcwd, listdir, scandir...) and open wrapped to count the calls. The
+imports of the interpreter go through its own functions and aren't counted.
+
+> python -m benchmarks.bench_syscalls
+> python -m benchmarks.bench_syscalls --files 100
+"""
+import argparse
+import builtins
+import collections
+import functools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CALLS = ["stat", "lstat", "fstat", "getcwd", "listdir", "scandir", "readlink", "replace", "mkdir"]
+
+
+def count_calls(argv):
+    # Runs in the child process, prints the counts as json on stderr
+    counts = collections.Counter()
+
+    def counted(name, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    for name in CALLS:
+        setattr(os, name, counted(name, getattr(os, name)))
+    builtins.open = counted("open", builtins.open)
+
+    from src import main
+
+    main.main(argv)
+    print(json.dumps(counts), file=sys.stderr)
+
+
+def run_counted(argv, directory):
+    code = f"import sys; sys.path.insert(0, {ROOT!r}); "
+    code += f"from benchmarks.bench_syscalls import count_calls; count_calls({argv!r})"
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    return json.loads(result.stderr.decode("utf-8").splitlines()[-1])
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, "dir"))
+        paths = [os.path.join("dir", f"file{i}.txt") for i in range(args.files)]
+        for i, path in enumerate(paths):
+            with open(os.path.join(directory, path), "w") as file:
+                file.write(f"{i}\n")
+
+        commands = [
+            ["init", "--path", directory],
+            ["add", *paths],
+            ["commit", "-m", "first"],
+            ["status"],
+            # Uses the stat data and the directory listings cached by the first status
+            ["status"],
+            ["log"],
+        ]
+        print(f"{'command':>10} {'total':>7}  calls")
+        for command in commands:
+            counts = run_counted(command, directory)
+            detail = " ".join(f"{name}={value}" for name, value in sorted(counts.items()))
+            print(f"{command[0]:>10} {sum(counts.values()):>7}  {detail}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark of the tree codec: parsing a tree object, reading the SHA-1 of every
+entry and serializing it back, over synthetic trees.
+
+> python -m benchmarks.bench_tree
+> python -m benchmarks.bench_tree --sizes 10000 --repeat 20
+"""
+import argparse
+import hashlib
+import sys
+import time
+
+from src.objects.tree import Tree
+
+
+def synthetic_tree_data(count):
+    # Sorted names, a subtree every 10 entries
+    entries = []
+    for i in range(count):
+        mode = b"40000" if i % 10 == 0 else b"100644"
+        sha = hashlib.sha1(str(i).encode("ascii")).digest()
+        entries.append(b"%s entry%08d\x00%s" % (mode, i, sha))
+    return b"".join(entries)
+
+
+def bench_tree(count, repeat):
+    data = synthetic_tree_data(count)
+    timings = {"parse": 0.0, "sha": 0.0, "serialize": 0.0}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tree = Tree(None, data)
+        timings["parse"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for item in tree.items:
+            item.sha
+        timings["sha"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        serialized = tree.serialize()
+        timings["serialize"] += time.perf_counter() - start
+
+    assert serialized == data
+    return {name: seconds / repeat for name, seconds in timings.items()}
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    print(f"{'entries':>10} {'parse ms':>10} {'sha ms':>10} {'serialize ms':>13}")
+    for count in args.sizes:
+        timings = bench_tree(count, args.repeat)
+        print(
+            f"{count:>10} {timings['parse'] * 1e3:>10.3f} {timings['sha'] * 1e3:>10.3f}"
+            f" {timings['serialize'] * 1e3:>13.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,27 @@
+import heapq
+import itertools
 import os
 import zlib
-from typing import List, Set
+from typing import (Callable, Dict, Iterable, Iterator, List, Optional, Set,
+                    Tuple)
 
+from src.commit_graph import GENERATION_INFINITY, get_commit_graph
+from src.ignore import IGNORE_FILE, IgnoreRules
+from src.index import IndexEntry
+from src.objects.base import is_sha1
 from src.objects.blob import Blob
 from src.objects.commit import Commit
 from src.objects.tree import Tree
+from src.pack import (find_packed_object, read_packed_object,
+                      read_packed_object_header)
 from src.repository import GITDIR, Repository, find_repository
+from src.stats import count
+from src.untracked_cache import UntrackedCache
 
 OBJECT_CLASSES = [Blob, Commit, Tree]
 OBJECT_CHOICES = {cls.object_type: cls for cls in OBJECT_CLASSES}
+# Bytes read (and inflated) at once to find the header of an object
+HEADER_CHUNK = 64
 
 
 def object_class(object_type):
@@ -19,10 +32,16 @@ def object_class(object_type):
 
 
 
-def read_object(repo: Repository, sha):
-    """ """
+def read_object_data(repo: Repository, sha) -> Tuple[bytes, bytes]:
+    """
+    Read the type and the content of an object, from a pack or as a loose object.
+    """
     assert len(sha) == 40
-    path = repo.build_path("objects", sha[0:2], sha[2:])
+    packed = read_packed_object(repo, sha)
+    if packed is not None:
+        return packed
+
+    path = get_loose_object_path(repo, sha)
     with open(path, "rb") as file:
         raw = zlib.decompress(file.read())
         # Read object type
@@ -35,8 +54,84 @@ def read_object(repo: Repository, sha):
         if size != len(raw) - header_end - 1:
             raise Exception(f"Invalid object {sha}: bad length")
 
-        obj_class = object_class(type_name)
-        return obj_class(repo, raw[header_end + 1 :])
+        return type_name, raw[header_end + 1 :]
+
+
+def get_loose_object_path(repo: Repository, sha) -> str:
+    # Objects written by the current transaction are still in their temporary file
+    transaction = repo.object_transaction
+    if transaction is not None and sha in transaction.staged:
+        return transaction.staged[sha]
+    return repo.build_path("objects", sha[0:2], sha[2:])
+
+
+def object_exists(repo: Repository, sha) -> bool:
+    """
+    Whether the object is stored, loose or in a pack.
+    """
+    path = get_loose_object_path(repo, sha)
+    return os.path.exists(path) or find_packed_object(repo, sha) is not None
+
+
+def read_object_header(repo: Repository, sha) -> Tuple[bytes, int]:
+    """
+    Read the type and the size of an object, inflating only its header.
+    """
+    assert len(sha) == 40
+    obj = repo.object_cache.get(sha)
+    if obj is not None:
+        return obj.object_type, len(obj.data)
+
+    packed = read_packed_object_header(repo, sha)
+    if packed is not None:
+        return packed
+
+    path = get_loose_object_path(repo, sha)
+    with open(path, "rb") as file:
+        decompressor = zlib.decompressobj()
+        header = b""
+        # "{type} {size}\0" is at the start of the stream
+        while b"\0" not in header:
+            chunk = decompressor.unconsumed_tail or file.read(HEADER_CHUNK)
+            if not chunk:
+                raise Exception(f"Invalid object {sha}: bad header")
+            header += decompressor.decompress(chunk, HEADER_CHUNK)
+
+    type_name, size = header[: header.find(b"\0")].split(b" ")
+    return type_name, int(size)
+
+
+def read_object(repo: Repository, sha):
+    """
+    Read and parse an object. Parsed objects are kept in the object cache of the
+    repository, so walking the history or the trees reads each object once.
+    """
+    obj = repo.object_cache.get(sha)
+    if obj is not None:
+        return obj
+
+    type_name, data = read_object_data(repo, sha)
+    obj_class = object_class(type_name)
+    obj = obj_class(repo, data)
+    repo.object_cache.put(sha, obj, len(data))
+    return obj
+
+
+def get_loose_objects(repo: Repository) -> List[str]:
+    """
+    SHA-1 of the objects stored as loose files in objects/xx/yyyy.
+    """
+    objects_dir = repo.build_path("objects")
+    shas = []
+    for directory in os.scandir(objects_dir):
+        # Skip objects/pack and objects/info
+        if len(directory.name) != 2 or not directory.is_dir():
+            continue
+        for file in os.scandir(directory.path):
+            sha = directory.name + file.name
+            if is_sha1(sha):
+                shas.append(sha)
+    return shas
 
 
 def find_object(repo, ref, object_type=None) -> str:
@@ -45,43 +140,408 @@ def find_object(repo, ref, object_type=None) -> str:
     return ref
 
 
+def get_commit_info(repo, sha) -> Tuple[List[str], int, int]:
+    """
+    (parents, commit time, generation) of a commit. They come from the commit-graph
+    when it has the commit, otherwise the commit object is read (with an infinite
+    generation).
+    """
+    commit_graph = get_commit_graph(repo)
+    if commit_graph is not None:
+        info = commit_graph.get(sha)
+        if info is not None:
+            return info
+
+    commit: Commit = read_object(repo, sha)
+    return commit.get_parents(), commit.get_commit_time(), GENERATION_INFINITY
+
+
+def walk_commits(repo, shas: List[str]) -> Iterator[str]:
+    """
+    Yield the SHA-1 of the commits reachable from shas (included), most recent first,
+    visiting every commit once even when several children share a parent.
+
+    Commits are looked up when they enter the queue, so stopping the iteration early
+    stops the reads too.
+    """
+    queue: List[Tuple[int, int, str, List[str]]] = []
+    seen: Set[str] = set()
+    # Breaks ties between commits with the same time, keeping insertion order
+    counter = itertools.count()
+
+    def push(sha):
+        if sha not in seen:
+            seen.add(sha)
+            parents, commit_time, _ = get_commit_info(repo, sha)
+            heapq.heappush(queue, (-commit_time, next(counter), sha, parents))
+
+    for sha in shas:
+        push(sha)
+
+    while queue:
+        _, _, sha, parents = heapq.heappop(queue)
+        yield sha
+        for parent in parents:
+            push(parent)
+
+
 def get_ancestors(repo, commit: Commit) -> List[str]:
-    """"""
-    ancestors = []
-    parents = commit.get_parents()  # sha 1 parents
-    for parent in parents:
-        parent_commit = read_object(repo, parent)
-        ancestors.append(parent)
-        ancestors.extend(get_ancestors(repo, parent_commit))
+    """
+    SHA-1 of the commits reachable from the parents of commit, most recent first.
+    """
+    return list(walk_commits(repo, commit.get_parents()))
+
+
+# Flags of paint_down_to_common
+PARENT1 = 1
+PARENT2 = 2
+STALE = 4
+
+
+def paint_down_to_common(repo, one: str, twos: List[str]) -> Tuple[List[str], List[str], Dict[str, int]]:
+    """
+    Walk down from one (painted PARENT1) and twos (painted PARENT2) passing the paint
+    to the parents, until only commits reachable from a common ancestor are left.
+
+    Commits are visited by generation and commit time, so a commit is painted by all
+    its children before it is visited. Returns the commits painted with both colors
+    that aren't below another one, the stale commits left in the queue and the paint
+    of every commit walked. The paint of the stale commits isn't passed down: without
+    a commit-graph a commit can be visited before a descendant, a commit painted with
+    a single color can still be reachable from them.
+    """
+    flags: Dict[str, int] = {}
+    queue: List[Tuple[int, int, int, str]] = []
+    queued: Set[str] = set()
+    counter = itertools.count()
+    # Non-stale commits in the queue, the walk is over when there are none left
+    pending = 0
+
+    def push(sha, paint):
+        nonlocal pending
+        old = flags.get(sha, 0)
+        if old & paint == paint:
+            return
+        flags[sha] = old | paint
+        if sha in queued:
+            if paint & STALE and not old & STALE:
+                pending -= 1
+            return
+        _, commit_time, generation = get_commit_info(repo, sha)
+        heapq.heappush(queue, (-generation, -commit_time, next(counter), sha))
+        queued.add(sha)
+        if not flags[sha] & STALE:
+            pending += 1
+
+    push(one, PARENT1)
+    for two in twos:
+        push(two, PARENT2)
 
-    return ancestors
+    common = []
+    while pending:
+        _, _, _, sha = heapq.heappop(queue)
+        queued.remove(sha)
+        paint = flags[sha]
+        if not paint & STALE:
+            pending -= 1
+            if paint & (PARENT1 | PARENT2) == PARENT1 | PARENT2:
+                common.append(sha)
+                paint |= STALE
+                flags[sha] = paint
+        for parent in get_commit_info(repo, sha)[0]:
+            push(parent, paint)
 
+    return common, list(queued), flags
 
-def ancestors_until_lca(commit1_ish, commit2_ish) -> List[str]:
-    repo: Repository = find_repository()
-    commit1: Commit = read_object(repo, commit1_ish)
 
-    ancestors1 = set(get_ancestors(repo, commit1))
-    commit2: Commit = read_object(repo, commit2_ish)
-    parent_hash = commit2_ish
-    ancestors_until_lca = [commit2_ish]
-    while parent_hash not in ancestors1:
-        # We asume that only has 1 parent
-        # Check get_parents doc.
-        parent_hash = read_object(repo, parent_hash).get_parents()[0]
-        ancestors_until_lca.append(parent_hash)
+def reachable_commits(repo, shas: List[str], targets: List[str]) -> Set[str]:
+    """
+    The targets reachable from shas (included). The walk doesn't go below the lowest
+    generation of the targets, their ancestors have a lower one.
+    """
+    min_generation = min(get_commit_info(repo, sha)[2] for sha in targets)
+    remaining = set(targets)
+    found: Set[str] = set()
+    seen: Set[str] = set()
+    stack = list(shas)
+    while stack and remaining:
+        sha = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+        if sha in remaining:
+            remaining.remove(sha)
+            found.add(sha)
+        parents, _, generation = get_commit_info(repo, sha)
+        if generation >= min_generation:
+            stack.extend(parents)
+    return found
 
-    ancestors_until_lca.reverse()
-    return ancestors_until_lca
 
+def remove_redundant(repo, shas: List[str]) -> List[str]:
+    """
+    shas without the commits that are an ancestor of another one of them.
 
-def get_files_rec(directory):
+    Every commit is checked against all the others, the order of shas doesn't matter:
+    without a commit-graph commits can be visited before their descendants (commit
+    times are equal or skewed).
+    """
+    redundant: Set[str] = set()
+    for sha in shas:
+        if sha in redundant:
+            continue
+        others = [other for other in shas if other != sha and other not in redundant]
+        if others:
+            redundant |= reachable_commits(repo, get_commit_info(repo, sha)[0], others)
+    return [sha for sha in shas if sha not in redundant]
+
+
+def merge_bases(repo, commit1: str, commit2: str) -> List[str]:
+    """
+    Best common ancestors of two commits: the common ancestors that aren't an
+    ancestor of another common ancestor. There are several with criss-cross merges.
+
+    https://git-scm.com/docs/git-merge-base
+    """
+    if commit1 == commit2:
+        return [commit1]
+
+    common, _, _ = paint_down_to_common(repo, commit1, [commit2])
+    return remove_redundant(repo, common)
+
+
+def merge_base(repo, commit1: str, commit2: str) -> Optional[str]:
+    """
+    A best common ancestor of two commits, None if they have no common history.
+    """
+    bases = merge_bases(repo, commit1, commit2)
+    return bases[0] if bases else None
+
+
+def commits_not_in(repo, commit: str, upstream: str) -> List[str]:
+    """
+    Commits reachable from commit but not from upstream, oldest first: the commits
+    that rebasing commit on upstream applies again.
+    """
+    if commit == upstream:
+        return []
+
+    _, stale, flags = paint_down_to_common(repo, upstream, [commit])
+    selected = {sha for sha, paint in flags.items() if paint == PARENT2}
+    # Pass the paint of the stale commits down, like git marks all the ancestors of
+    # upstream uninteresting
+    if selected and stale:
+        selected -= reachable_commits(repo, stale, list(selected))
+
+    # Topological order, not the visit order (see remove_redundant): depth first from
+    # commit, a commit is added once all its parents are
+    ordered: List[str] = []
+    done: Set[str] = set()
+    stack = [(commit, False)]
+    while stack:
+        sha, parents_done = stack.pop()
+        if parents_done:
+            ordered.append(sha)
+            continue
+        if sha in done or sha not in selected:
+            continue
+        done.add(sha)
+        stack.append((sha, True))
+        stack.extend((parent, False) for parent in reversed(get_commit_info(repo, sha)[0]))
+    return ordered
+
+
+def get_ignore_rules(worktree: str, path: str) -> IgnoreRules:
+    """
+    Rules of the .calpignore files of the directories containing path (relative to
+    worktree), from the root down to its parent.
+    """
+    rules = IgnoreRules()
+    prefix = ""
+    for name in path.split("/") if path else []:
+        rules = rules.load(worktree, prefix)
+        prefix += name + "/"
+    return rules
+
+
+def is_ignored(worktree: str, path: str, is_directory=False) -> bool:
+    """
+    Whether path (relative to worktree) is excluded by .calpignore files, by its name
+    or by the name of one of its parent directories.
+    """
+    rules = IgnoreRules()
+    prefix = ""
+    names = path.split("/")
+    for depth, name in enumerate(names, 1):
+        rules = rules.load(worktree, prefix)
+        prefix += name
+        if rules.is_ignored(prefix, is_directory or depth < len(names)):
+            return True
+        prefix += "/"
+    return False
+
+
+def walk_worktree(
+    worktree: str,
+    directory: str = "",
+    is_tracked: Optional[Callable[[str], bool]] = None,
+    directories: Optional[List[str]] = None,
+    untracked_cache: Optional[UntrackedCache] = None,
+) -> List[str]:
+    """
+    Paths of the files under directory (relative to worktree, / separated), without
+    the repository directory and the paths excluded by .calpignore files. The
+    directories walked are appended to directories if given.
+
+    Ignored directories are not entered, unless is_tracked("{directory}/") tells they
+    contain tracked files: ignore rules only apply to untracked paths. The walk uses
+    the file types cached by os.scandir, files are never stat'ed. With an untracked
+    cache, the directories that didn't change are not read either.
+    """
     files = []
-    for path in os.scandir(directory):
-        if not path.name.startswith(GITDIR):
-            if path.is_file():
-                files.append(os.path.join(directory, path))
-            else:
-                files.extend(get_files_rec(os.path.join(directory, path)))
+    # The .calpignore of directory itself is loaded by the walk
+    stack = [(directory + "/" if directory else "", get_ignore_rules(worktree, directory))]
+    while stack:
+        prefix, rules = stack.pop()
+        if directories is not None:
+            directories.append(prefix[:-1])
+        if untracked_cache is not None:
+            entries = untracked_cache.list_directory(worktree, prefix[:-1])
+        else:
+            with os.scandir(os.path.join(worktree, prefix)) as iterator:
+                entries = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in iterator]
+        if any(name == IGNORE_FILE for name, _ in entries):
+            rules = rules.load(worktree, prefix)
+
+        for name, is_directory in entries:
+            path = prefix + name
+            if is_directory:
+                if name == GITDIR:
+                    continue
+                if rules.is_ignored(path, True) and not (is_tracked and is_tracked(path + "/")):
+                    count("ignored directories skipped")
+                    continue
+                stack.append((path + "/", rules))
+            elif not rules.is_ignored(path, False) or (is_tracked and is_tracked(path)):
+                files.append(path)
 
     return files
+
+
+def iter_tree(repo, tree_sha: str, prefix: str = "") -> Iterator[Tuple[str, bytes, str]]:
+    """
+    Yield (path, mode, sha) of the blobs of a tree and its subtrees, in path order.
+    """
+    stack = [(prefix, iter(read_object(repo, tree_sha).items))]
+    while stack:
+        directory, items = stack[-1]
+        item = next(items, None)
+        if item is None:
+            stack.pop()
+            continue
+
+        path = directory + item.path.decode("utf-8")
+        if item.is_tree():
+            stack.append((path + "/", iter(read_object(repo, item.sha).items)))
+        else:
+            yield path, item.mode, item.sha
+
+
+def diff_trees(
+    repo, old_tree: Optional[str], new_tree: Optional[str]
+) -> Iterator[Tuple[str, str, Optional[Tuple[bytes, str]], Optional[Tuple[bytes, str]]]]:
+    """
+    Yield (status, path, old, new) for the blobs that differ between two trees, in
+    path order. status is "added", "modified" or "deleted", old and new are
+    (mode, sha) or None for the side missing the blob. A tree None is empty.
+
+    Both trees are walked together and subtrees with the same SHA-1 on both sides are
+    skipped without being read, so the cost depends on the size of the change.
+    """
+    stack = [diff_tree_items(repo, "", old_tree, new_tree)]
+    while stack:
+        change = next(stack[-1], None)
+        if change is None:
+            stack.pop()
+        elif change[0] == "tree":
+            _, path, old_sha, new_sha = change
+            stack.append(diff_tree_items(repo, path + "/", old_sha, new_sha))
+        else:
+            yield change
+
+
+def diff_tree_items(repo, prefix: str, old_sha: Optional[str], new_sha: Optional[str]):
+    """
+    Changes between the entries of two trees, merged in tree order. Subtrees to
+    compare are yielded as ("tree", path, old sha, new sha), for diff_trees to walk.
+    """
+    old_items = read_object(repo, old_sha).items if old_sha else []
+    new_items = read_object(repo, new_sha).items if new_sha else []
+    i = j = 0
+    while i < len(old_items) or j < len(new_items):
+        old = old_items[i] if i < len(old_items) else None
+        new = new_items[j] if j < len(new_items) else None
+        # In tree order, a subtree is sorted as if its name ended with a slash, so a
+        # file and a directory with the same name are a deletion and an addition
+        old_key = old.path + b"/" if old and old.is_tree() else old and old.path
+        new_key = new.path + b"/" if new and new.is_tree() else new and new.path
+
+        if new is None or (old is not None and old_key < new_key):
+            new = None
+            i += 1
+        elif old is None or new_key < old_key:
+            old = None
+            j += 1
+        else:
+            i += 1
+            j += 1
+            if old.raw_sha == new.raw_sha and old.mode == new.mode:
+                if old.is_tree():
+                    count("subtrees skipped")
+                continue
+
+        path = prefix + (old or new).path.decode("utf-8")
+        if (old or new).is_tree():
+            yield "tree", path, old and old.sha, new and new.sha
+        elif old is None:
+            yield "added", path, None, (new.mode, new.sha)
+        elif new is None:
+            yield "deleted", path, (old.mode, old.sha), None
+        else:
+            yield "modified", path, (old.mode, old.sha), (new.mode, new.sha)
+
+
+def diff_index_worktree(
+    entries: Dict[str, IndexEntry],
+    paths: Iterable[str],
+    is_modified: Callable[[IndexEntry, str], bool],
+) -> dict:
+    """
+    Classify the worktree files against the index entries in a single pass.
+
+    entries: index entries keyed by their path.
+    paths: files of the worktree, relative to its root.
+    is_modified: tells if the file at path has different content than its entry.
+
+    Every path is looked up once in the entries, so the cost is linear in the number
+    of files plus the number of entries.
+    """
+    remaining = dict(entries)
+    modified = []
+    untracked = []
+
+    for path in paths:
+        entry = remaining.pop(path, None)
+        if entry is None:
+            untracked.append(path)
+        elif is_modified(entry, path):
+            modified.append(path)
+
+    # Whatever wasn't found in the worktree has been deleted
+    deleted = list(remaining)
+
+    return {
+        "deleted": sorted(deleted),
+        "modified": sorted(modified),
+        "untracked": sorted(untracked),
+    }
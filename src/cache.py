@@ -0,0 +1,51 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Bounded mapping that evicts the least recently used entries, when it holds more
+    than max_entries entries or more than max_bytes bytes (as given to put).
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        try:
+            value, size = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size: int):
+        if size > self.max_bytes or self.max_entries <= 0:
+            # Would evict everything else
+            return
+
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.size += size
+
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
@@ -0,0 +1,57 @@
+import struct
+from typing import Dict, Iterable, Optional, Tuple
+
+"""
+The cache-tree is stored in the "TREE" extension of the index. For every directory
+whose tree object is known (the root is ""), it records the SHA-1 of the tree and the
+number of index entries below it:
+
+{path}\\0 {number of entries (u32)} {sha-1 (20 bytes)}
+
+Changing an entry invalidates the directories containing it, so write_tree only
+rebuilds the trees along the paths that changed.
+"""
+
+CACHE_TREE_SIGNATURE = b"TREE"
+TREE_RECORD = struct.Struct(">I20s")
+
+
+class CacheTree:
+    def __init__(self, trees: Optional[Dict[str, Tuple[int, str]]] = None):
+        # {directory: (number of entries, tree sha-1)}
+        self.trees = trees or {}
+
+    def __eq__(self, other):
+        return isinstance(other, CacheTree) and self.trees == other.trees
+
+    @classmethod
+    def deserialize(cls, data: bytes) -> "CacheTree":
+        trees = {}
+        pos = 0
+        while pos < len(data):
+            end = data.index(b"\0", pos)
+            entry_count, sha = TREE_RECORD.unpack_from(data, end + 1)
+            trees[data[pos:end].decode("utf-8")] = (entry_count, sha.hex())
+            pos = end + 1 + TREE_RECORD.size
+        return cls(trees)
+
+    def serialize(self) -> bytes:
+        return b"".join(
+            path.encode("utf-8") + b"\0" + TREE_RECORD.pack(entry_count, bytes.fromhex(sha))
+            for path, (entry_count, sha) in sorted(self.trees.items())
+        )
+
+    def get(self, directory: str) -> Optional[Tuple[int, str]]:
+        return self.trees.get(directory)
+
+    def set(self, directory: str, entry_count: int, sha: str):
+        self.trees[directory] = (entry_count, sha)
+
+    def invalidate(self, paths: Iterable[str]):
+        """
+        Forget the trees of the directories containing each path.
+        """
+        for path in paths:
+            parts = path.split("/")
+            for depth in range(len(parts)):
+                self.trees.pop("/".join(parts[:depth]), None)
@@ -1,11 +1,4 @@
-import argparse
-import optparse
-import time
-
-from src.repository import find_repository
-from src.utils import print_status_messages
-
-from . import plumbing, porcelain
+import sys
 
 
 class Command:
@@ -15,6 +8,9 @@ class Command:
 
 class CmdInit(Command):
     def run(self, args):
+        import optparse
+        from src import porcelain
+
         parser = optparse.OptionParser()
         parser.add_option(
             "--path", dest="path", default=".", help="Where to create the repository."
@@ -25,6 +21,9 @@ class CmdInit(Command):
 
 class CmdStatus(Command):
     def run(self, args):
+        import optparse
+        from src import porcelain, utils
+
         parser = optparse.OptionParser()
         parser.add_option(
             "-w",
@@ -39,18 +38,20 @@ class CmdStatus(Command):
             return
 
         if options.watch:
-            while True:
-                STATUS = porcelain.status()
-                print_status_messages(STATUS)
-                time.sleep(2)
-                print("\033c", end="")
+            from src import watch
+
+            watch.watch_status()
+            return
 
         STATUS = porcelain.status()
-        print_status_messages(STATUS)
+        utils.print_status_messages(STATUS)
 
 
 class CmdCheckout(Command):
     def run(self, args):
+        import optparse
+        from src import porcelain
+
         parser = optparse.OptionParser()
         parser.add_option(
             "-b",
@@ -73,37 +74,60 @@ class CmdCheckout(Command):
 
 class CmdAdd(Command):
     def run(self, args):
+        import argparse
+        from src import porcelain
+
         parser = argparse.ArgumentParser()
         parser.add_argument("paths", nargs="+")
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=None,
+            help="Number of threads hashing files (default: number of CPUs).",
+        )
         args = parser.parse_args(args)
-        porcelain.add(args.paths)
+        porcelain.add(args.paths, args.jobs)
 
 
 class CmdLog(Command):
     def run(self, args):
-        parser = optparse.OptionParser()
-        parser.add_option(
-            "-w",
-            dest="watch",
-            action="store_true",
-            help="Name of the branch.",
-        )
-        options, args = parser.parse_args(args)
+        # getopt, not optparse: log is run by hooks and prompts, optparse and the
+        # modules it imports take 8 ms
+        import getopt
+        from src import porcelain
+
+        try:
+            options, args = getopt.getopt(args, "wn:")
+        except getopt.GetoptError as error:
+            print(f"ERROR: {error}")
+            return
+        options = dict(options)
 
-        if options.watch and len(args) > 0:
+        if "-w" in options and len(args) > 0:
             print('ERROR: Flag "-w" does not require value')
             return
 
-        if options.watch:
-            while True:
-                porcelain.log()
-                time.sleep(2)
-                print("\033c", end="")
-        porcelain.log()
+        max_count = None
+        if "-n" in options:
+            if not options["-n"].isdigit():
+                print(f'ERROR: Flag "-n" requires a number, not {options["-n"]}')
+                return
+            max_count = int(options["-n"])
+
+        if "-w" in options:
+            from src import watch
+
+            watch.watch_log(max_count)
+            return
+        porcelain.log(max_count)
 
 
 class CmdCommit(Command):
     def run(self, args):
+        import argparse
+        from src import porcelain
+
         # required -m message
         parser = argparse.ArgumentParser()
         parser.add_argument("-m", "--message", required=True)
@@ -114,6 +138,9 @@ class CmdCommit(Command):
 
 class CmdLsTree(Command):
     def run(self, args):
+        import optparse
+        from src import plumbing
+
         parser = optparse.OptionParser()
         parser.add_option("--tree-ish", dest="tree_ish", help="Tree-ish of the tree.")
         options, args = parser.parse_args(args)
@@ -127,6 +154,9 @@ class CmdLsTree(Command):
 
 class CmdHashObject(Command):
     def run(self, args):
+        import optparse
+        from src import plumbing
+
         parser = optparse.OptionParser()
         parser.add_option(
             "-t",
@@ -160,18 +190,63 @@ class CmdHashObject(Command):
 
 class CmdCatFile(Command):
     def run(self, args):
+        import argparse
+        from src import plumbing
+
+        # calp cat-file <type> <object>
+        # calp cat-file (-t | -s) <object>
+        # calp cat-file --batch-check < objects
+        # calp cat-file --batch < objects
         parser = argparse.ArgumentParser()
         parser.add_argument(
-            "type", choices=["blob", "commit", "tag", "tree"], help="Specify the type"
+            "-t", dest="show_type", action="store_true", help="Show the object type"
         )
-        parser.add_argument("object", help="The object to display")
+        parser.add_argument(
+            "-s", dest="show_size", action="store_true", help="Show the object size"
+        )
+        parser.add_argument(
+            "--batch-check",
+            action="store_true",
+            help="Print the type and size of each object read from stdin",
+        )
+        parser.add_argument(
+            "--batch",
+            action="store_true",
+            help="Print the type, size and content of each object read from stdin",
+        )
+        parser.add_argument("args", nargs="*", metavar="[type] object")
         args = parser.parse_args(args)
-        data = plumbing.cat_file(args.type, args.object)
-        print(data)
+
+        if args.batch:
+            # Binary stream, flushed after each object for the reader waiting on it
+            for chunk in plumbing.cat_file_batch(sys.stdin):
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+            return
+
+        if args.batch_check:
+            for line in plumbing.cat_file_batch_check(sys.stdin):
+                print(line, flush=True)
+            return
+
+        if args.show_type or args.show_size:
+            if len(args.args) != 1:
+                parser.error("-t and -s require an object")
+            object_type, size = plumbing.cat_file_header(args.args[0])
+            print(object_type if args.show_type else size)
+            return
+
+        if len(args.args) != 2 or args.args[0] not in ["blob", "commit", "tag", "tree"]:
+            parser.error("a type (blob, commit, tag, tree) and an object are required")
+        data = plumbing.cat_file(*args.args)
+        sys.stdout.buffer.write(data)
 
 
 class CmdCherryPick(Command):
     def run(self, args):
+        import argparse
+        from src import porcelain
+
         parser = argparse.ArgumentParser()
         parser.add_argument("commit_ref", help="The commit to cherry-pick")
         args = parser.parse_args(args)
@@ -180,6 +255,9 @@ class CmdCherryPick(Command):
 
 class CmdRebase(Command):
     def run(self, args):
+        import argparse
+        from src import porcelain
+
         parser = argparse.ArgumentParser()
         parser.add_argument("commit_ref", help="The commit to rebase from")
         args = parser.parse_args(args)
@@ -187,8 +265,72 @@ class CmdRebase(Command):
         print(sha1)
 
 
+class CmdMergeBase(Command):
+    def run(self, args):
+        import argparse
+        from src import porcelain
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-a", "--all", action="store_true", help="Output all merge bases")
+        parser.add_argument("commit1", help="sha1 or branch name")
+        parser.add_argument("commit2", help="sha1 or branch name")
+        args = parser.parse_args(args)
+        bases = porcelain.merge_base(args.commit1, args.commit2, args.all)
+        if not bases:
+            sys.exit(1)
+        for sha in bases:
+            print(sha)
+
+
+class CmdRepack(Command):
+    def run(self, args):
+        import optparse
+        from src import plumbing
+
+        parser = optparse.OptionParser()
+        parser.add_option(
+            "-a",
+            dest="all_objects",
+            action="store_true",
+            help="Pack the objects of the existing packs too.",
+        )
+        parser.add_option(
+            "-d",
+            dest="delete",
+            action="store_true",
+            help="Remove the loose objects and packs made redundant.",
+        )
+        options, args = parser.parse_args(args)
+        pack_path = plumbing.repack(options.all_objects, options.delete)
+        print(pack_path or "Nothing new to pack")
+
+
+class CmdGc(Command):
+    def run(self, args):
+        import optparse
+        from src import porcelain
+
+        parser = optparse.OptionParser()
+        options, args = parser.parse_args(args)
+        pack_path = porcelain.gc()
+        print(pack_path or "Nothing to pack")
+
+
+class CmdCommitGraph(Command):
+    def run(self, args):
+        import argparse
+        from src import plumbing
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument("action", choices=["write"], help="Write the commit-graph")
+        args = parser.parse_args(args)
+        path = plumbing.write_commit_graph()
+        print(path or "No commits yet")
+
+
 commands = {
     "rebase": CmdRebase,
+    "merge-base": CmdMergeBase,
     "checkout": CmdCheckout,
     "init": CmdInit,
     "status": CmdStatus,
@@ -199,4 +341,7 @@ commands = {
     "cat-file": CmdCatFile,
     "ls-tree": CmdLsTree,
     "cherry-pick": CmdCherryPick,
+    "repack": CmdRepack,
+    "gc": CmdGc,
+    "commit-graph": CmdCommitGraph,
 }
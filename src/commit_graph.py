@@ -0,0 +1,212 @@
+import mmap
+import os
+import struct
+from hashlib import sha1
+from typing import Dict, List, Optional, Tuple
+
+from src.repository import Repository
+
+"""
+The commit-graph stores the parents of the commits in fixed-width records, so history
+walks don't have to inflate and parse the commit objects.
+
+Format of objects/info/commit-graph (integers are big endian):
+
+header:      "CGPH" | version (u32) | number of commits (u32)
+fanout:      256 u32, number of commits whose sha-1 first byte is <= i
+commits:     sha-1 (20 bytes) of each commit, sorted
+records:     one per commit, in the same order
+             tree sha-1 (20 bytes) | parent 1 (u32) | parent 2 (u32)
+             | generation (u32) | commit time (u64)
+extra edges: u32 positions of the parents of octopus merges
+checksum:    sha-1 of all the above
+
+Parents are positions in the commits table. PARENT_NONE means no parent. When a commit
+has more than two parents, parent 2 is EXTRA_EDGES | i, and its other parents are at
+extra edges i, i + 1, ... the last one has EXTRA_EDGES set.
+
+The generation of a commit is 1 + the maximum generation of its parents (1 for a root
+commit): a commit can't be an ancestor of a commit with a lower or equal generation.
+
+https://git-scm.com/docs/commit-graph
+"""
+
+GRAPH_SIGNATURE = b"CGPH"
+GRAPH_VERSION = 1
+GRAPH_HEADER = struct.Struct(">4sII")
+GRAPH_RECORD = struct.Struct(">20sIIIQ")
+PARENT_NONE = 0x70000000
+EXTRA_EDGES = 0x80000000
+# Generation of the commits missing from the graph
+GENERATION_INFINITY = 0xFFFFFFFF
+
+
+class CommitGraph:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, self.count = GRAPH_HEADER.unpack_from(self.data)
+        if signature != GRAPH_SIGNATURE or version != GRAPH_VERSION:
+            raise Exception(f"Invalid commit-graph {path}")
+
+        self.fanout = struct.unpack_from(">256I", self.data, GRAPH_HEADER.size)
+        self.shas_start = GRAPH_HEADER.size + 256 * 4
+        self.records_start = self.shas_start + self.count * 20
+        self.extra_edges_start = self.records_start + self.count * GRAPH_RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def sha_at(self, pos: int) -> str:
+        start = self.shas_start + pos * 20
+        return self.data[start : start + 20].hex()
+
+    def find(self, sha: str) -> int:
+        """
+        Position of the commit in the graph, or -1.
+        """
+        raw = bytes.fromhex(sha)
+        low = self.fanout[raw[0] - 1] if raw[0] else 0
+        high = self.fanout[raw[0]]
+        while low < high:
+            mid = (low + high) // 2
+            start = self.shas_start + mid * 20
+            mid_sha = self.data[start : start + 20]
+            if mid_sha < raw:
+                low = mid + 1
+            elif mid_sha > raw:
+                high = mid
+            else:
+                return mid
+        return -1
+
+    def record_at(self, pos: int) -> Tuple[bytes, int, int, int, int]:
+        return GRAPH_RECORD.unpack_from(self.data, self.records_start + pos * GRAPH_RECORD.size)
+
+    def parents_at(self, pos: int) -> List[int]:
+        _, parent1, parent2, _, _ = self.record_at(pos)
+        if parent1 == PARENT_NONE:
+            return []
+        if parent2 == PARENT_NONE:
+            return [parent1]
+        if not parent2 & EXTRA_EDGES:
+            return [parent1, parent2]
+
+        parents = [parent1]
+        edge = self.extra_edges_start + (parent2 & ~EXTRA_EDGES) * 4
+        while True:
+            (parent,) = struct.unpack_from(">I", self.data, edge)
+            parents.append(parent & ~EXTRA_EDGES)
+            if parent & EXTRA_EDGES:
+                return parents
+            edge += 4
+
+    def get(self, sha: str) -> Optional[Tuple[List[str], int, int]]:
+        """
+        (parents, commit time, generation) of a commit, None if it is not in the graph.
+        """
+        pos = self.find(sha)
+        if pos < 0:
+            return None
+        _, _, _, generation, commit_time = self.record_at(pos)
+        parents = [self.sha_at(parent) for parent in self.parents_at(pos)]
+        return parents, commit_time, generation
+
+    def get_tree_hash(self, sha: str) -> Optional[str]:
+        pos = self.find(sha)
+        return self.record_at(pos)[0].hex() if pos >= 0 else None
+
+    def close(self):
+        self.data.close()
+
+
+def get_commit_graph_path(repo: Repository) -> str:
+    return repo.build_path("objects", "info", "commit-graph")
+
+
+def get_commit_graph(repo: Repository) -> Optional[CommitGraph]:
+    """
+    Commit-graph of the repository, loaded again when the file is rewritten.
+    """
+    path = get_commit_graph_path(repo)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    cached = repo.commit_graph
+    if cached is None or cached[0] != mtime_ns:
+        if cached is not None:
+            cached[1].close()
+        repo.commit_graph = (mtime_ns, CommitGraph(path))
+    return repo.commit_graph[1]
+
+
+def write_commit_graph(repo: Repository, commits: Dict[str, Tuple[str, List[str], int]]) -> str:
+    """
+    Write the commit-graph of commits, {sha: (tree sha, parents, commit time)}.
+    Every parent must be in commits.
+    """
+    shas = sorted(commits)
+    positions = {sha: pos for pos, sha in enumerate(shas)}
+
+    # Parents first, without recursion: a commit is done once all its parents are
+    generations: Dict[str, int] = {}
+    for sha in shas:
+        stack = [sha]
+        while stack:
+            top = stack[-1]
+            if top in generations:
+                stack.pop()
+                continue
+            pending = [parent for parent in commits[top][1] if parent not in generations]
+            if pending:
+                stack.extend(pending)
+            else:
+                parents = commits[top][1]
+                generations[top] = 1 + max((generations[p] for p in parents), default=0)
+                stack.pop()
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    records = []
+    extra_edges: List[int] = []
+    for sha in shas:
+        tree, parents, commit_time = commits[sha]
+        parent_positions = [positions[parent] for parent in parents]
+        parent1 = parent_positions[0] if parent_positions else PARENT_NONE
+        if len(parent_positions) <= 2:
+            parent2 = parent_positions[1] if len(parent_positions) == 2 else PARENT_NONE
+        else:
+            parent2 = EXTRA_EDGES | len(extra_edges)
+            extra_edges.extend(parent_positions[1:])
+            extra_edges[-1] |= EXTRA_EDGES
+        records.append(
+            GRAPH_RECORD.pack(
+                bytes.fromhex(tree), parent1, parent2, generations[sha], commit_time
+            )
+        )
+
+    data = b"".join(
+        [
+            GRAPH_HEADER.pack(GRAPH_SIGNATURE, GRAPH_VERSION, len(shas)),
+            struct.pack(">256I", *fanout),
+            b"".join(bytes.fromhex(sha) for sha in shas),
+            b"".join(records),
+            struct.pack(f">{len(extra_edges)}I", *extra_edges),
+        ]
+    )
+
+    path = get_commit_graph_path(repo)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data + sha1(data).digest())
+    os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,119 @@
+import os
+import re
+from typing import List, Optional, Pattern, Tuple
+
+"""
+Ignore rules of the worktree, read from the .calpignore files. They follow the
+gitignore format:
+
+- blank lines and lines starting with # are skipped, \\# and \\! escape them
+- ! negates a pattern: a path it matches is not ignored anymore
+- a pattern ending with / only matches directories
+- a pattern with a / at the start or in the middle is relative to the directory of
+  the .calpignore, otherwise it matches a name at any depth below it
+- * and ? match anything but /, [...] a character of the class, ** any number of
+  directories
+
+Patterns of a .calpignore apply to its directory and below, the patterns of deeper
+files and the later patterns of a file take precedence.
+
+https://git-scm.com/docs/gitignore
+"""
+
+IGNORE_FILE = ".calpignore"
+
+# (directory of the .calpignore with a trailing /, regex, negated, only directories)
+Rule = Tuple[str, Pattern, bool, bool]
+
+
+def translate(pattern: str) -> str:
+    """
+    Regex of a glob pattern, relative to the directory of its file.
+    """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i) and (i == 0 or pattern[i - 1] == "/"):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern.endswith("**") and i + 2 == len(pattern) and (i == 0 or pattern[i - 1] == "/"):
+            # Everything inside
+            regex.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            regex.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            regex.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and pattern.find("]", i + 2) > 0:
+            end = pattern.find("]", i + 2)
+            chars = pattern[i + 1 : end]
+            if chars[0] == "!":
+                chars = "^" + chars[1:]
+            regex.append("[" + chars.replace("\\", "\\\\") + "]")
+            i = end + 1
+        elif pattern[i] == "\\" and i + 1 < len(pattern):
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(regex)
+
+
+def compile_rule(line: str, base: str) -> Optional[Rule]:
+    line = line.rstrip("\n").rstrip(" ")
+    if not line or line.startswith("#"):
+        return None
+
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    elif line.startswith("\\"):
+        line = line[1:]
+
+    only_directories = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+
+    # Patterns without a slash match a name at any depth
+    anchored = "/" in line
+    regex = translate(line.lstrip("/"))
+    if not anchored:
+        regex = "(?:.*/)?" + regex
+    return base, re.compile(regex + r"\Z"), negated, only_directories
+
+
+class IgnoreRules:
+    """
+    Rules of the .calpignore files that apply to a directory, from the worktree root
+    down to it.
+    """
+
+    def __init__(self, rules: List[Rule] = []):
+        self.rules = rules
+
+    def load(self, worktree: str, directory: str) -> "IgnoreRules":
+        """
+        Rules for directory (relative to worktree, "" or ending with /), with the ones
+        of its .calpignore if it has one.
+        """
+        try:
+            with open(os.path.join(worktree, directory, IGNORE_FILE), "r") as file:
+                lines = file.readlines()
+        except (FileNotFoundError, NotADirectoryError):
+            return self
+
+        rules = [compile_rule(line, directory) for line in lines]
+        return IgnoreRules(self.rules + [rule for rule in rules if rule is not None])
+
+    def is_ignored(self, path: str, is_directory: bool) -> bool:
+        # The last matching rule decides
+        for base, regex, negated, only_directories in reversed(self.rules):
+            if only_directories and not is_directory:
+                continue
+            if path.startswith(base) and regex.match(path, len(base)):
+                return not negated
+        return False
@@ -1,92 +1,447 @@
+import bisect
+import mmap
 import os
-from typing import List
+import struct
+from contextlib import contextmanager
+from hashlib import sha1
+from typing import Dict, Iterator, List, Optional
 
-from src.repository import find_repository
+from src.cache_tree import CACHE_TREE_SIGNATURE, CacheTree
+from src.repository import Repository, find_repository
+
+"""
+Format of the index file (integers are big endian):
+
+header:     "CIDX" | version (u32) | number of entries (u32) | size of the paths (u32)
+entries:    one fixed-width record per entry, sorted by path
+            ctime_ns (u64) | mtime_ns (u64) | inode (u64) | size (u64) | mode (u32)
+            | sha-1 (20 bytes) | path offset (u32) | path length (u16) | flags (u16)
+paths:      utf-8 paths, addressed by the records
+extensions: {signature (4 bytes)} {length (u32)} {data}, optional
+checksum:   sha-1 of all the above
+
+Records have a fixed width, so a path is found with a binary search over the mmapped
+file, and an update copies the untouched records as they are.
+"""
+
+INDEX_SIGNATURE = b"CIDX"
+INDEX_VERSION = 1
+HEADER = struct.Struct(">4sIII")
+RECORD = struct.Struct(">QQQQI20sIHH")
+# Offsets of the fields read straight from a record: the size of the fields before them
+RECORD_MTIME_OFFSET = struct.calcsize(">Q")
+RECORD_MODE_OFFSET = struct.calcsize(">QQQQ")
+RECORD_SHA_OFFSET = struct.calcsize(">QQQQI")
+RECORD_PATH_OFFSET = struct.calcsize(">QQQQI20s")
+EXTENSION_HEADER = struct.Struct(">4sI")
+# Only the mtime of a record, to find racy entries without unpacking the records
+RECORD_MTIME = struct.Struct(f">{RECORD_MTIME_OFFSET}xQ{RECORD.size - struct.calcsize('>QQ')}x")
+CHECKSUM_SIZE = 20
 
 
 class IndexEntry:
-    # {hash} {path}\n
-    def __init__(self, path, hash):
+    def __init__(self, path, hash, ctime_ns=0, mtime_ns=0, size=0, ino=0, mode=0):
         self.path = path
         self.hash = hash
+        # Stat data of the file when it was hashed. It lets status skip rehashing
+        # files that haven't been touched since they were added.
+        self.ctime_ns = ctime_ns
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.ino = ino
+        self.mode = mode
 
-    def deserialize(self, data: bytes):
-        # TODO: Implement
-        ...
+    @classmethod
+    def from_stat(cls, path, hash, st: os.stat_result) -> "IndexEntry":
+        return cls(
+            path, hash, st.st_ctime_ns, st.st_mtime_ns, st.st_size, st.st_ino, st.st_mode
+        )
 
-    def serialize(self) -> bytes:
-        # TODO: Implement
-        ...
+    @classmethod
+    def deserialize(cls, record: bytes, path: str) -> "IndexEntry":
+        ctime_ns, mtime_ns, ino, size, mode, sha, _, _, _ = RECORD.unpack(record)
+        return cls(path, sha.hex(), ctime_ns, mtime_ns, size, ino, mode)
 
+    def serialize(self, path_offset: int) -> bytes:
+        return RECORD.pack(
+            self.ctime_ns,
+            self.mtime_ns,
+            self.ino,
+            self.size,
+            self.mode,
+            bytes.fromhex(self.hash),
+            path_offset,
+            len(self.path.encode("utf-8")),
+            0,
+        )
 
-def read_entries() -> List[IndexEntry]:
-    entries = []
-    repository = find_repository()
-    index_path = repository.build_path("index")
+    def stat_matches(self, st: os.stat_result) -> bool:
+        return (
+            self.mtime_ns == st.st_mtime_ns
+            and self.ctime_ns == st.st_ctime_ns
+            and self.size == st.st_size
+            and self.ino == st.st_ino
+            and self.mode == st.st_mode
+        )
+
+    def is_racy(self, index_mtime_ns) -> bool:
+        """
+        An entry is "racily clean" when the file was modified in the same timestamp
+        tick the index was written: a later change could keep the same stat data, so
+        its content must be checked again.
+
+        https://git-scm.com/docs/racy-git
+        """
+        return self.mtime_ns >= index_mtime_ns
+
+    def smudge(self):
+        # Force the next status to rehash the file
+        self.mtime_ns = 0
+
+
+class IndexFile:
+    """
+    Read access to the index file, without parsing the entries up front.
+    """
+
+    def __init__(self, data=b"", mtime_ns=0, verify=False):
+        self.data = data
+        self.mtime_ns = mtime_ns
+        self.extensions: Dict[bytes, bytes] = {}
+
+        if not data:
+            self.count = 0
+            self.records = self.paths = memoryview(b"")
+            return
+
+        signature, version, self.count, paths_size = HEADER.unpack_from(data)
+        if signature != INDEX_SIGNATURE or version != INDEX_VERSION:
+            raise Exception(f"Invalid index file: unknown signature {signature}")
+
+        body_end = len(data) - CHECKSUM_SIZE
+        if verify:
+            if sha1(data[:body_end]).digest() != data[body_end:]:
+                raise Exception("Invalid index file: bad checksum")
+
+        view = memoryview(data)
+        records_end = HEADER.size + self.count * RECORD.size
+        paths_end = records_end + paths_size
+        self.records = view[HEADER.size : records_end]
+        self.paths = view[records_end:paths_end]
+
+        pos = paths_end
+        while pos < body_end:
+            signature, length = EXTENSION_HEADER.unpack_from(data, pos)
+            pos += EXTENSION_HEADER.size
+            self.extensions[signature] = bytes(view[pos : pos + length])
+            pos += length
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self) -> Iterator[IndexEntry]:
+        for pos in range(self.count):
+            yield self.entry_at(pos)
+
+    def record_at(self, pos) -> memoryview:
+        return self.records[pos * RECORD.size : (pos + 1) * RECORD.size]
+
+    def path_at(self, pos) -> bytes:
+        start = pos * RECORD.size + RECORD_PATH_OFFSET
+        offset, length = struct.unpack_from(">IH", self.records, start)
+        return bytes(self.paths[offset : offset + length])
+
+    def mode_at(self, pos) -> int:
+        (mode,) = struct.unpack_from(">I", self.records, pos * RECORD.size + RECORD_MODE_OFFSET)
+        return mode
 
+    def sha_at(self, pos) -> bytes:
+        start = pos * RECORD.size + RECORD_SHA_OFFSET
+        return bytes(self.records[start : start + 20])
+
+    def entry_at(self, pos) -> IndexEntry:
+        return IndexEntry.deserialize(self.record_at(pos), self.path_at(pos).decode("utf-8"))
+
+    def bisect(self, path: bytes) -> int:
+        """
+        Position of the first entry whose path is not lower than path.
+        """
+        return bisect.bisect_left(range(self.count), path, key=self.path_at)
+
+    def find(self, path: bytes) -> int:
+        pos = self.bisect(path)
+        if pos < self.count and self.path_at(pos) == path:
+            return pos
+        return -1
+
+    def iter_prefix(self, prefix: bytes) -> Iterator[IndexEntry]:
+        """
+        Entries whose path starts with prefix, they are contiguous in the index.
+        """
+        pos = self.bisect(prefix)
+        while pos < self.count and self.path_at(pos).startswith(prefix):
+            yield self.entry_at(pos)
+            pos += 1
+
+    def is_tracked(self, path: str) -> bool:
+        """
+        Whether path has an entry, or for a directory ending with /, any entry below.
+        """
+        if path.endswith("/"):
+            pos = self.bisect(path.encode("utf-8"))
+            return pos < self.count and self.path_at(pos).startswith(path.encode("utf-8"))
+        return self.find(path.encode("utf-8")) >= 0
+
+    def get(self, path: str) -> Optional[IndexEntry]:
+        pos = self.find(path.encode("utf-8"))
+        return self.entry_at(pos) if pos >= 0 else None
+
+
+def get_index_path(repo: Optional[Repository] = None) -> str:
+    repository = repo or find_repository()
+    index_path = repository.build_path("index")
     assert index_path.startswith(repository.gitdir)
+    return index_path
+
+
+@contextmanager
+def open_index(verify=False, repo: Optional[Repository] = None) -> Iterator[IndexFile]:
+    """
+    mmap the index file. Records and paths are read from the mapping on demand.
+    """
+    index_path = get_index_path(repo)
     if not os.path.exists(index_path):
-        return entries
+        yield IndexFile()
+        return
 
     with open(index_path, "rb") as file:
-        # Instantiate IndexEntry objects
-        data: str = file.read().decode("ascii")
-        for line in data.splitlines():
-            # TODO: Use deserialize method's in IndexEntry
-            hash, path = line.split(" ")
-            entries.append(IndexEntry(path, hash))
+        st = os.fstat(file.fileno())
+        if st.st_size == 0:
+            yield IndexFile(mtime_ns=st.st_mtime_ns)
+            return
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:4] != INDEX_SIGNATURE:
+                # Text index of older versions, it is upgraded on the next write
+                entries = read_legacy_entries(data[:])
+                yield build_index_file(entries, mtime_ns=st.st_mtime_ns)
+                return
+
+            index = IndexFile(data, st.st_mtime_ns, verify=verify)
+            try:
+                yield index
+            finally:
+                # Release the views on the mapping, so it can be closed
+                index.records.release()
+                index.paths.release()
 
+
+def read_legacy_entries(data: bytes) -> List[IndexEntry]:
+    """
+    Read an index of older versions, one "{hash} {path}" per line.
+    """
+    entries = []
+    for line in data.decode("utf-8").splitlines():
+        hash, path = line.split(" ", 1)
+        entries.append(IndexEntry(path, hash))
     return entries
 
 
-def write_entries(entries: List[IndexEntry]):
-    entries = sorted(entries, key=lambda entry: entry.path)
+def read_entries(repo: Optional[Repository] = None) -> List[IndexEntry]:
+    with open_index(verify=True, repo=repo) as index:
+        return list(index)
+
+
+def read_extensions(repo: Optional[Repository] = None) -> Dict[bytes, bytes]:
+    with open_index(repo=repo) as index:
+        return index.extensions
+
+
+def build_index_file(entries: List[IndexEntry], mtime_ns=0) -> IndexFile:
+    return IndexFile(serialize_index(entries, {}), mtime_ns)
 
-    data = b""
+
+def serialize_index(entries: List[IndexEntry], extensions: Dict[bytes, bytes]) -> bytes:
+    entries = sorted(entries, key=lambda entry: entry.path.encode("utf-8"))
+
+    records = []
+    paths = []
+    offset = 0
     for entry in entries:
-        # TODO: Use serialize method's in IndexEntry
-        data += f"{entry.hash} {entry.path}\n".encode("ascii")
+        path = entry.path.encode("utf-8")
+        records.append(entry.serialize(offset))
+        paths.append(path)
+        offset += len(path)
 
-    repository = find_repository()
-    index_path = repository.build_path("index")
-    with open(index_path, "wb") as file:
+    return assemble_index(len(entries), b"".join(records), b"".join(paths), extensions)
+
+
+def assemble_index(count, records, paths, extensions: Dict[bytes, bytes]) -> bytes:
+    parts = [HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION, count, len(paths)), records, paths]
+    for signature, extension in sorted(extensions.items()):
+        parts.append(EXTENSION_HEADER.pack(signature, len(extension)))
+        parts.append(extension)
+
+    data = b"".join(parts)
+    return data + sha1(data).digest()
+
+
+def write_index(data: bytes, repo: Optional[Repository] = None):
+    """
+    Write a new file and rename it, readers never see a half written index.
+
+    Entries modified in the same timestamp tick as the file just written are racy, they
+    are smudged in it before it is renamed, as git does when it writes the index.
+    """
+    index_path = get_index_path(repo)
+    lock_path = index_path + ".lock"
+    with open(lock_path, "wb") as file:
         file.write(data)
+        file.flush()
+        mtime_ns = os.fstat(file.fileno()).st_mtime_ns
+
+        _, _, count, _ = HEADER.unpack_from(data)
+        records_end = HEADER.size + count * RECORD.size
+        records = bytearray(data[HEADER.size : records_end])
+        if smudge_racy_records(records, mtime_ns):
+            # A later mtime (the file is written again) keeps the others clean
+            body = b"".join([data[: HEADER.size], records, data[records_end:-CHECKSUM_SIZE]])
+            file.seek(0)
+            file.write(body + sha1(body).digest())
+    os.replace(lock_path, index_path)
+
+
+def write_entries(
+    entries: List[IndexEntry],
+    extensions: Optional[Dict[bytes, bytes]] = None,
+    repo: Optional[Repository] = None,
+):
+    """
+    Write the index with entries. The entries copied from the current index must be
+    smudged with smudge_racy_entries first.
+    """
+    write_index(serialize_index(entries, extensions or {}), repo)
+
+
+def update_entries(
+    entries: List[IndexEntry],
+    removed_paths: Optional[List[str]] = None,
+    extensions: Optional[Dict[bytes, bytes]] = None,
+    repo: Optional[Repository] = None,
+):
+    """
+    Add or replace entries in the index, and remove the entries of removed_paths.
+
+    The records of the current index are copied as they are between the changed
+    positions, new paths are appended to the paths section. Only the changes are
+    serialized, so adding a file to a big index costs a binary search plus a copy.
+    """
+    removed_paths = removed_paths or []
+    with open_index(repo=repo) as index:
+        if extensions is None:
+            changed_paths = [entry.path for entry in entries] + list(removed_paths)
+            extensions = invalidate_cache_tree(index.extensions, changed_paths)
+
+        if removed_paths or isinstance(index.data, bytes):
+            # Removing entries would leave unused bytes in the paths, so the index is
+            # rebuilt. A text or missing index is rebuilt too.
+            removed = set(removed_paths) | {entry.path for entry in entries}
+            kept = [entry for entry in index if entry.path not in removed]
+            smudge_racy_entries(kept, index.mtime_ns)
+            write_entries(kept + entries, extensions, repo)
+            return
+
+        changes = {entry.path.encode("utf-8"): entry for entry in entries}
+        records = []
+        paths = [index.paths]
+        paths_size = len(index.paths)
+        count = index.count
+        last = 0
+        for path in sorted(changes):
+            entry = changes[path]
+            pos = index.bisect(path)
+            records.append(copy_records(index, last, pos))
+            if pos < index.count and index.path_at(pos) == path:
+                # Replace the record, its path stays where it is
+                start = pos * RECORD.size + RECORD_PATH_OFFSET
+                (offset,) = struct.unpack_from(">I", index.records, start)
+                last = pos + 1
+            else:
+                offset = paths_size
+                paths.append(path)
+                paths_size += len(path)
+                count += 1
+                last = pos
+            records.append(entry.serialize(offset))
+        records.append(copy_records(index, last, index.count))
+        data = assemble_index(count, b"".join(records), b"".join(paths), extensions)
+
+    write_index(data, repo)
+
+
+def update_extensions(extensions: Dict[bytes, bytes], repo: Optional[Repository] = None):
+    """
+    Replace extensions of the index, the records are copied as they are.
+    """
+    with open_index(repo=repo) as index:
+        extensions = {**index.extensions, **extensions}
+        if isinstance(index.data, bytes):
+            entries = list(index)
+            smudge_racy_entries(entries, index.mtime_ns)
+            write_entries(entries, extensions, repo)
+            return
+
+        records = copy_records(index, 0, index.count)
+        data = assemble_index(index.count, records, bytes(index.paths), extensions)
+
+    write_index(data, repo)
+
+
+def smudge_racy_entries(entries: List[IndexEntry], index_mtime_ns: int):
+    """
+    Smudge the entries of an index that are racy compared with it. They haven't been
+    verified since it was read, in the new index they would look clean.
+    """
+    for entry in entries:
+        if entry.is_racy(index_mtime_ns):
+            entry.smudge()
+
+
+def copy_records(index: IndexFile, start: int, end: int) -> bytearray:
+    # Records from start to end, smudged as smudge_racy_entries does
+    records = bytearray(index.records[start * RECORD.size : end * RECORD.size])
+    smudge_racy_records(records, index.mtime_ns)
+    return records
+
+
+def smudge_racy_records(records: bytearray, index_mtime_ns: int) -> bool:
+    # Smudge the records modified at or after index_mtime_ns, True if there were some
+    smudged = False
+    for pos, (mtime_ns,) in enumerate(RECORD_MTIME.iter_unpack(records)):
+        if mtime_ns >= index_mtime_ns:
+            struct.pack_into(">Q", records, pos * RECORD.size + RECORD_MTIME_OFFSET, 0)
+            smudged = True
+    return smudged
+
+
+def invalidate_cache_tree(extensions: Dict[bytes, bytes], paths: List[str]) -> Dict[bytes, bytes]:
+    """
+    Extensions with the trees containing paths removed from the cache-tree.
+    """
+    if CACHE_TREE_SIGNATURE not in extensions:
+        return extensions
+
+    cache_tree = CacheTree.deserialize(extensions[CACHE_TREE_SIGNATURE])
+    cache_tree.invalidate(paths)
+    return {**extensions, CACHE_TREE_SIGNATURE: cache_tree.serialize()}
+
+
+def read_cache_tree(repo: Optional[Repository] = None) -> CacheTree:
+    extensions = read_extensions(repo)
+    if CACHE_TREE_SIGNATURE not in extensions:
+        return CacheTree()
+    return CacheTree.deserialize(extensions[CACHE_TREE_SIGNATURE])
 
 
-def parse_index_entries_to_dict(entires: List[IndexEntry]) -> dict:
-    """
-    Build a dict of directories and files from the entries in the index file.
-
-    .git/index
-    b729d9500ea4c046f88c4e5c084251ec2cbb64a7 A/B/1.txt
-    b729d9500ea4c046f88c4e5c084251ec2cbb6427 A/B/2.txt
-    b729d9500ea4c046f88c4e5c084151ec2cbb6427 A/5.txt
-    b08f7b08213644cd1609487a660a26cb3edc3813 A/B/3.txt
-    f79dfaa021b9972c4a56da87269684e9a73539b5 main.txt
-
-    {
-        "A": {
-            "5.txt": "b729d9500ea4c046f88c4e5c084151ec2cbb6427",
-            "B": {
-                "1.txt": "b729d9500ea4c046f88c4e5c084251ec2cbb64a7",
-                "2.txt": "b729d9500ea4c046f88c4e5c084251ec2cbb6427",
-                "3.txt": "b08f7b08213644cd1609487a660a26cb3edc3813"
-            }
-        },
-        "main.txt": "f79dfaa021b9972c4a56da87269684e9a73539b5"
-    }
-    """
-    dict = {}
-    for entry in entires:
-        path = entry.path
-        if "/" not in path:
-            dict[path] = entry.hash
-        else:
-            dirs = path.split("/")
-            parent = dict
-            for dir in dirs[:-1]:
-                if dir not in parent:
-                    parent[dir] = {}
-                parent = parent[dir]
-            parent[dirs[-1]] = entry.hash
-    return dict
+def write_cache_tree(cache_tree: CacheTree, repo: Optional[Repository] = None):
+    update_extensions({CACHE_TREE_SIGNATURE: cache_tree.serialize()}, repo)
@@ -1,11 +1,30 @@
+import os
 import sys
 
 from src.cli import commands
 
 
 def main(argv=sys.argv[1:]):
+    # Options before the command:
+    # --verbose prints what the command did on stderr
+    # --git-dir <path> uses the repository at path, like setting CALP_DIR
+    verbose = False
+    while argv and argv[0].startswith("-"):
+        option, argv = argv[0], argv[1:]
+        if option in ["-v", "--verbose"]:
+            verbose = True
+        elif option == "--git-dir" and argv:
+            os.environ["CALP_DIR"], argv = argv[0], argv[1:]
+        elif option.startswith("--git-dir="):
+            os.environ["CALP_DIR"] = option[len("--git-dir=") :]
+        else:
+            print(f"Unknown option: {option}")
+            return
+
     if len(argv) < 1:
-        print(f"Usage: calp <{'|'.join(commands.keys())}> [OPTIONS...]")
+        print(
+            f"Usage: calp [--verbose] [--git-dir <path>] <{'|'.join(commands.keys())}> [OPTIONS...]"
+        )
         return
 
     cmd = argv[0]
@@ -14,4 +33,9 @@ def main(argv=sys.argv[1:]):
     except KeyError:
         print(f"No such subcommand: {cmd}")
         return
-    return cmd_cls().run(argv[1:])
+    result = cmd_cls().run(argv[1:])
+    if verbose:
+        from src.stats import print_stats
+
+        print_stats()
+    return result
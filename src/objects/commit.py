@@ -1,5 +1,5 @@
 import collections
-from typing import List
+from typing import Dict, List, Optional, Tuple, Union
 
 from .base import BaseObject
 
@@ -25,12 +25,17 @@ class Commit(BaseObject):
 
     object_type = b"commit"
 
+    # Parsed on demand from data, see headers and commit_data
+    _headers = None
+    _commit_data = None
+
     def serialize(self):
-        if not self.commit_data:
-            return
+        if self._commit_data is None:
+            # Nothing was changed, the raw data is the serialization
+            return self.data
 
-        raw = b""
-        for key, value in self.commit_data.items():
+        chunks = []
+        for key, value in self._commit_data.items():
             if key == b"":
                 continue
 
@@ -38,57 +43,137 @@ class Commit(BaseObject):
                 value = [value]
 
             for v in value:
-                raw += key + b" " + v + b"\n"
+                chunks.append(key + b" " + v + b"\n")
 
-        raw += b"\n" + self.commit_data[b""]
-        return raw
+        chunks.append(b"\n" + self._commit_data[b""])
+        return b"".join(chunks)
 
     def deserialize(self, data):
-        self.commit_data = self.parse_commit(data)
-
-    def parse_commit(self, raw, start=0, commit_data=None):
-        """ """
-        if not commit_data:
-            commit_data = collections.OrderedDict()
-
-        space = raw.find(b" ", start)
-        new_line = raw.find(b"\n", start)
-
-        # If newline appears first (or there's no space at all, in which
-        # case find returns -1), we assume a blank line.  A blank line
-        # means the remainder of the data is the message.
-        if (space < 0) or (new_line < space):
-            commit_data[b""] = raw[start + 1 :]
-            return commit_data
-
-        key = raw[start:space]
-        end = start
-        while True:
-            end = raw.find(b"\n", end + 1)
-            if raw[end + 1] != ord(" "):
-                break
-
-        value = raw[space + 1 : end]
-
-        if key in commit_data:
-            if isinstance(commit_data[key], list):
-                commit_data[key].append(value)
-            else:
-                commit_data[key] = [commit_data[key], value]
+        # Only the raw data is kept, the fields are decoded when they are read
+        self.data = bytes(data)
+
+    @property
+    def headers(self) -> Tuple[List[Tuple[bytes, int, int]], int]:
+        """
+        (key, value start, value end) of each header line in data, and the offset of
+        the message.
+        """
+        if self._headers is None:
+            self._headers = parse_headers(self.data)
+        return self._headers
+
+    @property
+    def commit_data(self) -> Dict[bytes, Union[bytes, List[bytes]]]:
+        """
+        Headers by key, a list when a key is repeated, and the message under b"".
+        """
+        if self._commit_data is None:
+            headers, message_start = self.headers
+            commit_data: Dict[bytes, Union[bytes, List[bytes]]] = collections.OrderedDict()
+            for key, start, end in headers:
+                value = self.data[start:end]
+                if key not in commit_data:
+                    commit_data[key] = value
+                elif isinstance(commit_data[key], list):
+                    commit_data[key].append(value)  # type: ignore
+                else:
+                    commit_data[key] = [commit_data[key], value]  # type: ignore
+            commit_data[b""] = self.data[message_start:]
+            self._commit_data = commit_data
+        return self._commit_data
+
+    def get_header(self, key: bytes) -> Optional[bytes]:
+        """
+        Value of the first header line with key, None if there is none. The line is
+        searched in data, without parsing the other headers.
+        """
+        if self._commit_data is not None:
+            value = self._commit_data.get(key)
+            return value[0] if isinstance(value, list) else value
+
+        data = self.data
+        # Headers end at the first blank line, continuation lines start with a space
+        headers_end = data.find(b"\n\n")
+        if headers_end < 0:
+            headers_end = len(data)
+        if data.startswith(key + b" "):
+            start = 0
         else:
-            commit_data[key] = value
-        return self.parse_commit(raw, start=end + 1, commit_data=commit_data)
+            start = data.find(b"\n" + key + b" ", 0, headers_end) + 1
+            if start == 0:
+                return None
+
+        end = data.find(b"\n", start)
+        while 0 <= end < headers_end and data[end + 1] == 0x20:
+            end = data.find(b"\n", end + 1)
+        return data[start + len(key) + 1 : end if end >= 0 else len(data)]
 
     def get_message(self) -> str:
-        return self.commit_data[b""].decode("ascii")
+        if self._commit_data is not None:
+            return self._commit_data[b""].decode("ascii")
+        return self.data[self.headers[1] :].decode("ascii")
 
     def get_tree_hash(self) -> str:
-        return self.commit_data[b"tree"].decode("ascii")
+        if self._commit_data is not None:
+            return self._commit_data[b"tree"].decode("ascii")
+        return parse_commit_links(self.data)[0]
 
     def get_parents(self) -> List[str]:
-        # TODO: We asume that our commits only have one parent
-        # because we are not implementing merge commands
-        # So the len of the return list should be 1 or 0 (if it's the first commit)
-        parent = self.commit_data.get(b'parent',None)
-        return  [parent.decode('ascii')] if parent else []
-        #return [parent.decode("ascii") for parent in self.commit_data.get(b"parent", [])]
+        if self._commit_data is not None:
+            parents = self._commit_data.get(b"parent", [])
+            if not isinstance(parents, list):
+                parents = [parents]
+            return [parent.decode("ascii") for parent in parents]
+        return parse_commit_links(self.data)[1]
+
+    def get_commit_time(self) -> int:
+        # committer {name} <{email}> {seconds} {timezone}
+        return int(self.get_header(b"committer").rsplit(b" ", 2)[1])
+
+
+def parse_headers(data: bytes) -> Tuple[List[Tuple[bytes, int, int]], int]:
+    """
+    Offsets of the header lines of a commit, see Commit.headers. A value continues on
+    the next lines starting with a space (e.g. gpgsig).
+    """
+    headers = []
+    find = data.find
+    pos = 0
+    end = len(data)
+    while pos < end:
+        new_line = find(b"\n", pos)
+        if new_line < 0:
+            new_line = end
+        if new_line == pos:
+            # A blank line, the rest is the message
+            return headers, pos + 1
+
+        space = find(b" ", pos, new_line)
+        if space < 0:
+            raise Exception("Invalid commit header")
+        while new_line + 1 < end and data[new_line + 1] == 0x20:
+            new_line = find(b"\n", new_line + 1)
+            if new_line < 0:
+                new_line = end
+
+        headers.append((data[pos:space], space + 1, new_line))
+        pos = new_line + 1
+
+    return headers, end
+
+
+def parse_commit_links(data: bytes) -> Tuple[str, List[str]]:
+    """
+    Tree and parents of a commit, for graph walks. They are the first lines of every
+    commit, with fixed width, so the other headers and the message aren't read.
+    """
+    if not data.startswith(b"tree "):
+        raise Exception("Invalid commit, it must start with the tree")
+    tree = data[5:45].decode("ascii")
+
+    parents = []
+    pos = 46
+    while data.startswith(b"parent ", pos):
+        parents.append(data[pos + 7 : pos + 47].decode("ascii"))
+        pos += 48
+    return tree, parents
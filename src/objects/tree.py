@@ -2,14 +2,31 @@ from typing import List
 
 from .base import BaseObject
 
+# Mode of the subtrees, entries with any other mode are blobs
+TREE_MODE = b"40000"
+# Modes of the blobs: regular and executable files, symbolic links
+FILE_MODE = b"100644"
+EXECUTABLE_MODE = b"100755"
+SYMLINK_MODE = b"120000"
+
 
 class TreeLeaf:
     # Format: [mode] space [path] 0x00 [sha-1]
-    def __init__(self, mode, path, sha, length):
+    # Trees can have thousands of entries, slots keep them small
+    __slots__ = ("mode", "path", "raw_sha")
+
+    def __init__(self, mode: bytes, path: bytes, raw_sha: bytes):
         self.mode = mode
         self.path = path
-        self.sha = sha
-        self.length = length
+        self.raw_sha = raw_sha
+
+    @property
+    def sha(self) -> str:
+        # Converted on demand, comparisons can use raw_sha
+        return self.raw_sha.hex()
+
+    def is_tree(self) -> bool:
+        return self.mode == TREE_MODE
 
 
 class Tree(BaseObject):
@@ -32,55 +49,26 @@ class Tree(BaseObject):
         self.items = self.parse_tree(data)
 
     def serialize(self) -> bytes:
-        ret = b""
-        for item in self.items:
-            sha = int(item.sha, 16).to_bytes(20, byteorder="big")
-            raw = item.mode + b" " + item.path + b"\x00" + sha
-            ret += raw
-        return ret
-
-    def parse_tree(self, data) -> List[TreeLeaf]:
+        return b"".join(
+            b"%s %s\x00%s" % (item.mode, item.path, item.raw_sha) for item in self.items
+        )
+
+    def parse_tree(self, data: bytes) -> List[TreeLeaf]:
+        # The fields are sliced straight from data, between the offsets of the
+        # separators of each entry
+        items = []
+        find = data.find
         pos = 0
-        max = len(data)
-        ret = []
-        while pos < max:
-            # Find raw
-            end_of_raw = data.find(b"\x00", pos) + 20  # 20 is the length of sha-1
-            raw = data[pos : end_of_raw + 1]
-            leaf: TreeLeaf = parse_to_leaf(raw)
-            pos = end_of_raw + 1
-            ret.append(leaf)
-
-        return ret
-
-
-def parse_to_leaf(raw: bytes) -> TreeLeaf:
-    start = 0
-    # Find the space terminator of the mode
-    x = raw.find(b" ", start)
-    assert 5 <= x - start <= 6
-    # TODO: revisra el start
-    mode = raw[:x]
-
-    # Find the NULL terminator of the path
-    y = raw.find(b"\x00", x)
-    path = raw[x + 1 : y]
-
-    # Read the SHA and convert to an hex string
-    sha = raw[y + 1 :]
-    assert len(sha) == 20
-    parsed_sha1 = hex(int.from_bytes(sha, "big"))[2:]
-    if len(parsed_sha1) < 40:
-        """
-        The hex representation of a SHA-1 hash is 40 characters long.
-        If the hex representation is shorter than 40 characters, it is
-        left-padded with zeros.
-        e.g. If the original sha1 starts with 0x038.... then
-        parsed_sha1 starts with 38, so we have to add 0s to the left
-        """
-        parsed_sha1 = "0" * (40 - len(parsed_sha1)) + parsed_sha1
-
-    return TreeLeaf(mode, path, parsed_sha1, y + 21)
+        end = len(data)
+        while pos < end:
+            space = find(b" ", pos)
+            null = find(b"\x00", space)
+            if space < 0 or null < 0 or null + 21 > end:
+                raise Exception("Invalid tree object")
+            items.append(TreeLeaf(data[pos:space], data[space + 1 : null], data[null + 1 : null + 21]))
+            pos = null + 21
+
+        return items
 
 
 # recursive tree parsing
@@ -0,0 +1,652 @@
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from contextlib import suppress
+from hashlib import sha1
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from src.repository import Repository
+
+"""
+Packfiles store many objects in a single file, most of them as deltas against a similar
+object. Each pack has an index (.idx) to find objects by sha-1 without reading the pack.
+
+We use the same formats as Git:
+https://git-scm.com/docs/pack-format
+"""
+
+PACK_SIGNATURE = b"PACK"
+PACK_VERSION = 2
+IDX_SIGNATURE = b"\377tOc"
+IDX_VERSION = 2
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NUMBERS = {b"commit": OBJ_COMMIT, b"tree": OBJ_TREE, b"blob": OBJ_BLOB, b"tag": OBJ_TAG}
+TYPE_NAMES = {number: name for name, number in TYPE_NUMBERS.items()}
+
+# Number of previous objects tried as delta base
+DELTA_WINDOW = 10
+# Longest chain of deltas to rebuild an object
+DELTA_MAX_DEPTH = 50
+# Bigger objects are stored whole, computing their deltas is too slow
+DELTA_SIZE_LIMIT = 256 * 1024
+# Length of the blocks of the base indexed to find matches
+DELTA_BLOCK = 16
+# Positions of the target looked up at once when searching for a match
+DELTA_SCAN_CHUNK = 256
+# Bytes compared at once when extending a match
+DELTA_COMPARE_CHUNK = 256
+# Positions of the target sampled to give up early on a base sharing little with it
+DELTA_SAMPLES = 32
+# Longest copy instruction, same as Git
+DELTA_MAX_COPY = 0x10000
+# Bytes of the pack fed to zlib at once
+INFLATE_CHUNK = 16 * 1024
+
+
+def encode_varint(value: int) -> bytes:
+    # Little endian base 128, used in the header of the deltas
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_varint(data, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def index_delta_base(base: bytes) -> Dict[bytes, int]:
+    """
+    Offset of the first occurrence of every aligned block of base, built once for
+    all the targets compared with it.
+    """
+    blocks: Dict[bytes, int] = {}
+    for offset in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        blocks.setdefault(base[offset : offset + DELTA_BLOCK], offset)
+    return blocks
+
+
+def create_delta(
+    base: bytes,
+    target: bytes,
+    blocks: Optional[Dict[bytes, int]] = None,
+    max_size: Optional[int] = None,
+) -> Optional[bytes]:
+    """
+    Build the instructions to rebuild target from base:
+    - copy: 1xxxxxxx {offset (up to 4 bytes)} {size (up to 3 bytes)}
+    - insert: 0xxxxxxx {xxxxxxx literal bytes}
+
+    blocks is the index of base. With max_size, returns None as soon as the delta
+    can't be smaller than max_size: a base sharing little with target is given up
+    without scanning all of it.
+    """
+    if blocks is None:
+        blocks = index_delta_base(base)
+    if max_size is not None and not _shares_enough(blocks, target, max_size):
+        return None
+    out = [encode_varint(len(base)), encode_varint(len(target))]
+    # Size of out, without the pending literal bytes
+    size = len(out[0]) + len(out[1])
+
+    literal_start = 0
+    pos = 0
+    end = len(target)
+    while pos + DELTA_BLOCK <= end:
+        if max_size is not None and size + pos - literal_start >= max_size:
+            return None
+
+        # Look the blocks starting at the next positions up at once, in C
+        stop = min(pos + DELTA_SCAN_CHUNK, end - DELTA_BLOCK + 1)
+        starts = range(pos, stop)
+        candidates = map(target.__getitem__, map(slice, starts, range(pos + DELTA_BLOCK, end)))
+        hits = list(map(blocks.__contains__, candidates))
+        if True not in hits:
+            pos = stop
+            continue
+        pos += hits.index(True)
+        offset = blocks[target[pos : pos + DELTA_BLOCK]]
+
+        # Blocks of the base are aligned, the match can start before the block
+        start = pos
+        while start > literal_start and offset > 0 and target[start - 1] == base[offset - 1]:
+            start -= 1
+            offset -= 1
+        length = _match_length(base, offset, target, start, pos + DELTA_BLOCK - start)
+
+        literal = _delta_insert(target[literal_start:start])
+        copy = _delta_copy(offset, length)
+        out.append(literal)
+        out.append(copy)
+        size += len(literal) + len(copy)
+        pos = start + length
+        literal_start = pos
+
+    out.append(_delta_insert(target[literal_start:]))
+    delta = b"".join(out)
+    if max_size is not None and len(delta) >= max_size:
+        return None
+    return delta
+
+
+def _shares_enough(blocks: Dict[bytes, int], target: bytes, max_size: int) -> bool:
+    """
+    Whether enough of target could be copied from the base for a delta smaller than
+    max_size, from a few sampled positions: a match covering a position contains a
+    block of the base starting less than DELTA_BLOCK bytes after it.
+    """
+    end = len(target) - 2 * DELTA_BLOCK
+    if end < DELTA_SAMPLES * DELTA_BLOCK * 4:
+        # Scanning it is as fast
+        return True
+
+    hits = 0
+    for i in range(DELTA_SAMPLES):
+        pos = end * i // DELTA_SAMPLES
+        starts = range(pos, pos + DELTA_BLOCK)
+        stops = range(pos + DELTA_BLOCK, pos + 2 * DELTA_BLOCK)
+        candidates = map(target.__getitem__, map(slice, starts, stops))
+        if any(map(blocks.__contains__, candidates)):
+            hits += 1
+    # At least len(target) - max_size bytes are copied, half as many samples are
+    # expected to hit to leave room for the ones at the edges of the matches
+    return hits * len(target) * 2 >= (len(target) - max_size) * DELTA_SAMPLES
+
+
+def _match_length(base: bytes, offset: int, target: bytes, pos: int, length: int) -> int:
+    # Extend a match of length bytes as far as possible, comparing chunks then halving
+    # the chunk that differs
+    def same(start, size):
+        base_start, target_start = offset + start, pos + start
+        return base[base_start : base_start + size] == target[target_start : target_start + size]
+
+    limit = min(len(base) - offset, len(target) - pos)
+    while length < limit:
+        chunk = min(DELTA_COMPARE_CHUNK, limit - length)
+        if same(length, chunk):
+            length += chunk
+            continue
+        while chunk > 1:
+            half = chunk // 2
+            if same(length, half):
+                length += half
+                chunk -= half
+            else:
+                chunk = half
+        return length
+    return length
+
+
+def _delta_insert(data: bytes) -> bytes:
+    out = []
+    for start in range(0, len(data), 0x7F):
+        chunk = data[start : start + 0x7F]
+        out.append(bytes([len(chunk)]) + chunk)
+    return b"".join(out)
+
+
+def _delta_copy(offset: int, length: int) -> bytes:
+    out = []
+    while length:
+        size = min(length, DELTA_MAX_COPY)
+        op = 0x80
+        args = bytearray()
+        for i in range(4):
+            byte = (offset >> (i * 8)) & 0xFF
+            if byte:
+                op |= 1 << i
+                args.append(byte)
+        # A size of 0x10000 is encoded as 0
+        for i in range(3):
+            byte = (size >> (i * 8)) & 0xFF if size != DELTA_MAX_COPY else 0
+            if byte:
+                op |= 1 << (4 + i)
+                args.append(byte)
+        out.append(bytes([op]) + args)
+        offset += size
+        length -= size
+    return b"".join(out)
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    base_size, pos = decode_varint(delta, 0)
+    if base_size != len(base):
+        raise Exception("Invalid delta: bad base length")
+    target_size, pos = decode_varint(delta, pos)
+
+    out = []
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (i * 8)
+                    pos += 1
+            for i in range(3):
+                if op & (1 << (4 + i)):
+                    size |= delta[pos] << (i * 8)
+                    pos += 1
+            out.append(base[offset : offset + (size or DELTA_MAX_COPY)])
+        elif op:
+            out.append(delta[pos : pos + op])
+            pos += op
+        else:
+            raise Exception("Invalid delta: unexpected opcode 0")
+
+    target = b"".join(out)
+    if len(target) != target_size:
+        raise Exception("Invalid delta: bad target length")
+    return target
+
+
+def encode_entry_header(type_number: int, size: int) -> bytes:
+    # {type (3 bits)} {size (4 bits)}, then the rest of the size in base 128
+    out = bytearray()
+    byte = (type_number << 4) | (size & 0x0F)
+    size >>= 4
+    while size:
+        out.append(byte | 0x80)
+        byte = size & 0x7F
+        size >>= 7
+    out.append(byte)
+    return bytes(out)
+
+
+def decode_entry_header(data, pos: int) -> Tuple[int, int, int]:
+    byte = data[pos]
+    pos += 1
+    type_number = (byte >> 4) & 0x07
+    size = byte & 0x0F
+    shift = 4
+    while byte & 0x80:
+        byte = data[pos]
+        pos += 1
+        size |= (byte & 0x7F) << shift
+        shift += 7
+    return type_number, size, pos
+
+
+def encode_ofs_offset(offset: int) -> bytes:
+    # Big endian base 128, adding 1 to every byte but the last one
+    out = bytearray([offset & 0x7F])
+    offset >>= 7
+    while offset:
+        offset -= 1
+        out.append(0x80 | (offset & 0x7F))
+        offset >>= 7
+    return bytes(reversed(out))
+
+
+def decode_ofs_offset(data, pos: int) -> Tuple[int, int]:
+    byte = data[pos]
+    pos += 1
+    offset = byte & 0x7F
+    while byte & 0x80:
+        byte = data[pos]
+        pos += 1
+        offset = ((offset + 1) << 7) | (byte & 0x7F)
+    return offset, pos
+
+
+def inflate(data, pos: int) -> bytes:
+    # Feed the stream by chunks, slicing the rest of the mmapped pack would copy it
+    decompressor = zlib.decompressobj()
+    out = []
+    while not decompressor.eof:
+        chunk = data[pos : pos + INFLATE_CHUNK]
+        if not chunk:
+            raise Exception("Invalid pack: truncated object")
+        out.append(decompressor.decompress(chunk))
+        pos += len(chunk)
+    return b"".join(out)
+
+
+def inflate_prefix(data, pos: int, length: int) -> bytes:
+    """
+    Inflate the first length bytes of the stream at pos, or all of it if shorter.
+    """
+    decompressor = zlib.decompressobj()
+    out = b""
+    while len(out) < length and not decompressor.eof:
+        chunk = decompressor.unconsumed_tail
+        if not chunk:
+            chunk = data[pos : pos + INFLATE_CHUNK]
+            if not chunk:
+                raise Exception("Invalid pack: truncated object")
+            pos += len(chunk)
+        out += decompressor.decompress(chunk, length - len(out))
+    return out
+
+
+class Pack:
+    """
+    A packfile and its index, both mmapped.
+    """
+
+    def __init__(self, idx_path: str):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[: -len(".idx")] + ".pack"
+
+        with open(self.idx_path, "rb") as file:
+            self.idx = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.pack_path, "rb") as file:
+            self.pack = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version = struct.unpack_from(">4sI", self.idx)
+        if signature != IDX_SIGNATURE or version != IDX_VERSION:
+            raise Exception(f"Invalid pack index {idx_path}")
+
+        self.fanout = struct.unpack_from(">256I", self.idx, 8)
+        self.count = self.fanout[255]
+        self.shas_start = 8 + 256 * 4
+        self.crcs_start = self.shas_start + self.count * 20
+        self.offsets_start = self.crcs_start + self.count * 4
+        self.large_offsets_start = self.offsets_start + self.count * 4
+
+    def __len__(self):
+        return self.count
+
+    def sha_at(self, pos: int) -> bytes:
+        start = self.shas_start + pos * 20
+        return self.idx[start : start + 20]
+
+    def find(self, sha: bytes) -> int:
+        """
+        Position of sha in the index, or -1. The fanout table gives the range of the
+        shas starting with the same byte, then it is a binary search.
+        """
+        low = self.fanout[sha[0] - 1] if sha[0] else 0
+        high = self.fanout[sha[0]]
+        while low < high:
+            mid = (low + high) // 2
+            mid_sha = self.sha_at(mid)
+            if mid_sha < sha:
+                low = mid + 1
+            elif mid_sha > sha:
+                high = mid
+            else:
+                return mid
+        return -1
+
+    def offset_at(self, pos: int) -> int:
+        (offset,) = struct.unpack_from(">I", self.idx, self.offsets_start + pos * 4)
+        if offset & 0x80000000:
+            large = self.large_offsets_start + (offset & 0x7FFFFFFF) * 8
+            (offset,) = struct.unpack_from(">Q", self.idx, large)
+        return offset
+
+    def offset_of(self, sha: str) -> Optional[int]:
+        pos = self.find(bytes.fromhex(sha))
+        return self.offset_at(pos) if pos >= 0 else None
+
+    def __contains__(self, sha: str) -> bool:
+        return self.find(bytes.fromhex(sha)) >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        for pos in range(self.count):
+            yield self.sha_at(pos).hex()
+
+    def read_at(self, offset: int, repo: Repository) -> Tuple[bytes, bytes]:
+        """
+        Read the object at offset as (type, data), applying deltas.
+        """
+        deltas = []
+        # Follow the chain of deltas down to a whole object
+        while True:
+            type_number, _, pos = decode_entry_header(self.pack, offset)
+            if type_number == OBJ_OFS_DELTA:
+                distance, pos = decode_ofs_offset(self.pack, pos)
+                deltas.append(inflate(self.pack, pos))
+                offset -= distance
+            elif type_number == OBJ_REF_DELTA:
+                base_sha = self.pack[pos : pos + 20].hex()
+                deltas.append(inflate(self.pack, pos + 20))
+                base_offset = self.offset_of(base_sha)
+                if base_offset is None:
+                    # The base is stored somewhere else in the repository
+                    from src.algorithms import read_object_data
+
+                    type_name, data = read_object_data(repo, base_sha)
+                    break
+                offset = base_offset
+            else:
+                type_name = TYPE_NAMES[type_number]
+                data = inflate(self.pack, pos)
+                break
+
+        for delta in reversed(deltas):
+            data = apply_delta(data, delta)
+        return type_name, data
+
+    def read_header_at(self, offset: int, repo: Repository) -> Tuple[bytes, int]:
+        """
+        Type and size of the object at offset, without rebuilding it. The size of a
+        delta's result is at the start of the delta, so only a few bytes are inflated.
+        The type is the one of the end of the chain.
+        """
+        type_number, size, pos = decode_entry_header(self.pack, offset)
+        if type_number == OBJ_OFS_DELTA:
+            distance, pos = decode_ofs_offset(self.pack, pos)
+            base_type, _ = self.read_header_at(offset - distance, repo)
+        elif type_number == OBJ_REF_DELTA:
+            base_sha = self.pack[pos : pos + 20].hex()
+            pos += 20
+            base_offset = self.offset_of(base_sha)
+            if base_offset is None:
+                from src.algorithms import read_object_header
+
+                base_type, _ = read_object_header(repo, base_sha)
+            else:
+                base_type, _ = self.read_header_at(base_offset, repo)
+        else:
+            return TYPE_NAMES[type_number], size
+
+        # {base size} {result size}, both varints of at most 10 bytes
+        delta_header = inflate_prefix(self.pack, pos, 20)
+        _, size_pos = decode_varint(delta_header, 0)
+        size, _ = decode_varint(delta_header, size_pos)
+        return base_type, size
+
+    def close(self):
+        self.idx.close()
+        self.pack.close()
+
+
+def get_pack_dir(repo: Repository) -> str:
+    return repo.build_path("objects", "pack")
+
+
+def get_packs(repo: Repository) -> List[Pack]:
+    """
+    Packs of the repository. They are loaded once, and again when a pack is added or
+    removed (the mtime of the pack directory changes).
+    """
+    pack_dir = get_pack_dir(repo)
+    try:
+        mtime_ns = os.stat(pack_dir).st_mtime_ns
+    except FileNotFoundError:
+        return []
+
+    cached = getattr(repo, "packs", None)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+
+    packs = [
+        Pack(os.path.join(pack_dir, name))
+        for name in sorted(os.listdir(pack_dir))
+        if name.endswith(".idx")
+    ]
+    repo.packs = (mtime_ns, packs)
+    return packs
+
+
+def find_packed_object(repo: Repository, sha: str) -> Optional[Tuple[Pack, int]]:
+    for pack in get_packs(repo):
+        offset = pack.offset_of(sha)
+        if offset is not None:
+            return pack, offset
+    return None
+
+
+def read_packed_object(repo: Repository, sha: str) -> Optional[Tuple[bytes, bytes]]:
+    found = find_packed_object(repo, sha)
+    if found is None:
+        return None
+    pack, offset = found
+    return pack.read_at(offset, repo)
+
+
+def read_packed_object_header(repo: Repository, sha: str) -> Optional[Tuple[bytes, int]]:
+    found = find_packed_object(repo, sha)
+    if found is None:
+        return None
+    pack, offset = found
+    return pack.read_header_at(offset, repo)
+
+
+def write_pack(
+    repo: Repository, objects: List[Tuple[str, bytes, int]], read_data: Callable[[str], bytes]
+) -> str:
+    """
+    Write the objects, as (sha, type, size), in a new pack and its index.
+    Returns the path of the pack.
+
+    Objects are sorted by type and size, then every object is compared with the
+    previous ones in a window and stored as a delta against the one giving the
+    smallest delta (OFS_DELTA: the base is earlier in the same pack).
+
+    The data of each object is read with read_data when it is written, only the
+    objects of the window are kept in memory.
+    """
+    objects = sorted(objects, key=lambda obj: (obj[1], -obj[2]))
+
+    entries = []  # [(sha, offset, crc)]
+    depths: Dict[str, int] = {}
+    offsets: Dict[str, int] = {}
+    # [(sha, type, data, index of the blocks of data)]
+    window: List[Tuple[str, bytes, bytes, Dict[bytes, int]]] = []
+
+    pack_dir = get_pack_dir(repo)
+    os.makedirs(pack_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix="tmp_pack_", dir=pack_dir)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            header = struct.pack(">4sII", PACK_SIGNATURE, PACK_VERSION, len(objects))
+            file.write(header)
+            pack_hash = sha1(header)
+            offset = len(header)
+            for sha, type_name, _ in objects:
+                data = read_data(sha)
+                best_base, best_delta = None, None
+                if len(data) <= DELTA_SIZE_LIMIT:
+                    # Not worth it unless the delta is at most half the object
+                    max_size = len(data) // 2
+                    for base_sha, base_type, base_data, blocks in window:
+                        if base_type != type_name or depths[base_sha] >= DELTA_MAX_DEPTH:
+                            continue
+                        # The bytes missing from the base are inserted
+                        if len(data) - len(base_data) >= max_size:
+                            continue
+                        delta = create_delta(base_data, data, blocks, max_size)
+                        if delta is not None:
+                            best_base, best_delta = base_sha, delta
+                            max_size = len(delta)
+
+                if best_base is not None:
+                    depths[sha] = depths[best_base] + 1
+                    raw = (
+                        encode_entry_header(OBJ_OFS_DELTA, len(best_delta))
+                        + encode_ofs_offset(offset - offsets[best_base])
+                        + zlib.compress(best_delta)
+                    )
+                else:
+                    depths[sha] = 0
+                    raw = encode_entry_header(TYPE_NUMBERS[type_name], len(data)) + zlib.compress(
+                        data
+                    )
+
+                entries.append((sha, offset, zlib.crc32(raw)))
+                offsets[sha] = offset
+                file.write(raw)
+                pack_hash.update(raw)
+                offset += len(raw)
+
+                if len(data) <= DELTA_SIZE_LIMIT:
+                    window.append((sha, type_name, data, index_delta_base(data)))
+                    window = window[-DELTA_WINDOW:]
+
+            pack_checksum = pack_hash.digest()
+            file.write(pack_checksum)
+
+        pack_path = os.path.join(pack_dir, f"pack-{pack_checksum.hex()}.pack")
+        os.replace(tmp_path, pack_path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+    # The index is written last, readers only look for packs with an index
+    _write_file(pack_path[: -len(".pack")] + ".idx", build_idx(entries, pack_checksum))
+    return pack_path
+
+
+def build_idx(entries: List[Tuple[str, int, int]], pack_checksum: bytes) -> bytes:
+    entries = sorted(entries)
+
+    fanout = [0] * 256
+    for sha, _, _ in entries:
+        fanout[int(sha[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    offsets = []
+    large_offsets = []
+    for _, offset, _ in entries:
+        if offset < 0x80000000:
+            offsets.append(offset)
+        else:
+            offsets.append(0x80000000 | len(large_offsets))
+            large_offsets.append(offset)
+
+    data = b"".join(
+        [
+            struct.pack(">4sI", IDX_SIGNATURE, IDX_VERSION),
+            struct.pack(">256I", *fanout),
+            b"".join(bytes.fromhex(sha) for sha, _, _ in entries),
+            struct.pack(f">{len(entries)}I", *(crc for _, _, crc in entries)),
+            struct.pack(f">{len(offsets)}I", *offsets),
+            struct.pack(f">{len(large_offsets)}Q", *large_offsets),
+            pack_checksum,
+        ]
+    )
+    return data + sha1(data).digest()
+
+
+def _write_file(path: str, data: bytes):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
@@ -1,27 +1,76 @@
 import os
+import stat
+import tempfile
+import threading
 import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from datetime import date
 from hashlib import sha1
-from typing import List
-
-from src.algorithms import (find_object, get_files_rec, object_class,
-                            read_object)
-from src.index import (IndexEntry, parse_index_entries_to_dict, read_entries,
-                       write_entries)
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from src import commit_graph
+from src.algorithms import (diff_trees, find_object, get_loose_objects,
+                            iter_tree, object_class, object_exists,
+                            read_object, read_object_data, read_object_header,
+                            walk_commits)
+from src.cache_tree import CacheTree
+from src.index import (IndexEntry, IndexFile, open_index, read_cache_tree,
+                       update_entries, write_cache_tree, write_entries)
 from src.objects.base import is_sha1
-from src.repository import find_repository
+from src.pack import get_packs, write_pack
+from src.repository import Repository, find_repository
+from src.stats import count
+from src.transaction import (FSYNC_NONE, ObjectTransaction, get_fsync_mode,
+                             object_transaction, sync_files)
 
 from .objects.blob import Blob
 from .objects.commit import Commit
-from .objects.tree import Tree
+from .objects.tree import (EXECUTABLE_MODE, FILE_MODE, SYMLINK_MODE, TREE_MODE,
+                           Tree)
+
+# Bytes of a file hashed and compressed at once
+STREAM_CHUNK = 1024 * 1024
+# Bytes of blobs read and not written yet by the threads of checkout_files
+CHECKOUT_BUFFER = 64 * 1024 * 1024
+# Files written by a task of checkout_files
+CHECKOUT_BATCH = 64
+
+
+def create_object_tempfile(repo):
+    """
+    Objects are written to a temporary file in objects/, then renamed to their final
+    path, so a reader never sees a partially written object.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix="tmp_obj_", dir=repo.build_path("objects"))
+    return os.fdopen(fd, "wb"), tmp_path
 
 
-def hash_object_data(object_type, data, write) -> str:
+def move_object_tempfile(repo, tmp_path, sha) -> bool:
+    """
+    Store the temporary file as the object sha. False when another thread stored it
+    first, the temporary file is removed.
+    """
+    # Objects are immutable
+    os.chmod(tmp_path, 0o444)
+    transaction = repo.object_transaction
+    if transaction is None:
+        # A transaction of its own, not set on the repository: the threads of add can
+        # write objects outside of a transaction at the same time
+        transaction = ObjectTransaction(repo)
+        stored = transaction.stage(tmp_path, sha)
+        transaction.commit()
+    else:
+        stored = transaction.stage(tmp_path, sha)
+    count("objects written" if stored else "object writes avoided")
+    return stored
+
+
+def hash_object_data(object_type, data, write, repo: Optional[Repository] = None) -> str:
     """
     Auxiliar function to compute object ID and optionally creates a blob from a file,
     used in hash_object command.
     """
-    repo = None
     object_type = object_type.encode("ascii")
 
     obj_class = object_class(object_type)
@@ -34,68 +83,338 @@ def hash_object_data(object_type, data, write) -> str:
     assert len(sha) == 40
 
     if write:
-        repo = find_repository()
-        path = repo.create_dir("objects", sha[0:2])
-        with open(f"{path}/{sha[2:]}", "wb") as file:
+        repo = repo or find_repository()
+        if object_exists(repo, sha):
+            # Objects are immutable, it is already there
+            count("object writes avoided")
+            return sha
+
+        file, tmp_path = create_object_tempfile(repo)
+        with file:
             file.write(zlib.compress(full_data))
+        move_object_tempfile(repo, tmp_path, sha)
     return sha
 
 
-def hash_object(object_type, path=None, data=None, write=True) -> str:
+def stream_object(file, header: bytes, size: int, output=None) -> str:
+    """
+    Compute the object ID of the content of file, read by chunks. With output, the
+    object is also compressed into it.
+    """
+    hash = sha1(header)
+    if output is not None:
+        compressor = zlib.compressobj()
+        output.write(compressor.compress(header))
+
+    buffer = memoryview(bytearray(STREAM_CHUNK))
+    read = 0
+    while True:
+        length = file.readinto(buffer)
+        if not length:
+            break
+        read += length
+        hash.update(buffer[:length])
+        if output is not None:
+            output.write(compressor.compress(buffer[:length]))
+
+    if read != size:
+        raise Exception(f"{file.name} changed while hashing it")
+
+    if output is not None:
+        output.write(compressor.flush())
+    return hash.hexdigest()
+
+
+def write_blob_file(path, repo: Optional[Repository] = None) -> str:
+    """
+    Write a file as a blob, hashed and compressed in one pass: the file is read once.
+    The compressed object is dropped when it turns out to be stored already.
+    """
+    repo = repo or find_repository()
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        header = b"blob " + str(size).encode("ascii") + b"\0"
+        output, tmp_path = create_object_tempfile(repo)
+        try:
+            with output:
+                sha = stream_object(file, header, size, output)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    if object_exists(repo, sha):
+        os.remove(tmp_path)
+        count("object writes avoided")
+    else:
+        move_object_tempfile(repo, tmp_path, sha)
+    return sha
+
+
+def hash_object_file(path, write, repo: Optional[Repository] = None) -> str:
+    """
+    Compute the object ID of a file as a blob, and optionally write it.
+
+    The file is read once. Small files are kept in memory and only compressed when
+    the object is not stored yet. Bigger ones are read by chunks, so the memory used
+    doesn't depend on the size of the file, and compressed while they are hashed.
+    """
+    if write and os.path.getsize(path) > STREAM_CHUNK:
+        return write_blob_file(path, repo)
+
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size <= STREAM_CHUNK:
+            data = file.read()
+            if len(data) != size:
+                raise Exception(f"{path} changed while hashing it")
+            return hash_object_data("blob", data, write, repo)
+
+        header = b"blob " + str(size).encode("ascii") + b"\0"
+        return stream_object(file, header, size)
+
+
+def hash_object(
+    object_type, path=None, data=None, write=True, repo: Optional[Repository] = None
+) -> str:
     """
     Compute object ID and optionally creates a blob from a file.
     https://git-scm.com/docs/git-hash-object
     """
-    if object_type == "blob":
-        with open(path, "rb") as file:  # type: ignore
-            data = file.read()
-            hash = hash_object_data(object_type, data, write)
-            return hash
+    if object_type == "blob" and path is not None:
+        return hash_object_file(path, write, repo)
     else:
-        return hash_object_data(object_type, data, write)
+        return hash_object_data(object_type, data, write, repo)
 
 
-def cat_file(object_type, object) -> str:
+def cat_file(object_type, object, repo: Optional[Repository] = None) -> bytes:
     """
     Provides the content of an object in the repository.
     https://git-scm.com/docs/git-cat-file
     """
-    repo = find_repository()
+    repo = repo or find_repository()
     obj = read_object(repo, find_object(repo, object, object_type=object_type))
-    res: bytes = obj.serialize()
-    return res.decode("ascii")
+    return obj.serialize()
+
 
+def cat_file_header(object, repo: Optional[Repository] = None) -> Tuple[str, int]:
+    """
+    Provides the type and the size of an object, without reading its content.
+    https://git-scm.com/docs/git-cat-file
+    """
+    repo = repo or find_repository()
+    object_type, size = read_object_header(repo, find_object(repo, object))
+    return object_type.decode("ascii"), size
 
-def ls_tree(tree_ish) -> List:
+
+def cat_file_batch_check(lines: Iterable[str], repo: Optional[Repository] = None) -> Iterator[str]:
+    """
+    "{sha} {type} {size}" for every object name in lines, "{name} missing" when
+    there is no such object.
+    """
+    repo = repo or find_repository()
+    for line in lines:
+        name = line.strip()
+        if not is_sha1(name):
+            yield f"{name} missing"
+            continue
+        try:
+            object_type, size = cat_file_header(name, repo)
+        except FileNotFoundError:
+            yield f"{name} missing"
+        else:
+            yield f"{name} {object_type} {size}"
+
+
+def cat_file_batch(lines: Iterable[str], repo: Optional[Repository] = None) -> Iterator[bytes]:
+    """
+    "{sha} {type} {size}\n{content}\n" for every object name in lines, read as they
+    come, "{name} missing\n" when there is no such object. The repository, its object
+    caches and pack maps stay open for the whole stream.
+    """
+    repo = repo or find_repository()
+    for line in lines:
+        name = line.strip()
+        if not is_sha1(name):
+            yield name.encode("utf-8") + b" missing\n"
+            continue
+        try:
+            object_type, data = read_object_data(repo, find_object(repo, name))
+        except FileNotFoundError:
+            yield name.encode("utf-8") + b" missing\n"
+        else:
+            header = b"%s %s %d\n" % (name.encode("ascii"), object_type, len(data))
+            yield b"".join([header, data, b"\n"])
+
+
+def ls_tree(tree_ish, repo: Optional[Repository] = None) -> List:
     """
     List the contents of a tree object.
     https://git-scm.com/docs/git-ls-tree
     """
-    repo = find_repository()
+    repo = repo or find_repository()
     object_ref = find_object(repo, tree_ish, object_type=b"tree")
     obj: Tree = read_object(repo, object_ref)
 
     items = []
     for item in obj.items:
         mode = "0" * (6 - len(item.mode)) + item.mode.decode("ascii")
-        type = read_object(repo, item.sha).object_type.decode("ascii")
+        # The mode tells the type, the object doesn't need to be read
+        type = "tree" if item.is_tree() else "blob"
         items.append((mode, type, item.sha, item.path.decode("ascii")))
 
     return items
 
 
-def write_tree() -> str:
+def repack(all_objects=False, delete=False, repo: Optional[Repository] = None) -> Optional[str]:
+    """
+    Pack the loose objects into a new pack. With all_objects, the objects of the
+    existing packs are packed too. With delete, the loose objects and packs made
+    redundant by the new pack are removed.
+
+    Returns the path of the new pack, None if there was nothing to pack.
+    https://git-scm.com/docs/git-repack
+    """
+    repo = repo or find_repository()
+    loose_objects = get_loose_objects(repo)
+    old_packs = get_packs(repo) if all_objects else []
+
+    shas = set(loose_objects)
+    for pack in old_packs:
+        shas.update(pack)
+    if not shas:
+        return None
+
+    # Only the type and size are read first, write_pack reads the data of each
+    # object when it writes it
+    objects = [(sha, *read_object_header(repo, sha)) for sha in sorted(shas)]
+    pack_path = write_pack(repo, objects, lambda sha: read_object_data(repo, sha)[1])
+
+    if delete:
+        if get_fsync_mode(repo) != FSYNC_NONE:
+            # The pack is on disk before the objects it replaces are removed
+            idx_path = pack_path[: -len(".pack")] + ".idx"
+            sync_files(os.path.dirname(pack_path), [pack_path, idx_path])
+
+        for pack in old_packs:
+            # Packing the same objects again gives the same pack
+            if pack.pack_path != pack_path:
+                pack.close()
+                os.remove(pack.idx_path)
+                os.remove(pack.pack_path)
+
+        for sha in loose_objects:
+            os.remove(repo.build_path("objects", sha[0:2], sha[2:]))
+        for sha in {sha[0:2] for sha in loose_objects}:
+            with suppress(OSError):
+                os.rmdir(repo.build_path("objects", sha))
+
+    return pack_path
+
+
+def write_commit_graph(repo: Optional[Repository] = None) -> Optional[str]:
+    """
+    Write the commit-graph of the commits reachable from the branches and HEAD.
+    Returns its path, None if there are no commits.
+
+    https://git-scm.com/docs/git-commit-graph
+    """
+    repo = repo or find_repository()
+    heads = [get_reference(f"refs/heads/{branch}", repo) for branch in get_branches(repo)]
+    heads.append(get_reference("HEAD", repo))
+    heads = [head for head in heads if head]
+    if not heads:
+        return None
+
+    commits = {}
+    for sha in walk_commits(repo, heads):
+        commit = read_object(repo, sha)
+        commits[sha] = (commit.get_tree_hash(), commit.get_parents(), commit.get_commit_time())
+    return commit_graph.write_commit_graph(repo, commits)
+
+
+def get_branches(repo: Optional[Repository] = None) -> List[str]:
+    repo = repo or find_repository()
+    return sorted(os.listdir(repo.build_path("refs", "heads")))
+
+
+def write_tree(repo: Optional[Repository] = None) -> str:
     """
     Create recursively a tree object from the index
     https://git-scm.com/docs/git-write-tree
+
+    Trees of the directories recorded in the cache-tree are reused, only the
+    directories containing changed entries are serialized and hashed again.
     """
-    entries = read_entries()
-    parsed_entries = parse_index_entries_to_dict(entries)
-    sha = hash_tree_recursive(parsed_entries)
+    repo = repo or find_repository()
+    cache_tree = read_cache_tree(repo)
+    new_cache_tree = CacheTree()
+    with object_transaction(repo) as transaction:
+        with open_index(repo=repo) as index:
+            sha, _ = build_tree(index, 0, b"", cache_tree, new_cache_tree, repo)
+
+        if new_cache_tree != cache_tree:
+            # The cache-tree must only name trees that are on disk
+            transaction.after_commit(lambda: write_cache_tree(new_cache_tree, repo))
     return sha
 
 
-def commit_tree(tree_sha, message):
+def build_tree(
+    index: IndexFile,
+    start: int,
+    prefix: bytes,
+    cache_tree: CacheTree,
+    new_cache_tree: CacheTree,
+    repo: Repository,
+) -> Tuple[str, int]:
+    """
+    Create the tree of the directory prefix, whose entries start at position start
+    of the index (entries of a directory are contiguous, as they are sorted by path).
+
+    Returns the SHA-1 of the tree and the position of the first entry after it.
+    """
+    directory = prefix[:-1].decode("utf-8")
+    cached = cache_tree.get(directory)
+    if cached is not None:
+        entry_count, sha = cached
+        end = start + entry_count
+        # The cached count must cover exactly the entries of the directory
+        if (
+            entry_count > 0
+            and end <= len(index)
+            and index.path_at(end - 1).startswith(prefix)
+            and (end == len(index) or not index.path_at(end).startswith(prefix))
+        ):
+            new_cache_tree.set(directory, entry_count, sha)
+            return sha, end
+
+    items = []
+    pos = start
+    while pos < len(index):
+        path = index.path_at(pos)
+        if not path.startswith(prefix):
+            break
+
+        name = path[len(prefix) :]
+        slash = name.find(b"/")
+        if slash >= 0:
+            # Is a directory
+            name = name[:slash]
+            sha_child, pos = build_tree(
+                index, pos, prefix + name + b"/", cache_tree, new_cache_tree, repo
+            )
+            items.append(TREE_MODE + b" " + name + b"\x00" + bytes.fromhex(sha_child))
+        else:
+            # Is a file
+            mode = EXECUTABLE_MODE if index.mode_at(pos) & stat.S_IXUSR else FILE_MODE
+            items.append(mode + b" " + name + b"\x00" + index.sha_at(pos))
+            pos += 1
+
+    sha = hash_object("tree", data=b"".join(items), write=True, repo=repo)
+    new_cache_tree.set(directory, pos - start, sha)
+    return sha, pos
+
+
+def commit_tree(tree_sha, message, repo: Optional[Repository] = None):
     """
     Create a new commit object
 
@@ -105,26 +424,26 @@ def commit_tree(tree_sha, message):
 
     https://git-scm.com/docs/git-commit-tree
     """
-    parent = get_reference("HEAD")
+    repo = repo or find_repository()
+    parent = get_reference("HEAD", repo)
 
     if parent:
-        repo = find_repository()
         current_commit = read_object(repo, parent)
         data = current_commit.commit_data
         if data[b"tree"] == tree_sha.encode("ascii"):
             print("Nothing to commit")
             raise SystemExit(1)
-        commit_sha1 = write_commit(tree_sha, message, [parent])
+        commit_sha1 = write_commit(tree_sha, message, [parent], repo)
     else:
-        commit_sha1 = write_commit(tree_sha, message)
+        commit_sha1 = write_commit(tree_sha, message, repo=repo)
     return commit_sha1
 
 
-def update_index(entries: List[IndexEntry]):
-    write_entries(entries)
+def update_index(entries: List[IndexEntry], repo: Optional[Repository] = None):
+    write_entries(entries, repo=repo)
 
 
-def write_commit(tree_sha, message, parents=[]):
+def write_commit(tree_sha, message, parents=[], repo: Optional[Repository] = None):
     data = b"tree " + tree_sha.encode("ascii") + b"\n"
     for parent in parents:
         data += b"parent " + parent.encode("ascii") + b"\n"
@@ -149,65 +468,31 @@ def write_commit(tree_sha, message, parents=[]):
     assert len(message) > 0
     data += b"\n" + message.encode("ascii")
 
-    commit_sha1 = hash_object("commit", data=data, write=True)
+    commit_sha1 = hash_object("commit", data=data, write=True, repo=repo)
     return commit_sha1
 
 
-def hash_tree_recursive(entries: dict) -> str:
-    """
-    Create a tree object from a dict of entries.
-
-    e.g. of entries:
-    {
-        "A": {
-            "5.txt": "b729d9500ea4c046f88c4e5c084151ec2cbb6427",
-            "B": {
-                "1.txt": "b729d9500ea4c046f88c4e5c084251ec2cbb64a7",
-                "2.txt": "b729d9500ea4c046f88c4e5c084251ec2cbb6427",
-                "3.txt": "b08f7b08213644cd1609487a660a26cb3edc3813"
-            }
-        },
-        "main.txt": "f79dfaa021b9972c4a56da87269684e9a73539b5"
-    }
-    """
-    data = b""
-    for entry, item in entries.items():
-        if isinstance(item, dict):
-            # Is a directory
-            sha_child = hash_tree_recursive(item)
-            mode = b"40000"
-            path = entry.encode("ascii")
-            data += mode + b" " + path + b"\x00" + bytes.fromhex(sha_child)
-        else:
-            # Is a file
-            data += (
-                b"100644" + b" " + entry.encode("ascii") + b"\x00" + bytes.fromhex(item)
-            )
-    sha = hash_object("tree", data=data, write=True)
-    return sha
-
-
-def read_file(path):
-    repo = find_repository()
+def read_file(path, repo: Optional[Repository] = None):
+    repo = repo or find_repository()
     with open(repo.build_path(path), "r") as file:
         return file.read()
 
 
-def get_current_branch() -> str:
+def get_current_branch(repo: Optional[Repository] = None) -> str:
     # TODO: handle when HEAD is pointing to an specific
     # commit sha1
-    head_ref = read_file("HEAD")    # ref: /refs/heads/master
+    head_ref = read_file("HEAD", repo)    # ref: /refs/heads/master
     return head_ref.split("/")[-1].strip()  # /refs/heads/master
 
 
-def get_reference(ref) -> str:
+def get_reference(ref, repo: Optional[Repository] = None) -> str:
     """image.png
     Get the commit SHA.
 
     Args:
         ref: HEAD or refs/heads/*
     """
-    repo = find_repository()
+    repo = repo or find_repository()
     path = repo.build_path(*ref.split("/"))
     if not os.path.exists(path):
         return None  # type: ignore
@@ -216,29 +501,30 @@ def get_reference(ref) -> str:
         data = file.read().strip()
 
     if data.startswith("ref: "):
-        return get_reference(data[5:])
+        return get_reference(data[5:], repo)
     else:
         return data
 
 
-def get_commit(commit_ref) -> Commit:
+def get_commit(commit_ref, repo: Optional[Repository] = None) -> Commit:
     # commit_ref: sha1 of commit | branch_name
-    repo = find_repository()
+    repo = repo or find_repository()
     if not is_sha1(commit_ref):
-        path = repo.build_path(["refs", "heads", commit_ref])
+        path = repo.build_path("refs", "heads", commit_ref)
         with open(path, "r") as file:
             commit_ref = file.read().strip()
     return read_object(repo, commit_ref)
 
 
-def get_current_commit():
-    current_commit_ref = get_reference("HEAD")
-    return get_commit(current_commit_ref)
+def get_current_commit(repo: Optional[Repository] = None):
+    repo = repo or find_repository()
+    current_commit_ref = get_reference("HEAD", repo)
+    return get_commit(current_commit_ref, repo)
 
 
-def update_current_ref(commit_sha):
+def update_current_ref(commit_sha, repo: Optional[Repository] = None):
     assert commit_sha is not None and is_sha1(commit_sha)
-    repo = find_repository()
+    repo = repo or find_repository()
     with open(repo.build_path("HEAD"), "r") as file:
         head_data = file.read().strip()
 
@@ -252,7 +538,7 @@ def update_current_ref(commit_sha):
             file.write(commit_sha)
 
 
-def update_ref(reference, commit_sha):
+def update_ref(reference, commit_sha, repo: Optional[Repository] = None):
     assert commit_sha is not None and is_sha1(commit_sha)
     """
     Update the object name stored in a ref safely.
@@ -262,78 +548,162 @@ def update_ref(reference, commit_sha):
     if reference != "HEAD":
         reference = f"refs/heads/{reference}"
 
-    repo = find_repository()
+    repo = repo or find_repository()
     with open(repo.build_path(reference), "w") as file:
         print(f"Reference {reference} updated to {commit_sha}")
         file.write(commit_sha)
 
 
-def get_index_entries_from_commit(commit_sha) -> List[IndexEntry]:
-    repo = find_repository()
+def get_index_entries_from_commit(
+    commit_sha, repo: Optional[Repository] = None
+) -> List[IndexEntry]:
+    repo = repo or find_repository()
     commit = read_object(repo, commit_sha)
-    tree_sha = commit.commit_data[b"tree"].decode("ascii")
+    return [
+        IndexEntry(path, sha) for path, _, sha in iter_tree(repo, commit.get_tree_hash())
+    ]
 
-    tree_items = ls_tree(tree_sha)
-    return get_index_entries_rec(tree_items)
 
+def get_commit_changes(commit_sha, repo: Optional[Repository] = None) -> List[Tuple[str, str]]:
+    """
+    Get the changes from a commit: (path, sha) of the files it adds or modifies
+    compared to its first parent, in path order.
+    """
+    repo = repo or find_repository()
+    commit = read_object(repo, commit_sha)
+    parents = commit.get_parents()
+    parent_tree = read_object(repo, parents[0]).get_tree_hash() if parents else None
 
-def get_index_entries_rec(tree_items: List, seed_path=[]) -> List[IndexEntry]:
-    entries = []
-    for mode, type, sha, path in tree_items:
-        if type == "tree":
-            assert len(sha) == 40
-            entries += get_index_entries_rec(ls_tree(sha), seed_path + [path])
-        else:
-            # TODO: agregar mode a index entry?
-            path = "/".join(seed_path + [path])
-            entries.append(IndexEntry(path, sha))
-    return entries
+    changes = diff_trees(repo, parent_tree, commit.get_tree_hash())
+    return [(path, new[1]) for _, path, _, new in changes if new is not None]
 
 
-def get_commit_changes(commit_sha):
+def update_working_directory(
+    old_tree: Optional[str], new_tree: str, repo: Optional[Repository] = None
+) -> List[Tuple[str, str, Optional[Tuple[bytes, str]], Optional[Tuple[bytes, str]]]]:
     """
-    Get the changes from a commit
+    Update the working tree from old_tree to new_tree. Only the files that differ
+    between the two trees are deleted or written, the other files keep their content
+    and their stat data. Returns the changes, as yielded by diff_trees.
     """
-    repo = find_repository()
-    commit = read_object(repo, commit_sha)
-    index_entries = get_index_entries_from_commit(commit_sha)
-    differences = {
-        (index_entry.path, index_entry.hash) for index_entry in index_entries
-    }
-
-    parent_commit = commit.commit_data.get(b"parent", None)
-    if parent_commit:
-        parent_commit_sha1 = parent_commit.decode("ascii")
-        parent_commit = read_object(repo, parent_commit_sha1)
-
-        parent_entries = get_index_entries_from_commit(parent_commit_sha1)
-        differences -= {
-            (index_entry.path, index_entry.hash) for index_entry in parent_entries
-        }
-    return differences
-
-
-def update_index_entries(branch_path):
-    with open(branch_path, "r") as f:
-        branch_commit = f.read()
-        index_entries = get_index_entries_from_commit(branch_commit)
-        update_index(index_entries)
-
-
-def update_working_directory():
-    repo = find_repository()
-    files = get_files_rec(repo.worktree)
-    entries = read_entries()
-    new_files = [entry.path for entry in entries]
-
-    for file in files:
-        if file not in new_files:
-            os.remove(file)
-
-    for entry in entries:
-        obj = read_object(repo, entry.hash)
-        res: bytes = obj.serialize()
-        content = res.decode("ascii")
-
-        with open(entry.path, "w") as f:
-            f.write(content)
+    repo = repo or find_repository()
+    changes = list(diff_trees(repo, old_tree, new_tree))
+
+    # Deletions first, a deleted directory can be replaced by a file of the same name.
+    # Modified files are deleted too and written again, with their new mode.
+    for status, path, _, _ in changes:
+        absolute_path = os.path.join(repo.worktree, path)
+        if status != "added":
+            with suppress(FileNotFoundError):
+                os.remove(absolute_path)
+        if status == "deleted":
+            # Remove the directories left empty, up to the first one that isn't
+            with suppress(OSError):
+                os.removedirs(os.path.dirname(absolute_path))
+
+    # Checkout stops on untracked files but not on ignored ones: like git, an ignored
+    # file in the place of an added file or of one of its directories is removed
+    checked: Set[str] = set()
+    for status, path, _, _ in changes:
+        if status != "added":
+            continue
+        prefix = ""
+        for name in path.split("/"):
+            prefix = f"{prefix}/{name}" if prefix else name
+            if prefix in checked:
+                continue
+            checked.add(prefix)
+            try:
+                st = os.lstat(os.path.join(repo.worktree, prefix))
+            except FileNotFoundError:
+                break
+            if not stat.S_ISDIR(st.st_mode):
+                os.remove(os.path.join(repo.worktree, prefix))
+                break
+
+    checkout_files([(path, *new) for _, path, _, new in changes if new is not None], repo=repo)
+    return changes
+
+
+def checkout_files(
+    files: List[Tuple[str, bytes, str]],
+    jobs: Optional[int] = None,
+    repo: Optional[Repository] = None,
+):
+    """
+    Write the blobs of files, as (path, mode, sha), to paths that don't exist in the
+    working tree.
+
+    Blobs are read, inflated and written by jobs threads, zlib and file writes release
+    the GIL. A thread waits before reading a blob while the blobs read and not written
+    yet take more than CHECKOUT_BUFFER bytes, so memory stays bounded with large files.
+    """
+    repo = repo or find_repository()
+    # Directories are created once, before the threads write in them
+    for directory in sorted({os.path.dirname(path) for path, _, _ in files}):
+        if directory:
+            os.makedirs(os.path.join(repo.worktree, directory), exist_ok=True)
+    # Loaded before the threads read from them
+    get_packs(repo)
+
+    buffered = 0
+    buffer_changed = threading.Condition()
+
+    def checkout_batch(batch):
+        nonlocal buffered
+        for path, mode, sha in batch:
+            if buffered >= CHECKOUT_BUFFER:
+                with buffer_changed:
+                    buffer_changed.wait_for(lambda: buffered < CHECKOUT_BUFFER)
+            _, data = read_object_data(repo, sha)
+            with buffer_changed:
+                buffered += len(data)
+            try:
+                write_worktree_file(os.path.join(repo.worktree, path), mode, data)
+            finally:
+                with buffer_changed:
+                    buffered -= len(data)
+                    buffer_changed.notify_all()
+
+    # A task writes a batch of files, most files are small and a task per file would
+    # cost more than writing it
+    batches = [files[i : i + CHECKOUT_BATCH] for i in range(0, len(files), CHECKOUT_BATCH)]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(checkout_batch, batches))
+    count("files checked out", len(files))
+
+
+def write_worktree_file(path: str, mode: bytes, data: bytes):
+    """
+    Create the file of a blob, with the permissions of its mode (before the umask).
+    """
+    if mode == SYMLINK_MODE:
+        os.symlink(data, path)
+        return
+
+    permissions = 0o777 if mode == EXECUTABLE_MODE else 0o666
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, permissions)
+    try:
+        # Unbuffered, a file costs an open, a write and a close
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+
+
+def update_index_entries(changes, repo: Optional[Repository] = None):
+    """
+    Update the index with the changes of update_working_directory, the written files
+    get their new stat data so the next status doesn't hash them again.
+    """
+    repo = repo or find_repository()
+    entries = []
+    removed_paths = []
+    for _, path, _, new in changes:
+        if new is None:
+            removed_paths.append(path)
+        else:
+            st = os.stat(os.path.join(repo.worktree, path))
+            entries.append(IndexEntry.from_stat(path, new[1], st))
+    update_entries(entries, removed_paths, repo=repo)
@@ -1,14 +1,22 @@
+import collections
+import itertools
 import os
-from typing import List
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
 from src import plumbing
-from src.algorithms import (ancestors_until_lca, get_ancestors, get_files_rec,
-                            read_object)
+from src.algorithms import (commits_not_in, diff_index_worktree,
+                            get_commit_info, is_ignored, merge_bases,
+                            read_object, walk_commits, walk_worktree)
 from src.colors import color_text
-from src.index import IndexEntry, read_entries
+from src.index import (IndexEntry, IndexFile, open_index, smudge_racy_entries,
+                       update_entries, update_extensions, write_entries)
 from src.objects.base import is_sha1
-from src.objects.commit import Commit
-from src.repository import GITDIR, create_repository, find_repository
+from src.repository import (GITDIR, Repository, create_repository,
+                            find_repository)
+from src.transaction import object_transaction
+from src.untracked_cache import UNTRACKED_CACHE_SIGNATURE, UntrackedCache
 from src.utils import print_status_messages
 
 
@@ -21,7 +29,7 @@ def init(path):
     create_repository(path)
 
 
-def add(paths: List[str]):
+def add(paths: List[str], jobs: Optional[int] = None, repo: Optional[Repository] = None):
     """
     Add file contents to the index.
 
@@ -41,28 +49,82 @@ def add(paths: List[str]):
     changes included in the next commit, then you must run git add again to add the new
     content to the index.
 
+    Directories are added recursively ("." is the whole working tree), including the
+    removal of their deleted files. Files are hashed and compressed by jobs threads.
+
     https://git-scm.com/docs/git-add
     """
     # paths: ["A/1.txt", "2.txt"]
-    # Read the entries from the staging area in the index file
-    entries: List[IndexEntry] = read_entries()
-    entries = [entry for entry in entries if entry.path not in paths]
-
+    repo = repo or find_repository()
+    worktree_paths = []
+    cwd = os.getcwd()
     for path in paths:
-        if path.startswith(GITDIR) or path in [".", ".."]:
+        relative_path = os.path.relpath(os.path.join(cwd, path), repo.worktree)
+        if relative_path.split(os.sep)[0] in [GITDIR, ".."]:
             raise Exception(f"Cannot add {path} to the index")
-
-    for path in paths:
-        # TODO: Handle directories
-        if os.path.exists(path):
-            hash = plumbing.hash_object("blob", path=path, write=True)
-            entry = IndexEntry(path, hash)
-            entries.append(entry)
-
-    plumbing.update_index(entries)
-
-
-def commit(message):
+        worktree_paths.append(relative_path)
+
+    # Files to hash (by path, with their stat data) and entries to remove
+    files = {}
+    removed_paths: List[str] = []
+    with open_index(repo=repo) as index:
+        for path in worktree_paths:
+            absolute_path = os.path.normpath(os.path.join(repo.worktree, path))
+            try:
+                mode = os.stat(absolute_path).st_mode
+            except FileNotFoundError:
+                # Deleted from the working tree, remove it (or the files of the
+                # deleted directory) from the staging area
+                if index.find(path.encode("utf-8")) >= 0:
+                    removed_paths.append(path)
+                directory_prefix = path.encode("utf-8") + b"/"
+                removed_paths.extend(entry.path for entry in index.iter_prefix(directory_prefix))
+                continue
+
+            if stat.S_ISDIR(mode):
+                directory = "" if path == "." else path
+                found = set(walk_worktree(repo.worktree, directory, index.is_tracked))
+                prefix = directory + "/" if directory else ""
+                # Tracked files of the directory deleted from the working tree
+                for entry in index.iter_prefix(prefix.encode("utf-8")):
+                    if entry.path not in found:
+                        removed_paths.append(entry.path)
+                # A tracked file replaced by the directory
+                if index.find(path.encode("utf-8")) >= 0:
+                    removed_paths.append(path)
+            else:
+                found = {path}
+                # The tracked files of a directory replaced by the file
+                directory_prefix = path.encode("utf-8") + b"/"
+                removed_paths.extend(entry.path for entry in index.iter_prefix(directory_prefix))
+
+            for file in found:
+                # Stat before hashing, so a change made while hashing is seen as a stat mismatch
+                st = os.stat(os.path.join(repo.worktree, file))
+                entry = index.get(file)
+                if entry and entry.stat_matches(st) and not entry.is_racy(index.mtime_ns):
+                    # Already staged and untouched since
+                    continue
+                files[file] = st
+
+    # SHA-1 and zlib release the GIL, so files are hashed and compressed in threads,
+    # each file read once. A content written by two threads at the same time is stored
+    # once. The blobs are flushed together before the index names them.
+    with object_transaction(repo), ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        def write_file(path):
+            return plumbing.hash_object(
+                "blob", path=os.path.join(repo.worktree, path), write=True, repo=repo
+            )
+
+        hashes = dict(zip(files, executor.map(write_file, files)))
+
+    entries = [IndexEntry.from_stat(path, hashes[path], st) for path, st in files.items()]
+    if entries or removed_paths:
+        update_entries(entries, removed_paths, repo=repo)
+
+
+def commit(message, repo: Optional[Repository] = None):
     """
     Record changes to the repository.
 
@@ -71,70 +133,120 @@ def commit(message):
 
     https://git-scm.com/docs/git-commit
     """
-    tree_sha1 = plumbing.write_tree()
-    commit_sha1 = plumbing.commit_tree(tree_sha1, message)
-    current_branch = plumbing.get_current_branch()
-    plumbing.update_ref(current_branch, commit_sha1)
+    repo = repo or find_repository()
+    # Trees and commit are flushed together, before the branch points to them
+    with object_transaction(repo):
+        tree_sha1 = plumbing.write_tree(repo)
+        commit_sha1 = plumbing.commit_tree(tree_sha1, message, repo)
+    current_branch = plumbing.get_current_branch(repo)
+    plumbing.update_ref(current_branch, commit_sha1, repo)
     return commit_sha1
 
 
-def status():
+def status(paths: Optional[List[str]] = None, repo: Optional[Repository] = None):
     """
     Show the working tree status.
     Displays paths that have differences between the index file and the current HEAD commit,
     paths that have differences between the working tree and the index file, and paths in
     the working tree that are not tracked by Calp (our Git implementation).
 
+    paths (relative to the worktree) limits the status to these files and the files
+    under these directories.
+
     https://git-scm.com/docs/git-status
     """
-    repo = find_repository()
-    entries: List[IndexEntry] = read_entries()
-    files = get_files_rec(repo.worktree)
-    modified = []
-    untracked = []
-    deleted = []
-    hashes = []
-
-    for file in files:
-        hash = plumbing.hash_object("blob", path=file, write=False)
-        hashes.append(hash)
-        found = False
-
-        for entry in entries:
-            if entry.hash != hash and entry.path in file:
-                modified.append(entry.path)
-                found = True
-                break
-            elif entry.hash == hash and entry.path in file:
-                found = True
-                break
-
-        if not found:
-            relative_path = os.path.relpath(file, repo.worktree)
-            untracked.append(relative_path)
-
-    for entry in entries:
-        if entry.hash not in hashes and entry.path not in modified:
-            deleted.append(entry.path)
-
-    return {
-        "deleted": deleted,
-        "modified": modified,
-        "untracked": untracked,
-    }
-
-
-def has_uncommited_changes():
-    modifies = status()
+    repo = repo or find_repository()
+    with open_index(verify=True, repo=repo) as index:
+        index_mtime_ns = index.mtime_ns
+        extensions = index.extensions
+        untracked_cache = None
+        if paths is None:
+            if repo.conf.getboolean("core", "untrackedCache", fallback=True):
+                untracked_cache = UntrackedCache.deserialize(
+                    extensions.get(UNTRACKED_CACHE_SIGNATURE, b""), index_mtime_ns
+                )
+            entries_by_path = {entry.path: entry for entry in index}
+            # Ignored files are only listed when they are tracked
+            files = walk_worktree(
+                repo.worktree, is_tracked=index.is_tracked, untracked_cache=untracked_cache
+            )
+        else:
+            entries_by_path, files = find_paths(paths, index, repo)
+    refreshed = []
+
+    def is_modified(entry: IndexEntry, path: str) -> bool:
+        st = os.stat(os.path.join(repo.worktree, path))
+        if entry.stat_matches(st) and not entry.is_racy(index_mtime_ns):
+            # Untouched since it was added, trust the hash stored in the index
+            return False
+
+        hash = plumbing.hash_object(
+            "blob", path=os.path.join(repo.worktree, path), write=False, repo=repo
+        )
+        if entry.hash != hash:
+            return True
+
+        # Same content with new stat data (e.g. touched), refresh the entry
+        # so the next status doesn't have to rehash it.
+        refreshed.append(IndexEntry.from_stat(entry.path, hash, st))
+        return False
+
+    STATUS = diff_index_worktree(entries_by_path, files, is_modified)
+
+    if untracked_cache is not None and untracked_cache.is_changed():
+        extensions = {**extensions, UNTRACKED_CACHE_SIGNATURE: untracked_cache.serialize()}
+        if not refreshed:
+            update_extensions(extensions, repo)
+
+    if refreshed and paths is not None:
+        # Only some of the entries were read
+        update_entries(refreshed, extensions=extensions, repo=repo)
+    elif refreshed:
+        smudge_racy_entries(list(entries_by_path.values()), index_mtime_ns)
+        for entry in refreshed:
+            entries_by_path[entry.path] = entry
+        write_entries(list(entries_by_path.values()), extensions, repo)
+
+    return STATUS
+
+
+def find_paths(paths: List[str], index: IndexFile, repo: Repository):
+    """
+    Index entries (by path) and worktree files at or under paths, for status.
+    """
+    entries_by_path = {}
+    files = []
+    for path in paths:
+        if path.split("/")[0] == GITDIR:
+            continue
+        tracked = index.get(path)
+        if tracked is not None:
+            entries_by_path[path] = tracked
+        for entry in index.iter_prefix(path.encode("utf-8") + b"/"):
+            entries_by_path[entry.path] = entry
+
+        absolute_path = os.path.join(repo.worktree, path)
+        if os.path.isdir(absolute_path):
+            files.extend(walk_worktree(repo.worktree, path, index.is_tracked))
+        elif os.path.exists(absolute_path):
+            if tracked is not None or not is_ignored(repo.worktree, path):
+                files.append(path)
+
+    # Paths can overlap
+    return entries_by_path, sorted(set(files))
+
+
+def has_uncommited_changes(repo: Optional[Repository] = None):
+    modifies = status(repo=repo)
     return bool(modifies["modified"] or modifies["untracked"] or modifies["deleted"])
 
 
-def checkout(branch_name, is_new_branch=False):
+def checkout(branch_name, is_new_branch=False, repo: Optional[Repository] = None):
     """
     Switch branches or restore working tree files
     https://git-scm.com/docs/git-checkout
     """
-    repo = find_repository()
+    repo = repo or find_repository()
 
     branch_path = repo.worktree + "/" + GITDIR + "/refs/heads/" + branch_name
     with open(repo.build_path("HEAD"), "r+") as file:
@@ -161,26 +273,52 @@ def checkout(branch_name, is_new_branch=False):
         return
 
     if os.path.exists(branch_path):
-        STATUS = status()
+        STATUS = status(repo=repo)
         # If there are changes, they need to be commited before
         # changing to a branch
-        if has_uncommited_changes():
+        if STATUS["modified"] or STATUS["untracked"] or STATUS["deleted"]:
             print_status_messages(STATUS)
         else:
             if current_branch == branch_name:
                 print(f"Already on branch {branch_name}")
             else:
-                with open(repo.build_path("HEAD"), "r+") as file:
-                    file.truncate(0)
+                current_commit = plumbing.get_reference("HEAD", repo)
+                old_tree = current_commit and read_object(repo, current_commit).get_tree_hash()
+                with open(branch_path, "r") as file:
+                    new_tree = read_object(repo, file.read().strip()).get_tree_hash()
+
+                # Only the files that differ between both commits are touched
+                changes = plumbing.update_working_directory(old_tree, new_tree, repo)
+                plumbing.update_index_entries(changes, repo)
+                with open(repo.build_path("HEAD"), "w") as file:
                     file.write(f"ref: refs/heads/{branch_name}")
-                    plumbing.update_index_entries(branch_path)
-                    plumbing.update_working_directory()
-                    print(f"Switched to branch {branch_name}")
+
+                print(f"Switched to branch {branch_name}")
+                if changes:
+                    summary = collections.Counter(change[0] for change in changes)
+                    details = ", ".join(f"{summary[name]} {name}" for name in sorted(summary))
+                    print(f"Updated {len(changes)} files ({details})")
     else:
         print("Branch does not exist")
 
 
-def cherry_pick(commit_ref):
+def gc(repo: Optional[Repository] = None):
+    """
+    Cleanup unnecessary files and optimize the local repository.
+
+    Loose objects and existing packs are packed into a single pack, storing similar
+    objects as deltas, and the loose objects are removed. The commit-graph is written
+    again.
+
+    https://git-scm.com/docs/git-gc
+    """
+    repo = repo or find_repository()
+    pack_path = plumbing.repack(all_objects=True, delete=True, repo=repo)
+    plumbing.write_commit_graph(repo)
+    return pack_path
+
+
+def cherry_pick(commit_ref, repo: Optional[Repository] = None):
     """
     commit_ref: sha1 of commit | branch_name
 
@@ -193,43 +331,44 @@ def cherry_pick(commit_ref):
     https://git-scm.com/docs/git-cherry-pick
     """
 
+    repo = repo or find_repository()
     # check if commit_sha1 is a valid sha1 chars with hashlib library
     if is_sha1(commit_ref):
         commit_sha1 = commit_ref
     else:
         # Is a branch name. e.g. feature_branch,
         # we need to get the commit sha1 from refs/heads/feature_branch file.
-        commit_sha1 = plumbing.get_reference(f"refs/heads/{commit_ref}")
+        commit_sha1 = plumbing.get_reference(f"refs/heads/{commit_ref}", repo)
 
-    if has_uncommited_changes():
+    if has_uncommited_changes(repo):
         raise Exception("Cannot cherry-pick with uncommited changes")
 
-    repo = find_repository()
-    commit_to_cherry_pick = plumbing.get_commit(commit_sha1)  # sixth commit
+    commit_to_cherry_pick = plumbing.get_commit(commit_sha1, repo)  # sixth commit
 
-    changes = plumbing.get_commit_changes(commit_sha1)
+    changes = plumbing.get_commit_changes(commit_sha1, repo)
     for path, sha in changes:
-        commited_data = plumbing.cat_file("blob", sha)
+        commited_data = plumbing.cat_file("blob", sha, repo)
         list_path = path.split("/")
 
         is_modified_file = (
-            os.path.exists(path) and plumbing.hash_object("blob", path=path, write=False) != sha
+            os.path.exists(path)
+            and plumbing.hash_object("blob", path=path, write=False, repo=repo) != sha
         )
         is_new_file = not os.path.exists(path)
 
         if is_modified_file or is_new_file:
             # Create paths if not exists
             os.makedirs(os.path.join(repo.worktree, "/".join(list_path[:-1])), exist_ok=True)
-            with open(path, "w+") as f:
+            with open(path, "wb") as f:
                 # TODO: Check lowest common ancestor hash, to verify if the file has been modified
                 # betweet current commit and the lca commit, and detect merge conflicts
                 f.write(commited_data)
-            add([path])
+            add([path], repo=repo)
 
-    return commit(commit_to_cherry_pick.get_message())
+    return commit(commit_to_cherry_pick.get_message(), repo)
 
 
-def rebase(commit_ref):
+def rebase(commit_ref, repo: Optional[Repository] = None):
     """
     commit_ref: sha1 of commit | branch_name
 
@@ -240,44 +379,76 @@ def rebase(commit_ref):
     https://git-scm.com/docs/git-rebase
     """
 
+    repo = repo or find_repository()
     if is_sha1(commit_ref):
         commit_sha = commit_ref
     else:
-        commit_sha = plumbing.get_reference(f"refs/heads/{commit_ref}")
+        commit_sha = plumbing.get_reference(f"refs/heads/{commit_ref}", repo)
 
     # TODO: change this if HEAD is not a branch
-    head_branch = plumbing.get_current_branch()  # master
-    current_commit = plumbing.get_reference("HEAD")  # commit de master
+    head_branch = plumbing.get_current_branch(repo)  # master
+    current_commit = plumbing.get_reference("HEAD", repo)  # commit de master
 
-    ancestors = ancestors_until_lca(commit_sha, current_commit)[1:]
+    # Only the commits after the fork point are walked, merges are dropped like git
+    # does by default
+    ancestors = [
+        sha
+        for sha in commits_not_in(repo, current_commit, commit_sha)
+        if len(get_commit_info(repo, sha)[0]) <= 1
+    ]
 
     if not ancestors:
-        print("Cannot rebase a branch onto itself")
+        print(f"Current branch {head_branch} is up to date.")
         return
 
-    repo = find_repository()
     with open(repo.build_path(f"refs/heads/{head_branch}"), "w+") as file:
         file.write(commit_sha)
 
     last_commit = None
     for ancestor_hash in ancestors:
-        last_commit = cherry_pick(ancestor_hash)
+        last_commit = cherry_pick(ancestor_hash, repo)
 
     # Update HEAD with last_commit
-    plumbing.update_ref(head_branch, last_commit)
+    plumbing.update_ref(head_branch, last_commit, repo)
     return last_commit
 
 
-def log():
+def merge_base(
+    commit_ref1, commit_ref2, all_bases=False, repo: Optional[Repository] = None
+) -> List[str]:
+    """
+    commit_ref1, commit_ref2: sha1 of commit | branch_name | HEAD
+
+    Find the best common ancestor of two commits, all of them with all_bases.
+    https://git-scm.com/docs/git-merge-base
+    """
+    repo = repo or find_repository()
+    shas = []
+    for commit_ref in [commit_ref1, commit_ref2]:
+        if is_sha1(commit_ref):
+            sha = commit_ref
+        elif commit_ref == "HEAD":
+            sha = plumbing.get_reference("HEAD", repo)
+        else:
+            sha = plumbing.get_reference(f"refs/heads/{commit_ref}", repo)
+        if not sha:
+            raise Exception(f"Not a valid commit: {commit_ref}")
+        shas.append(sha)
+
+    bases = merge_bases(repo, *shas)
+    return bases if all_bases else bases[:1]
+
+
+def log(max_count: Optional[int] = None, repo: Optional[Repository] = None):
     """
     List commits that are reachable by following
     the parent links from the given commit(s)
     https://git-scm.com/docs/git-log
     """
 
-    repo = find_repository()
+    repo = repo or find_repository()
 
-    head_commit = plumbing.get_reference("HEAD")
+    head_commit = plumbing.get_reference("HEAD", repo)
 
     with open(repo.build_path("HEAD"), "r+") as file:
         head = file.read().split('/')[-1]
@@ -287,17 +458,14 @@ def log():
         print("No commits yet")
         return
 
-    head_commit_object: Commit = read_object(repo, head_commit)
-
-    ancestors = get_ancestors(repo, head_commit_object)
-
-    # Print head commit
-    log_message = color_text("YELLOW", head_commit[:8]) + color_text("YELLOW", " (")
-    log_message += color_text("CYAN", "HEAD ->") + color_text("GREEN", " " + head)
-    log_message += color_text("YELLOW", ") ") + head_commit_object.get_message()
-
-    print(log_message)
-
-    for ancestor in ancestors:
-        ancestor_commit_obj: Commit = read_object(repo, ancestor)
-        print(color_text("YELLOW", ancestor[:8]) + " " + ancestor_commit_obj.get_message())
+    commits = walk_commits(repo, [head_commit])
+    for sha in itertools.islice(commits, max_count):
+        commit = read_object(repo, sha)
+        if sha == head_commit:
+            # Print head commit
+            log_message = color_text("YELLOW", sha[:8]) + color_text("YELLOW", " (")
+            log_message += color_text("CYAN", "HEAD ->") + color_text("GREEN", " " + head)
+            log_message += color_text("YELLOW", ") ") + commit.get_message()
+            print(log_message)
+        else:
+            print(color_text("YELLOW", sha[:8]) + " " + commit.get_message())
@@ -1,23 +1,43 @@
 import configparser
 import os
+from typing import Dict, Optional, Tuple
+
+from src.cache import LRUCache
 
 GITDIR = ".calp"
 
+# Default limits of the object cache, see [core] objectCacheLimit and objectCacheSize
+OBJECT_CACHE_LIMIT = 4096
+OBJECT_CACHE_SIZE = 64 * 1024 * 1024
+
 
 class Repository:
 
     worktree = "."
     gitdir = GITDIR
     conf = None
-
-    def __init__(self, path: str):
+    # (mtime of objects/pack, [Pack]), see pack.get_packs
+    packs = None
+    # Parsed objects by sha-1, see algorithms.read_object
+    object_cache = None
+    # (mtime of objects/info/commit-graph, CommitGraph), see commit_graph.get_commit_graph
+    commit_graph = None
+    # Current ObjectTransaction, see transaction.object_transaction
+    object_transaction = None
+
+    def __init__(self, path: str, gitdir: Optional[str] = None):
         self.worktree = path
-        self.gitdir = os.path.join(path, GITDIR)
+        self.gitdir = gitdir or os.path.join(path, GITDIR)
         self.conf = configparser.ConfigParser()
         cf = self.build_path("config")
         if os.path.exists(cf):
             self.conf.read([cf])
 
+        self.object_cache = LRUCache(
+            self.conf.getint("core", "objectCacheLimit", fallback=OBJECT_CACHE_LIMIT),
+            self.conf.getint("core", "objectCacheSize", fallback=OBJECT_CACHE_SIZE),
+        )
+
     def build_path(self, *path):
         # [ "A", "B", "C" ]
         # .calp/A/B/C
@@ -25,8 +45,8 @@ class Repository:
 
     def create_dir(self, *path):
         path = self.build_path(*path)
-        if not os.path.exists(path):
-            os.makedirs(path)
+        # Another thread may create it at the same time
+        os.makedirs(path, exist_ok=True)
         return path
 
 
@@ -43,22 +63,61 @@ def create_repository(path) -> Repository:
 
     with open(repo.build_path("HEAD"), "w+") as f:
         f.write("ref: refs/heads/master")
+    # The directories below path now belong to the new repository
+    forget_repositories()
     return repo
 
 
-def find_repository(path=".") -> Repository:
-    path = os.path.realpath(path)
-
-    if os.path.isdir(os.path.join(path, GITDIR)):
-        return Repository(path)
+# Environment variable with the path of the repository directory, set by
+# calp --git-dir. The worktree is the directory containing it.
+CALP_DIR = "CALP_DIR"
 
-    parent = os.path.realpath(os.path.join(path, ".."))
+# Repositories already found, by path of the worktree. Reusing the instance keeps its
+# caches for the whole process.
+repositories: Dict[str, Repository] = {}
+# (worktree, gitdir) found for a directory, so each directory is searched once
+discovered: Dict[Tuple[str, Optional[str]], Tuple[str, str]] = {}
 
-    # Base case
-    if parent == path:
-        # os.path.join("/", "..") == "/":
-        # If parent == path, then path is root.
-        raise Exception("No git directory.")
 
-    # Recursive case
-    return find_repository(parent)
+def find_repository(path=".") -> Repository:
+    """
+    Repository containing path (the current directory by default), or the one of
+    CALP_DIR when it is set. The parents of path are only searched the first time,
+    the repository is then reused for the whole process.
+    """
+    calp_dir = os.environ.get(CALP_DIR)
+    key = (os.path.join(os.getcwd(), path), calp_dir)
+    if key not in discovered:
+        if calp_dir:
+            gitdir = os.path.realpath(calp_dir)
+            if not os.path.isdir(gitdir):
+                raise Exception(f"Not a git directory: {calp_dir}")
+            discovered[key] = (os.path.dirname(gitdir), gitdir)
+        else:
+            worktree = search_worktree(os.path.realpath(path))
+            discovered[key] = (worktree, os.path.join(worktree, GITDIR))
+
+    worktree, gitdir = discovered[key]
+    if worktree not in repositories:
+        repositories[worktree] = Repository(worktree, gitdir)
+    return repositories[worktree]
+
+
+def forget_repositories():
+    """
+    Drop the repositories found and their caches, the next find_repository searches
+    the directories again.
+    """
+    repositories.clear()
+    discovered.clear()
+
+
+def search_worktree(path: str) -> str:
+    # Closest directory containing a repository, from path up to the root
+    while not os.path.isdir(os.path.join(path, GITDIR)):
+        parent = os.path.dirname(path)
+        if parent == path:
+            # path is the root
+            raise Exception("No git directory.")
+        path = parent
+    return path
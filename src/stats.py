@@ -0,0 +1,26 @@
+import sys
+import threading
+from collections import Counter
+
+from src.repository import repositories
+
+# Work done by the current command, printed with calp --verbose
+counters: Counter = Counter()
+lock = threading.Lock()
+
+
+def count(name: str, value: int = 1):
+    # Counters are updated from the threads of add
+    with lock:
+        counters[name] += value
+
+
+def print_stats(file=sys.stderr):
+    for name, value in sorted(counters.items()):
+        if value:
+            print(f"{name}: {value}", file=file)
+
+    for repo in repositories.values():
+        cache = repo.object_cache
+        print(f"object cache hits: {cache.hits}", file=file)
+        print(f"object cache misses: {cache.misses}", file=file)
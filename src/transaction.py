@@ -0,0 +1,152 @@
+import ctypes
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+
+from src.repository import Repository
+from src.stats import count
+
+"""
+Durability of the objects written by a command, set by core.fsync in the config:
+
+- none: objects are renamed into place as soon as they are written and never synced.
+  A crash can leave empty or truncated objects behind.
+- batch (default): objects are written to temporary files. When the transaction ends,
+  a single syncfs (fsync of each file where syncfs isn't available) flushes all of
+  them, and only then are they renamed into place. An object is never visible before
+  its content is on disk, and a commit costs one flush, not one per object.
+- full: each object is fsynced before it is renamed, then its directory is fsynced.
+
+A transaction wraps the writes of a command (an add, the trees and the commit of a
+commit) and ends before the references are updated, so a reference never points to an
+object that isn't on disk. Objects staged by the transaction are read from their
+temporary file until then.
+
+https://git-scm.com/docs/git-config#Documentation/git-config.txt-corefsync
+"""
+
+FSYNC_NONE = "none"
+FSYNC_BATCH = "batch"
+FSYNC_FULL = "full"
+FSYNC_MODES = [FSYNC_NONE, FSYNC_BATCH, FSYNC_FULL]
+
+
+def get_fsync_mode(repo: Repository) -> str:
+    mode = repo.conf.get("core", "fsync", fallback=FSYNC_BATCH)
+    if mode not in FSYNC_MODES:
+        raise Exception(f"Invalid core.fsync {mode}, expected one of {', '.join(FSYNC_MODES)}")
+    return mode
+
+
+class ObjectTransaction:
+    def __init__(self, repo: Repository):
+        self.repo = repo
+        self.mode = get_fsync_mode(repo)
+        # {sha: temporary file} of the objects waiting for the end of the transaction
+        self.staged: Dict[str, str] = {}
+        # Objects are written by the threads of add
+        self.lock = threading.Lock()
+        # Writes that must only name objects on disk, run by commit
+        self.callbacks: List[Callable[[], None]] = []
+
+    def stage(self, tmp_path: str, sha: str) -> bool:
+        """
+        Add a written (and closed) temporary file as the object sha. False when the
+        object is already stored loose or staged, the temporary file is removed.
+        """
+        if self.mode == FSYNC_FULL:
+            fsync_path(tmp_path)
+        with self.lock:
+            if sha in self.staged or os.path.exists(
+                self.repo.build_path("objects", sha[0:2], sha[2:])
+            ):
+                # Written twice, by two threads of add
+                os.remove(tmp_path)
+                return False
+            if self.mode == FSYNC_BATCH:
+                self.staged[sha] = tmp_path
+                return True
+            path = self.rename(tmp_path, sha)
+        if self.mode == FSYNC_FULL:
+            fsync_path(os.path.dirname(path))
+        return True
+
+    def rename(self, tmp_path: str, sha: str) -> str:
+        path = os.path.join(self.repo.create_dir("objects", sha[0:2]), sha[2:])
+        os.replace(tmp_path, path)
+        return path
+
+    def after_commit(self, callback: Callable[[], None]):
+        self.callbacks.append(callback)
+
+    def commit(self):
+        if self.staged:
+            sync_files(self.repo.build_path("objects"), list(self.staged.values()))
+            for sha, tmp_path in self.staged.items():
+                self.rename(tmp_path, sha)
+            count("objects synced", len(self.staged))
+            self.staged = {}
+
+        for callback in self.callbacks:
+            callback()
+        self.callbacks = []
+
+    def abort(self):
+        for tmp_path in self.staged.values():
+            os.remove(tmp_path)
+        self.staged = {}
+        self.callbacks = []
+
+
+@contextmanager
+def object_transaction(repo: Repository) -> Iterator[ObjectTransaction]:
+    """
+    Group the object writes made in the block, see the modes above. A transaction
+    started inside another one joins it. When the block raises, the staged objects are
+    removed.
+    """
+    if repo.object_transaction is not None:
+        yield repo.object_transaction
+        return
+
+    transaction = ObjectTransaction(repo)
+    repo.object_transaction = transaction
+    try:
+        yield transaction
+    except BaseException:
+        repo.object_transaction = None
+        transaction.abort()
+        raise
+    repo.object_transaction = None
+    transaction.commit()
+
+
+def fsync_path(path: str):
+    # Directories can only be opened read only, fsync works on any descriptor
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_files(directory: str, paths: List[str]):
+    """
+    Flush paths to disk. On Linux, syncfs flushes the whole file system of directory
+    with one call, elsewhere each file is fsynced.
+    """
+    # The symbols of the interpreter, the C library included
+    libc = ctypes.CDLL(None, use_errno=True)
+    if hasattr(libc, "syncfs"):
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            if libc.syncfs(fd) == 0:
+                count("syncfs calls")
+                return
+        finally:
+            os.close(fd)
+
+    for path in paths:
+        fsync_path(path)
+    count("fsync calls", len(paths))
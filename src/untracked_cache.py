@@ -0,0 +1,87 @@
+import os
+import struct
+from typing import Dict, List, Optional, Tuple
+
+from src.stats import count
+
+"""
+The untracked cache is stored in the "UNTR" extension of the index. For every directory
+status walked (the root is ""), it records the mtime of the directory and its entries
+when it was listed:
+
+{path}\\0 {mtime_ns (u64)} {number of entries (u32)}, then for each entry
+{"d" for a directory or "f"}{name}\\0
+
+Creating, deleting or renaming an entry changes the mtime of its directory, so while
+the mtime is the same the listing is reused: status stats the directory instead of
+reading it. The entries are stored before the ignore rules and the index are applied,
+both are checked again by each status.
+
+As for the entries of the index, a directory whose mtime is not older than the index
+could have changed in the same clock tick after it was listed, it is listed again.
+"""
+
+UNTRACKED_CACHE_SIGNATURE = b"UNTR"
+DIRECTORY_RECORD = struct.Struct(">QI")
+
+# [(name, is a directory)]
+Listing = List[Tuple[str, bool]]
+
+
+class UntrackedCache:
+    def __init__(
+        self, directories: Optional[Dict[str, Tuple[int, Listing]]] = None, index_mtime_ns=0
+    ):
+        # {directory: (mtime_ns, listing)} read from the index
+        self.directories = directories or {}
+        self.index_mtime_ns = index_mtime_ns
+        # Directories listed by the current walk, the ones not walked anymore are dropped
+        self.listed: Dict[str, Tuple[int, Listing]] = {}
+        self.read_count = 0
+
+    @classmethod
+    def deserialize(cls, data: bytes, index_mtime_ns: int) -> "UntrackedCache":
+        directories = {}
+        pos = 0
+        while pos < len(data):
+            end = data.index(b"\0", pos)
+            mtime_ns, entry_count = DIRECTORY_RECORD.unpack_from(data, end + 1)
+            directory = data[pos:end].decode("utf-8")
+            pos = end + 1 + DIRECTORY_RECORD.size
+
+            listing = []
+            for _ in range(entry_count):
+                end = data.index(b"\0", pos)
+                listing.append((data[pos + 1 : end].decode("utf-8"), data[pos] == ord("d")))
+                pos = end + 1
+            directories[directory] = (mtime_ns, listing)
+        return cls(directories, index_mtime_ns)
+
+    def serialize(self) -> bytes:
+        records = []
+        for directory, (mtime_ns, listing) in sorted(self.listed.items()):
+            records.append(directory.encode("utf-8") + b"\0")
+            records.append(DIRECTORY_RECORD.pack(mtime_ns, len(listing)))
+            for name, is_directory in listing:
+                records.append((b"d" if is_directory else b"f") + name.encode("utf-8") + b"\0")
+        return b"".join(records)
+
+    def list_directory(self, worktree: str, directory: str) -> Listing:
+        path = os.path.join(worktree, directory)
+        # Stat before reading, a change made in between is seen on the next status
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = self.directories.get(directory)
+        if cached is not None and cached[0] == mtime_ns and mtime_ns < self.index_mtime_ns:
+            count("directories listed from the untracked cache")
+            listing = cached[1]
+        else:
+            with os.scandir(path) as iterator:
+                listing = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in iterator]
+            self.read_count += 1
+        self.listed[directory] = (mtime_ns, listing)
+        return listing
+
+    def is_changed(self) -> bool:
+        # A directory read again is stored with its new listing, or as not racy anymore
+        # once the index is written
+        return self.read_count > 0 or self.listed.keys() != self.directories.keys()
@@ -0,0 +1,291 @@
+"""
+Watch mode of status and log: the output is drawn again when the working tree or the
+repository changes.
+
+On Linux the changes come from inotify, called through ctypes: a watch on each
+directory of the working tree (the ignored ones excluded, as status doesn't list
+them), on the repository directory for the index and HEAD, and on refs/heads. Only
+the changed paths are checked again. Where inotify isn't available, the stat data of
+the files is polled.
+
+https://man7.org/linux/man-pages/man7/inotify.7.html
+"""
+import ctypes
+import os
+import select
+import struct
+import time
+from typing import Dict, List, Optional, Set
+
+from src import porcelain
+from src.algorithms import is_ignored, walk_worktree
+from src.index import open_index
+from src.repository import GITDIR, Repository, find_repository
+from src.utils import print_status_messages
+
+# See inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+# struct inotify_event: wd, mask, cookie, length of the name that follows
+EVENT = struct.Struct("iIII")
+
+# Files of the repository directory that change the status or the log
+REPOSITORY_FILES = ["index", "HEAD"]
+# Changes come in bursts (a checkout, an editor saving a file), events are read until
+# none comes for SETTLE_TIME seconds, for at most MAX_SETTLE_TIME
+SETTLE_TIME = 0.05
+MAX_SETTLE_TIME = 1
+# Seconds between two scans of the polling watcher
+POLL_INTERVAL = 2
+
+
+class InotifyWatcher:
+    """
+    Paths changed in the working tree and the repository, from inotify events.
+
+    Paths are relative to the worktree, the ones of the repository start with .calp/
+    wherever the repository is.
+    """
+
+    def __init__(self, repo: Repository, worktree=True):
+        # The symbols of the interpreter, the C library included
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.inotify_rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.repo = repo
+        # Directory of each watch descriptor, relative with a trailing /
+        self.directories: Dict[int, str] = {}
+        self.add_watch(repo.gitdir, GITDIR + "/")
+        self.add_watch(repo.build_path("refs", "heads"), GITDIR + "/refs/heads/")
+        if worktree:
+            self.watch_worktree("")
+
+    def add_watch(self, path: str, directory: str):
+        wd = self.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            # Deleted since it was listed
+            return
+        self.directories[wd] = directory
+
+    def watch_worktree(self, directory: str):
+        # The directories status walks, the ignored ones without tracked files are left out
+        directories: List[str] = []
+        with open_index(repo=self.repo) as index:
+            walk_worktree(self.repo.worktree, directory, index.is_tracked, directories)
+        for path in directories:
+            self.add_watch(os.path.join(self.repo.worktree, path), path + "/" if path else "")
+
+    def unwatch(self, directory: str):
+        # A directory moved away keeps its watches, they would report the old paths
+        for wd, path in list(self.directories.items()):
+            if path.startswith(directory):
+                self.inotify_rm_watch(self.fd, wd)
+                del self.directories[wd]
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[Set[str]]:
+        """
+        Paths changed since the previous call, waiting at most timeout seconds for a
+        change (an empty set when there was none). None when events were lost and every
+        path must be checked again.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+
+        paths: Set[str] = set()
+        complete = True
+        deadline = time.monotonic() + MAX_SETTLE_TIME
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    break
+                if not select.select([self.fd], [], [], SETTLE_TIME)[0]:
+                    break
+                continue
+            complete = self.read_events(data, paths) and complete
+        return paths if complete else None
+
+    def read_events(self, data: bytes, paths: Set[str]) -> bool:
+        # Adds the changed paths to paths, False if the kernel queue overflowed
+        complete = True
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, pos)
+            name = os.fsdecode(data[pos + EVENT.size : pos + EVENT.size + length].rstrip(b"\0"))
+            pos += EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                complete = False
+                continue
+            if mask & IN_IGNORED:
+                # The directory was deleted
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+
+            path = directory + name
+            if directory.startswith(GITDIR + "/"):
+                if name in REPOSITORY_FILES or directory != GITDIR + "/":
+                    paths.add(path)
+                continue
+            if path == GITDIR:
+                continue
+
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                self.unwatch(path + "/")
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                if not is_ignored(self.repo.worktree, path, is_directory=True):
+                    self.watch_worktree(path)
+            paths.add(path)
+        return complete
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Paths changed in the working tree and the repository, found by comparing the stat
+    data of the files every interval seconds. Used where inotify isn't available.
+    """
+
+    def __init__(self, repo: Repository, worktree=True, interval: float = POLL_INTERVAL):
+        self.repo = repo
+        self.worktree = worktree
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self) -> Dict[str, tuple]:
+        paths = [GITDIR + "/" + name for name in REPOSITORY_FILES]
+        with os.scandir(self.repo.build_path("refs", "heads")) as entries:
+            paths.extend(GITDIR + "/refs/heads/" + entry.name for entry in entries)
+        if self.worktree:
+            with open_index(repo=self.repo) as index:
+                paths.extend(walk_worktree(self.repo.worktree, is_tracked=index.is_tracked))
+
+        snapshot = {}
+        for path in paths:
+            if path.startswith(GITDIR + "/"):
+                absolute_path = self.repo.build_path(path[len(GITDIR) + 1 :])
+            else:
+                absolute_path = os.path.join(self.repo.worktree, path)
+            try:
+                st = os.stat(absolute_path)
+            except FileNotFoundError:
+                continue
+            snapshot[path] = (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino)
+        return snapshot
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[Set[str]]:
+        """
+        Same as InotifyWatcher.wait.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval
+            if deadline is not None:
+                delay = max(min(delay, deadline - time.monotonic()), 0)
+            time.sleep(delay)
+
+            snapshot = self.scan()
+            paths = {
+                path
+                for path in snapshot.keys() | self.snapshot.keys()
+                if snapshot.get(path) != self.snapshot.get(path)
+            }
+            self.snapshot = snapshot
+            if paths or (deadline is not None and time.monotonic() >= deadline):
+                return paths
+
+    def close(self):
+        pass
+
+
+def create_watcher(repo: Repository, worktree=True):
+    try:
+        return InotifyWatcher(repo, worktree)
+    except (OSError, AttributeError):
+        # Not Linux (no inotify functions in the C library), or no instance left
+        return PollingWatcher(repo, worktree)
+
+
+def update_status(status: dict, changes: dict, paths: Set[str]) -> dict:
+    """
+    status with the entries at or under paths replaced by changes, the status of paths.
+    """
+    prefixes = tuple(path + "/" for path in paths)
+    return {
+        key: sorted(
+            [path for path in status[key] if path not in paths and not path.startswith(prefixes)]
+            + changes[key]
+        )
+        for key in status
+    }
+
+
+def watch_status(repo: Optional[Repository] = None):
+    """
+    Print the status, and again each time it changes, until interrupted.
+    """
+    repo = repo or find_repository()
+    watcher = create_watcher(repo)
+    STATUS: Optional[dict] = None
+    paths: Optional[Set[str]] = None
+    try:
+        while True:
+            repository_changed = any(path.startswith(GITDIR + "/") for path in paths or [])
+            if STATUS is None or paths is None or repository_changed:
+                # The index changed (or events were lost), every path is checked again
+                new_status = porcelain.status(repo=repo)
+            elif paths:
+                new_status = update_status(STATUS, porcelain.status(sorted(paths), repo), paths)
+            else:
+                new_status = STATUS
+
+            if new_status != STATUS:
+                STATUS = new_status
+                print("\033c", end="")
+                print_status_messages(STATUS)
+            paths = watcher.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def watch_log(max_count: Optional[int] = None, repo: Optional[Repository] = None):
+    """
+    Print the log, and again each time HEAD or a branch changes, until interrupted.
+    """
+    repo = repo or find_repository()
+    watcher = create_watcher(repo, worktree=False)
+    try:
+        while True:
+            print("\033c", end="")
+            porcelain.log(max_count, repo)
+            paths: Optional[Set[str]] = set()
+            while paths == set():
+                paths = watcher.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
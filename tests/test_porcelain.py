@@ -1,15 +1,29 @@
 # Test file
+import hashlib
 import io
 import os
+import random
+import subprocess
 import sys
+import time
 import unittest
 from contextlib import suppress
 
-from src.index import read_entries
-from src.plumbing import (get_commit_changes, get_reference, read_object,
+from src.algorithms import (commits_not_in, diff_trees, get_ancestors,
+                            get_commit_info, iter_tree, merge_bases,
+                            read_object_data, read_object_header, walk_commits,
+                            walk_worktree)
+from src.commit_graph import get_commit_graph
+from src.index import open_index, read_cache_tree, read_entries
+from src.objects.tree import Tree
+from src.plumbing import (get_commit_changes, get_reference, hash_object,
+                          read_object, repack, update_ref, write_commit,
                           write_tree)
-from src.porcelain import status
-from src.repository import find_repository
+from src.porcelain import init, rebase, status
+from src.repository import find_repository, forget_repositories
+from src.stats import counters
+from src.transaction import object_transaction
+from src.watch import InotifyWatcher, PollingWatcher, update_status
 
 TEST_PATHS = f"{os.getcwd()}/tests"
 ABSOLUTE_PATH = f"{TEST_PATHS}/tmp"
@@ -25,11 +39,14 @@ class TestGitCommands(unittest.TestCase):
 
     def setUp(self):
         os.system(f"rm -rf {ABSOLUTE_PATH}/*")
+        # Forget the repositories (and their caches) of the previous tests
+        forget_repositories()
         return super().setUp()
 
     def tearDown(self):
         os.system(f"rm -rf {ABSOLUTE_PATH}/*")
         os.system(f"rm -rf {ABSOLUTE_PATH}/{GITDIR}")
+        os.system(f"rm -f {ABSOLUTE_PATH}/.calpignore")
 
     def test_init(self):
 
@@ -50,6 +67,19 @@ class TestGitCommands(unittest.TestCase):
         self.assertTrue(os.path.exists(f"{ABSOLUTE_PATH}/{GITDIR}/objects"))
         self.assertTrue(os.path.exists(f"{ABSOLUTE_PATH}/{GITDIR}/refs"))
 
+    def test_init_nested_repository(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.mkdir("sub")
+        self.assertEqual(find_repository("sub").worktree, ABSOLUTE_PATH)
+
+        # The repositories found before are forgotten
+        init("sub")
+        self.assertEqual(os.path.realpath(find_repository("sub").worktree), f"{ABSOLUTE_PATH}/sub")
+        self.assertEqual(find_repository().worktree, ABSOLUTE_PATH)
+
     def test_add(self):
         # assert that tmp_path not exists
         self.assertTrue(os.path.exists(ABSOLUTE_PATH))
@@ -367,3 +397,1020 @@ class TestGitCommands(unittest.TestCase):
 
         obj = read_object(repo, entries[2].hash)
         self.assertTrue(obj.blob_data == b"3\n")
+
+    def test_rebase(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("echo 'base' > base.txt")
+        os.system("../../calp add base.txt")
+        os.system("../../calp commit -m 'base'")
+        os.system("../../calp checkout -b topic")
+        for i in range(1, 3):
+            os.system(f"echo 'topic {i}' > topic.txt")
+            os.system("../../calp add topic.txt")
+            os.system(f"../../calp commit -m 'topic {i}'")
+        os.system("../../calp checkout master")
+        os.system("echo 'main' > main.txt")
+        os.system("../../calp add main.txt")
+        os.system("../../calp commit -m 'main'")
+        main_sha = get_reference("HEAD")
+        os.system("../../calp checkout topic")
+
+        # Commits made the same day have the same time, the history decides the order
+        head_sha = rebase("master")
+
+        repo = find_repository()
+        self.assertEqual(get_reference("HEAD"), head_sha)
+        commits = list(walk_commits(repo, [head_sha]))
+        messages = [read_object(repo, sha).get_message() for sha in commits]
+        self.assertEqual(messages, ["topic 2", "topic 1", "main", "base"])
+        self.assertEqual(commits[2], main_sha)
+        blob_sha = hash_object("blob", data=b"topic 2\n", write=False)
+        self.assertEqual(get_commit_changes(head_sha), [("topic.txt", blob_sha)])
+
+    def test_rebase_skips_upstream_commits(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        # Y <- X <- C <- u1 <- U (upstream) and Y <- Z, T merges Z and C (topic)
+        os.system("../../calp init")
+        os.system("echo 'y' > y.txt")
+        os.system("../../calp add y.txt")
+        os.system("../../calp commit -m 'Y'")
+        os.system("../../calp checkout -b upstream")
+        for name in ["x", "c", "u1", "u"]:
+            os.system(f"echo '{name}' > {name}.txt")
+            os.system(f"../../calp add {name}.txt")
+            os.system(f"../../calp commit -m '{name.upper()}'")
+            if name == "c":
+                c_sha = get_reference("HEAD")
+        os.system("../../calp checkout master")
+        os.system("../../calp checkout -b topic")
+        os.system("echo 'z' > z.txt")
+        os.system("../../calp add z.txt")
+        os.system("../../calp commit -m 'Z'")
+        z_sha = get_reference("HEAD")
+        os.system("echo 'x' > x.txt")
+        os.system("echo 'c' > c.txt")
+        os.system("../../calp add x.txt c.txt")
+        update_ref("topic", write_commit(write_tree(), "T", [z_sha, c_sha]))
+
+        # Only Z is applied again, T is a merge and Y, X and C are in upstream
+        head_sha = rebase("upstream")
+
+        repo = find_repository()
+        commits = list(walk_commits(repo, [head_sha]))
+        messages = [read_object(repo, sha).get_message() for sha in commits]
+        self.assertEqual(messages, ["Z", "U", "U1", "C", "X", "Y"])
+
+    def test_status_uses_index_stat_data(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("echo 'test' > test.txt")
+        os.system("../../calp add test.txt")
+
+        # The index records the stat data of the file when it was added
+        entries = read_entries()
+        st = os.stat("test.txt")
+        self.assertEqual(entries[0].size, st.st_size)
+        self.assertEqual(entries[0].ino, st.st_ino)
+        self.assertEqual(entries[0].mode, st.st_mode)
+
+        STATUS = status()
+        self.assertTrue(STATUS["modified"] == [])
+
+        # Same size and (racily) same timestamp, the content must be checked again
+        os.system("echo 'tent' > test.txt")
+        STATUS = status()
+        self.assertTrue("test.txt" in STATUS["modified"])
+
+        # Rewritten with the original content
+        os.system("echo 'test' > test.txt")
+        STATUS = status()
+        self.assertTrue(STATUS["modified"] == [])
+
+    def test_status_similar_paths(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("echo 'a' > a.txt")
+        os.system("echo 'ba' > ba.txt")
+        os.system("../../calp add a.txt")
+
+        # ba.txt ends with a.txt, but it is not tracked
+        STATUS = status()
+        self.assertEqual(STATUS["untracked"], ["ba.txt"])
+        self.assertEqual(STATUS["modified"], [])
+        self.assertEqual(STATUS["deleted"], [])
+
+        os.system("rm a.txt")
+        STATUS = status()
+        self.assertEqual(STATUS["untracked"], ["ba.txt"])
+        self.assertEqual(STATUS["deleted"], ["a.txt"])
+
+    def test_index_binary_lookup(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("mkdir A")
+        os.system("echo 'test' > test.txt")
+        os.system("echo 'test1' > A/test1.txt")
+        os.system("../../calp add test.txt")
+        os.system("../../calp add A/test1.txt")
+
+        with open(f"{ABSOLUTE_PATH}/{GITDIR}/index", "rb") as file:
+            self.assertTrue(file.read().startswith(b"CIDX"))
+
+        with open_index(verify=True) as index:
+            self.assertEqual(len(index), 2)
+            self.assertEqual(index.find(b"A/test1.txt"), 0)
+            self.assertEqual(index.find(b"test.txt"), 1)
+            self.assertEqual(index.find(b"A"), -1)
+            self.assertEqual(
+                index.get("test.txt").hash, "9daeafb9864cf43055ae93beb0afd6c7d144bfa4"
+            )
+
+        # Replace an entry in place
+        os.system("echo 'test2' > test.txt")
+        os.system("../../calp add test.txt")
+        entries = read_entries()
+        self.assertEqual([entry.path for entry in entries], ["A/test1.txt", "test.txt"])
+        self.assertEqual(entries[1].hash, "180cf8328022becee9aaa2577a8f84ea2b9f3827")
+
+    def test_gc_packs_loose_objects(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        for i in range(1, 4):
+            # Similar versions of the same file, stored as deltas
+            os.system(f"seq 1 {i * 100} > seq.txt")
+            os.system("../../calp add seq.txt")
+            os.system(f"../../calp commit -m 'commit {i}'")
+        commit_sha = get_reference("HEAD")
+
+        os.system("../../calp gc")
+
+        objects = os.listdir(f"{ABSOLUTE_PATH}/{GITDIR}/objects")
+        self.assertEqual(sorted(objects), ["info", "pack"])
+        packs = os.listdir(f"{ABSOLUTE_PATH}/{GITDIR}/objects/pack")
+        self.assertEqual(len(packs), 2)
+
+        repo = find_repository()
+        commit = read_object(repo, commit_sha)
+        self.assertEqual(commit.get_message(), "commit 3")
+        obj = read_object(repo, read_entries()[0].hash)
+        self.assertEqual(obj.blob_data, "".join(f"{i}\n" for i in range(1, 301)).encode())
+
+        STATUS = status()
+        self.assertTrue(STATUS["modified"] == [])
+        self.assertTrue(STATUS["untracked"] == [])
+
+    def test_packed_binary_delta_headers(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        rng = random.Random(0)
+        data = bytes(rng.choice(b"abcdefgh\0\xff") for _ in range(200 * 1024))
+        # Two similar binary blobs, the second one packed as a delta with literal data
+        changed = bytearray(data)
+        for pos in range(0, len(changed), 1024):
+            changed[pos : pos + 64] = bytes(rng.randrange(256) for _ in range(64))
+        with open("a.bin", "wb") as file:
+            file.write(data)
+        with open("b.bin", "wb") as file:
+            file.write(bytes(changed))
+        os.system("../../calp add a.bin b.bin")
+        os.system("../../calp commit -m 'binaries'")
+        repo = find_repository()
+        shas = {entry.path: entry.hash for entry in read_entries()}
+
+        repack(all_objects=True, repo=repo)
+
+        for path, content in (("a.bin", data), ("b.bin", bytes(changed))):
+            sha = shas[path]
+            self.assertEqual(read_object_header(repo, sha), (b"blob", len(content)))
+            output = os.popen(f"../../calp cat-file -t {sha}").read()
+            self.assertEqual(output, "blob\n")
+            output = os.popen(f"../../calp cat-file -s {sha}").read()
+            self.assertEqual(output, f"{len(content)}\n")
+            output = os.popen(f"echo {sha} | ../../calp cat-file --batch-check").read()
+            self.assertEqual(output, f"{sha} blob {len(content)}\n")
+
+    def test_gc_twice_over_deltas(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        rng = random.Random(1)
+        data = bytearray(rng.choice(b"abcdefgh\0\xff") for _ in range(200 * 1024))
+        for i in range(1, 4):
+            # Binary versions of the same file, packed as deltas by the first gc
+            for pos in range(i * 100, len(data), 1024):
+                data[pos : pos + 64] = bytes(rng.randrange(256) for _ in range(64))
+            with open("data.bin", "wb") as file:
+                file.write(data)
+            os.system("../../calp add data.bin")
+            os.system(f"../../calp commit -m 'commit {i}'")
+
+        # The second gc reads the headers of the packed deltas
+        self.assertEqual(os.system("../../calp gc"), 0)
+        self.assertEqual(os.system("../../calp gc"), 0)
+
+        packs = os.listdir(f"{ABSOLUTE_PATH}/{GITDIR}/objects/pack")
+        self.assertEqual(len(packs), 2)
+        repo = find_repository()
+        obj = read_object(repo, read_entries()[0].hash)
+        self.assertEqual(obj.blob_data, bytes(data))
+        self.assertEqual(len(list(walk_commits(repo, [get_reference("HEAD")]))), 3)
+
+    def test_object_cache(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system(f"printf '[core]\\nobjectCacheLimit = 2\\n' > {GITDIR}/config")
+        for i in range(1, 4):
+            os.system(f"echo '{i}' > {i}.txt")
+            os.system(f"../../calp add {i}.txt")
+            os.system(f"../../calp commit -m 'commit {i}'")
+
+        repo = find_repository()
+        cache = repo.object_cache
+        self.assertEqual(cache.max_entries, 2)
+
+        commit_sha = get_reference("HEAD")
+        commit = read_object(repo, commit_sha)
+        self.assertTrue(read_object(repo, commit_sha) is commit)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # The least recently used object is evicted
+        read_object(repo, commit.get_tree_hash())
+        read_object(repo, commit.get_parents()[0])
+        self.assertEqual(len(cache), 2)
+        self.assertFalse(commit_sha in cache)
+
+    def test_cat_file_type_and_size(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("echo 'test' > test.txt")
+        os.system("../../calp add test.txt")
+        os.system("../../calp commit -m 'first commit'")
+        commit_sha = get_reference("HEAD")
+        blob_sha = "9daeafb9864cf43055ae93beb0afd6c7d144bfa4"
+
+        output = os.popen(f"../../calp cat-file -t {blob_sha}").read()
+        self.assertEqual(output, "blob\n")
+        output = os.popen(f"../../calp cat-file -s {blob_sha}").read()
+        self.assertEqual(output, "5\n")
+
+        missing_sha = "0" * 40
+        output = os.popen(
+            f"printf '{commit_sha}\\n{missing_sha}\\n' | ../../calp cat-file --batch-check"
+        ).read()
+        commit_size = len(read_object(find_repository(), commit_sha).data)
+        self.assertEqual(
+            output, f"{commit_sha} commit {commit_size}\n{missing_sha} missing\n"
+        )
+
+        # Not object names, also without asserts: the second one is the path of HEAD
+        # from objects/
+        names = f"HEAD\\n..refs/../HEAD\\n{commit_sha}\\n"
+        output = os.popen(f"printf '{names}' | python -O ../../calp cat-file --batch-check").read()
+        self.assertEqual(
+            output, f"HEAD missing\n..refs/../HEAD missing\n{commit_sha} commit {commit_size}\n"
+        )
+
+    def test_cat_file_batch(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        content = bytes(range(256)) * 4
+        with open("binary.bin", "wb") as file:
+            file.write(content)
+        os.system("../../calp add binary.bin")
+        os.system("../../calp commit -m 'binary'")
+        blob_sha = hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+        repo = find_repository()
+        tree_sha = read_object(repo, get_reference("HEAD")).get_tree_hash()
+        tree_data = read_object(repo, tree_sha).serialize()
+
+        missing_sha = "0" * 40
+        stdin = f"{blob_sha}\n{missing_sha}\n{tree_sha}\n".encode("ascii")
+        output = subprocess.run(
+            ["../../calp", "cat-file", "--batch"], input=stdin, stdout=subprocess.PIPE, check=True
+        ).stdout
+        expected = b"%s blob %d\n%s\n" % (blob_sha.encode("ascii"), len(content), content)
+        expected += b"%s missing\n" % missing_sha.encode("ascii")
+        expected += b"%s tree %d\n%s\n" % (tree_sha.encode("ascii"), len(tree_data), tree_data)
+        self.assertEqual(output, expected)
+
+        # Not object names, also without asserts
+        output = subprocess.run(
+            ["python", "-O", "../../calp", "cat-file", "--batch"],
+            input=f"..refs/../HEAD\n{tree_sha}\n".encode("ascii"),
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+        expected = b"..refs/../HEAD missing\n"
+        expected += b"%s tree %d\n%s\n" % (tree_sha.encode("ascii"), len(tree_data), tree_data)
+        self.assertEqual(output, expected)
+
+        output = subprocess.run(
+            ["../../calp", "cat-file", "blob", blob_sha], stdout=subprocess.PIPE, check=True
+        ).stdout
+        self.assertEqual(output, content)
+
+    def test_add_large_file(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        # Bigger than the chunks it is hashed and compressed by
+        data = os.urandom(3 * 1024 * 1024 + 7)
+        with open("large.bin", "wb") as file:
+            file.write(data)
+        expected_hash = hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+        os.system("../../calp add large.bin")
+
+        entries = read_entries()
+        self.assertEqual(entries[0].hash, expected_hash)
+        obj = read_object(find_repository(), expected_hash)
+        self.assertEqual(obj.blob_data, data)
+        # No temporary file is left behind
+        objects = os.listdir(f"{ABSOLUTE_PATH}/{GITDIR}/objects")
+        self.assertEqual(objects, [expected_hash[:2]])
+
+    def test_add_directories(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("mkdir -p A/B")
+        os.system("echo 'main' > main.txt")
+        os.system("echo 'same' > A/1.txt")
+        os.system("echo 'same' > A/B/2.txt")
+        os.system("echo 'other' > A/B/3.txt")
+
+        os.system("../../calp add -j 4 .")
+        entries = read_entries()
+        self.assertEqual(
+            [entry.path for entry in entries], ["A/1.txt", "A/B/2.txt", "A/B/3.txt", "main.txt"]
+        )
+        # Same content, same object
+        self.assertEqual(entries[0].hash, entries[1].hash)
+
+        os.system("rm A/B/3.txt")
+        os.system("echo 'new' > A/4.txt")
+        os.system("../../calp add A")
+        entries = read_entries()
+        self.assertEqual(
+            [entry.path for entry in entries], ["A/1.txt", "A/4.txt", "A/B/2.txt", "main.txt"]
+        )
+
+        STATUS = status()
+        self.assertTrue(STATUS["modified"] == [])
+        self.assertTrue(STATUS["untracked"] == [])
+        self.assertTrue(STATUS["deleted"] == [])
+
+    def test_existing_objects_are_not_rewritten(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("mkdir A")
+        os.system("echo 'same' > A/1.txt")
+        os.system("echo 'same' > 2.txt")
+
+        output = os.popen("../../calp --verbose add A/1.txt 2.txt 2>&1").read()
+        self.assertTrue("objects written: 1\n" in output)
+        self.assertTrue("object writes avoided: 1\n" in output)
+        os.system("../../calp commit -m 'first commit'")
+
+        # Without the cache-tree, the tree of A is hashed again but it is already stored
+        os.system("echo 'other' > 2.txt")
+        os.system(f"rm {GITDIR}/index")
+        os.system("../../calp add A/1.txt 2.txt")
+        output = os.popen("../../calp --verbose commit -m 'second commit' 2>&1").read()
+        self.assertTrue("objects written: 2\n" in output)
+        self.assertTrue("object writes avoided: 1\n" in output)
+
+    def test_commit_reuses_cache_tree(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("mkdir -p A/B C")
+        os.system("echo '1' > A/B/1.txt")
+        os.system("echo '2' > A/2.txt")
+        os.system("echo '3' > C/3.txt")
+        os.system("../../calp add .")
+        os.system("../../calp commit -m 'first commit'")
+
+        cache_tree = read_cache_tree()
+        self.assertEqual(sorted(cache_tree.trees), ["", "A", "A/B", "C"])
+        self.assertEqual(cache_tree.get("A")[0], 2)
+
+        # Adding a file invalidates the directories containing it
+        os.system("echo 'new 1' > A/B/1.txt")
+        os.system("../../calp add A/B/1.txt")
+        self.assertEqual(sorted(read_cache_tree().trees), ["C"])
+
+        output = os.popen("../../calp --verbose commit -m 'second commit' 2>&1").read()
+        # Trees of A/B, A and the root, plus the commit
+        self.assertTrue("objects written: 4\n" in output)
+        self.assertTrue("object writes avoided" not in output)
+        commit = read_object(find_repository(), get_reference("HEAD"))
+        self.assertEqual(read_cache_tree().get("")[1], commit.get_tree_hash())
+
+        # Same tree as built without the cache-tree
+        os.system(f"rm {GITDIR}/index")
+        os.system("../../calp add .")
+        self.assertEqual(write_tree(), commit.get_tree_hash())
+
+    def test_log_long_history(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("echo 'test' > test.txt")
+        os.system("../../calp add test.txt")
+        os.system("../../calp commit -m 'commit 0'")
+
+        # Deeper than the recursion limit
+        tree_sha = write_tree()
+        commit_sha = get_reference("HEAD")
+        for i in range(1, sys.getrecursionlimit() + 100):
+            commit_sha = write_commit(tree_sha, f"commit {i}", [commit_sha])
+        update_ref("master", commit_sha)
+
+        repo = find_repository()
+        ancestors = get_ancestors(repo, read_object(repo, commit_sha))
+        self.assertEqual(len(ancestors), sys.getrecursionlimit() + 99)
+        self.assertEqual(read_object(repo, ancestors[-1]).get_message(), "commit 0")
+
+        output = os.popen("../../calp log -n 3").read()
+        self.assertEqual(len(output.splitlines()), 3)
+
+    def test_commit_graph_walk(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("echo 'test' > test.txt")
+        os.system("../../calp add test.txt")
+        os.system("../../calp commit -m 'commit 0'")
+        tree_sha = write_tree()
+        root_sha = get_reference("HEAD")
+        left_sha = write_commit(tree_sha, "left", [root_sha])
+        right_sha = write_commit(tree_sha, "right", [root_sha])
+        other_sha = write_commit(tree_sha, "other", [root_sha])
+        merge_sha = write_commit(tree_sha, "merge", [left_sha, right_sha, other_sha])
+        update_ref("master", merge_sha)
+
+        os.system("../../calp commit-graph write")
+
+        # The walk only needs the commit-graph, not the commit objects
+        for sha in [root_sha, left_sha, right_sha, other_sha]:
+            os.remove(f"{ABSOLUTE_PATH}/{GITDIR}/objects/{sha[:2]}/{sha[2:]}")
+        forget_repositories()
+        repo = find_repository()
+        commits = list(walk_commits(repo, [merge_sha]))
+        self.assertEqual(len(commits), 5)
+        self.assertEqual(set(commits[1:4]), {left_sha, right_sha, other_sha})
+        self.assertEqual(commits[4], root_sha)
+
+        parents, _, generation = get_commit_info(repo, merge_sha)
+        self.assertEqual(parents, [left_sha, right_sha, other_sha])
+        self.assertEqual(generation, 3)
+        self.assertEqual(get_commit_graph(repo).get_tree_hash(merge_sha), tree_sha)
+
+    def test_merge_base(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("echo 'test' > test.txt")
+        os.system("../../calp add test.txt")
+        os.system("../../calp commit -m 'root'")
+        tree_sha = write_tree()
+        root_sha = get_reference("HEAD")
+        main1_sha = write_commit(tree_sha, "main 1", [root_sha])
+        main2_sha = write_commit(tree_sha, "main 2", [main1_sha])
+        topic1_sha = write_commit(tree_sha, "topic 1", [root_sha])
+        topic2_sha = write_commit(tree_sha, "topic 2", [topic1_sha])
+        # Criss-cross merge, both sides are best common ancestors
+        cross1_sha = write_commit(tree_sha, "cross 1", [main1_sha, topic1_sha])
+        cross2_sha = write_commit(tree_sha, "cross 2", [topic1_sha, main1_sha])
+        update_ref("master", main2_sha)
+        os.system("echo '%s' > .calp/refs/heads/topic" % topic2_sha)
+
+        for write_graph in [False, True]:
+            if write_graph:
+                os.system("echo '%s' > .calp/refs/heads/cross" % cross2_sha)
+                os.system("../../calp commit-graph write")
+            forget_repositories()
+            repo = find_repository()
+            self.assertEqual(merge_bases(repo, main2_sha, topic2_sha), [root_sha])
+            self.assertEqual(merge_bases(repo, main2_sha, main1_sha), [main1_sha])
+            self.assertEqual(
+                set(merge_bases(repo, cross1_sha, cross2_sha)), {main1_sha, topic1_sha}
+            )
+            self.assertEqual(commits_not_in(repo, topic2_sha, main2_sha), [topic1_sha, topic2_sha])
+            self.assertEqual(commits_not_in(repo, main1_sha, main2_sha), [])
+
+        output = os.popen("../../calp merge-base master topic").read()
+        self.assertEqual(output.strip(), root_sha)
+        output = os.popen(f"../../calp merge-base --all {cross1_sha} {cross2_sha}").read()
+        self.assertEqual(set(output.split()), {main1_sha, topic1_sha})
+
+        # Commits made the same day have the same time, without a commit-graph they
+        # are visited in insertion order: C is reached from X before D
+        c_sha = write_commit(tree_sha, "C", [root_sha])
+        d_sha = write_commit(tree_sha, "D", [c_sha])
+        x3_sha = write_commit(tree_sha, "x3", [d_sha])
+        x2_sha = write_commit(tree_sha, "x2", [x3_sha])
+        x1_sha = write_commit(tree_sha, "x1", [x2_sha])
+        x_sha = write_commit(tree_sha, "X", [c_sha, x1_sha])
+        y_sha = write_commit(tree_sha, "Y", [d_sha])
+        os.remove(".calp/objects/info/commit-graph")
+        forget_repositories()
+        repo = find_repository()
+        self.assertEqual(merge_bases(repo, x_sha, y_sha), [d_sha])
+        self.assertEqual(
+            commits_not_in(repo, x_sha, y_sha), [x3_sha, x2_sha, x1_sha, x_sha]
+        )
+        output = os.popen(f"../../calp merge-base {x_sha} {y_sha}").read()
+        self.assertEqual(output.strip(), d_sha)
+
+        # Y is reached from T before its stale paint, which is left in the queue
+        y_sha = write_commit(tree_sha, "Y", [])
+        x_sha = write_commit(tree_sha, "X", [y_sha])
+        c2_sha = write_commit(tree_sha, "C'", [x_sha])
+        u1_sha = write_commit(tree_sha, "u1", [c2_sha])
+        u_sha = write_commit(tree_sha, "U", [u1_sha])
+        z_sha = write_commit(tree_sha, "Z", [y_sha])
+        t_sha = write_commit(tree_sha, "T", [z_sha, c2_sha])
+        self.assertEqual(commits_not_in(repo, t_sha, u_sha), [z_sha, t_sha])
+
+    def test_tree_round_trip(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        # "a" sorts as "a/" between "a.txt" and "a0"
+        os.system("mkdir -p a/b && echo 'nested' > a/b/c.txt && echo 'a' > a/a.txt")
+        os.system("echo '1' > a-b && echo '2' > a.txt && echo '3' > a0 && echo '4' > B")
+        os.system("printf '#!/bin/sh\\n' > a/run.sh && chmod +x a/run.sh")
+        os.system("../../calp add a a-b a.txt a0 B")
+        repo = find_repository()
+        _, data = read_object_data(repo, write_tree())
+        # add follows symbolic links, the entry of one is appended by hand
+        link_sha = hash_object("blob", data=b"a/b/c.txt")
+        tree_sha = hash_object("tree", data=data + b"120000 link\x00" + bytes.fromhex(link_sha))
+
+        names = [item.path for item in read_object(repo, tree_sha).items]
+        self.assertEqual(names, [b"B", b"a-b", b"a.txt", b"a", b"a0", b"link"])
+        modes = {path: mode for path, mode, _ in iter_tree(repo, tree_sha)}
+        self.assertEqual(modes["a/run.sh"], b"100755")
+        self.assertEqual(modes["link"], b"120000")
+        self.assertEqual(modes["a/b/c.txt"], b"100644")
+
+        # Every tree serializes back to the bytes it was parsed from
+        stack = [tree_sha]
+        while stack:
+            sha = stack.pop()
+            object_type, data = read_object_data(repo, sha)
+            self.assertEqual(object_type, b"tree")
+            tree = Tree(repo, data)
+            self.assertEqual(tree.serialize(), data)
+            header = b"tree %d\x00" % len(data)
+            self.assertEqual(hashlib.sha1(header + tree.serialize()).hexdigest(), sha)
+            stack.extend(item.sha for item in tree.items if item.is_tree())
+
+    def test_diff_trees(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("mkdir A B")
+        os.system("echo 'x' > A/x.txt")
+        os.system("echo 'y' > B/y.txt")
+        os.system("echo 'c' > c.txt")
+        os.system("echo 'd' > d")
+        os.system("../../calp add A B c.txt d")
+        os.system("../../calp commit -m 'first'")
+        old_tree = write_tree()
+
+        os.system("echo 'new x' > A/x.txt")
+        os.system("rm c.txt d")
+        os.system("mkdir d")
+        os.system("echo 'f' > d/f.txt")
+        os.system("echo 'e' > e.txt")
+        os.system("../../calp add A c.txt d e.txt")
+        os.system("../../calp commit -m 'second'")
+        new_tree = write_tree()
+
+        repo = find_repository()
+        counters.clear()
+        changes = [(status, path) for status, path, _, _ in diff_trees(repo, old_tree, new_tree)]
+        self.assertEqual(
+            changes,
+            [
+                ("modified", "A/x.txt"),
+                ("deleted", "c.txt"),
+                ("deleted", "d"),
+                ("added", "d/f.txt"),
+                ("added", "e.txt"),
+            ],
+        )
+        # B is the same on both sides
+        self.assertEqual(counters["subtrees skipped"], 1)
+
+        self.assertEqual(
+            [path for path, _ in get_commit_changes(get_reference("HEAD"))],
+            ["A/x.txt", "d/f.txt", "e.txt"],
+        )
+
+    def test_signed_commit(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("echo 'test' > test.txt")
+        os.system("../../calp add test.txt")
+        os.system("../../calp commit -m 'first'")
+        tree_sha = write_tree()
+        parent_sha = get_reference("HEAD")
+
+        # Continuation lines of gpgsig start with a space
+        signature = "".join(f" line {i}\n" for i in range(5000))
+        data = (
+            f"tree {tree_sha}\nparent {parent_sha}\n"
+            "author calp <calp@example.com> 1700000000 +0000\n"
+            "committer calp <calp@example.com> 1700000001 +0000\n"
+            f"gpgsig -----BEGIN PGP SIGNATURE-----\n{signature} -----END PGP SIGNATURE-----\n"
+            "\nsigned\n"
+        ).encode("ascii")
+        commit_sha = hash_object("commit", data=data)
+
+        repo = find_repository()
+        commit = read_object(repo, commit_sha)
+        self.assertEqual(commit.get_tree_hash(), tree_sha)
+        self.assertEqual(commit.get_parents(), [parent_sha])
+        self.assertEqual(commit.get_commit_time(), 1700000001)
+        self.assertEqual(commit.get_message(), "signed\n")
+        self.assertTrue(commit.get_header(b"gpgsig").endswith(b"-----END PGP SIGNATURE-----"))
+        self.assertEqual(commit.serialize(), data)
+        self.assertEqual(commit.commit_data[b"committer"], b"calp <calp@example.com> 1700000001 +0000")
+
+    def test_cli_imports_commands_lazily(self):
+        # Listing the commands doesn't import them
+        code = "import sys, src.main; print('src.plumbing' in sys.modules, 'argparse' in sys.modules)"
+        output = subprocess.run(
+            [sys.executable, "-c", code], cwd=os.path.dirname(TEST_PATHS), stdout=subprocess.PIPE
+        ).stdout
+        self.assertEqual(output, b"False False\n")
+
+    def test_git_dir_override(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("echo 'test' > test.txt")
+        os.system("../../calp add test.txt")
+        os.system("../../calp commit -m 'first'")
+        commit_sha = get_reference("HEAD")
+
+        # From outside the worktree
+        os.chdir(TEST_PATHS)
+        output = os.popen(f"../calp --git-dir {ABSOLUTE_PATH}/{GITDIR} log").read()
+        self.assertIn("first", output)
+        output = os.popen(f"CALP_DIR={ABSOLUTE_PATH}/{GITDIR} ../calp log").read()
+        self.assertIn("first", output)
+
+        os.environ["CALP_DIR"] = f"{ABSOLUTE_PATH}/{GITDIR}"
+        try:
+            repo = find_repository()
+            self.assertEqual(repo.worktree, os.path.realpath(ABSOLUTE_PATH))
+            self.assertEqual(get_reference("HEAD", repo), commit_sha)
+            # Found once, then reused
+            self.assertIs(find_repository(), repo)
+        finally:
+            del os.environ["CALP_DIR"]
+
+    def test_ignore_rules(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("mkdir -p node_modules/lib src/build build logs")
+        os.system("echo 'lib' > node_modules/lib/index.js")
+        os.system("echo 'main' > src/main.py")
+        os.system("echo 'out' > src/build/out.o")
+        os.system("echo 'notes' > build/notes.txt")
+        os.system("echo 'debug' > debug.log")
+        os.system("echo 'keep' > keep.log")
+        os.system("echo 'tracked' > logs/tracked.txt")
+        os.system("../../calp add logs/tracked.txt")
+        with open(".calpignore", "w") as file:
+            file.write("# dependencies\nnode_modules/\n*.log\n!keep.log\nlogs\n")
+        with open("src/.calpignore", "w") as file:
+            file.write("build/\n")
+
+        repo = find_repository()
+        counters.clear()
+        STATUS = status()
+        self.assertEqual(
+            sorted(STATUS["untracked"]),
+            [".calpignore", "build/notes.txt", "keep.log", "src/.calpignore", "src/main.py"],
+        )
+        # A tracked file stays tracked once its directory is ignored
+        self.assertEqual(STATUS["deleted"], [])
+        # node_modules and src/build, logs has tracked files
+        self.assertEqual(counters["ignored directories skipped"], 2)
+
+        # The rules of the parent directories apply to a walk from a subdirectory
+        self.assertEqual(
+            sorted(walk_worktree(repo.worktree, "src")), ["src/.calpignore", "src/main.py"]
+        )
+
+        os.system("../../calp add .")
+        with open_index() as index:
+            self.assertEqual(
+                [entry.path for entry in index],
+                [
+                    ".calpignore",
+                    "build/notes.txt",
+                    "keep.log",
+                    "logs/tracked.txt",
+                    "src/.calpignore",
+                    "src/main.py",
+                ],
+            )
+
+    def test_checkout_only_touches_changes(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("mkdir -p lib old")
+        os.system("echo 'same' > same.txt")
+        os.system("echo 'lib' > lib/lib.txt")
+        os.system("echo 'old' > old/old.txt")
+        os.system("echo 'main' > main.txt")
+        os.system("../../calp add same.txt lib old main.txt")
+        os.system("../../calp commit -m 'first'")
+
+        os.system("../../calp checkout -b feature")
+        os.system("echo 'feature' > main.txt")
+        os.system("rm -r old lib")
+        os.system("echo 'lib is a file' > lib")
+        os.system("mkdir new && echo 'new' > new/new.txt")
+        os.system("../../calp add main.txt old lib new")
+        os.system("../../calp commit -m 'feature'")
+
+        same_stat = os.stat("same.txt")
+        output = os.popen("../../calp checkout master").read()
+        self.assertIn("Switched to branch master", output)
+        self.assertIn("Updated 5 files (2 added, 2 deleted, 1 modified)", output)
+
+        # Untouched files keep their stat data
+        self.assertEqual(os.stat("same.txt").st_mtime_ns, same_stat.st_mtime_ns)
+        self.assertEqual(os.stat("same.txt").st_ino, same_stat.st_ino)
+        with open("main.txt") as file:
+            self.assertEqual(file.read(), "main\n")
+        with open("lib/lib.txt") as file:
+            self.assertEqual(file.read(), "lib\n")
+        self.assertTrue(os.path.exists("old/old.txt"))
+        # Directories left empty are removed
+        self.assertFalse(os.path.exists("new"))
+
+        STATUS = status()
+        self.assertEqual((STATUS["modified"], STATUS["deleted"], STATUS["untracked"]), ([], [], []))
+        with open_index() as index:
+            self.assertEqual(
+                [entry.path for entry in index],
+                ["lib/lib.txt", "main.txt", "old/old.txt", "same.txt"],
+            )
+
+    def test_checkout_modes_and_binary_files(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("echo 'main' > main.txt")
+        os.system("../../calp add main.txt")
+        os.system("../../calp commit -m 'first'")
+
+        os.system("../../calp checkout -b feature")
+        binary = bytes(range(256)) * 64
+        os.makedirs("bin/data")
+        with open("bin/data/blob.bin", "wb") as file:
+            file.write(binary)
+        os.system("printf '#!/bin/sh\\n' > bin/run.sh && chmod +x bin/run.sh")
+        os.system("../../calp add bin")
+        os.system("../../calp commit -m 'feature'")
+        repo = find_repository()
+        tree_sha = read_object(repo, get_reference("HEAD")).get_tree_hash()
+        modes = {path: mode for path, mode, _ in iter_tree(repo, tree_sha)}
+        self.assertEqual(modes["bin/run.sh"], b"100755")
+        self.assertEqual(modes["bin/data/blob.bin"], b"100644")
+
+        os.system("../../calp checkout master")
+        self.assertFalse(os.path.exists("bin"))
+        os.system("../../calp checkout feature")
+        with open("bin/data/blob.bin", "rb") as file:
+            self.assertEqual(file.read(), binary)
+        self.assertTrue(os.access("bin/run.sh", os.X_OK))
+        self.assertFalse(os.access("bin/data/blob.bin", os.X_OK))
+        STATUS = status()
+        self.assertEqual((STATUS["modified"], STATUS["deleted"], STATUS["untracked"]), ([], [], []))
+
+    def test_checkout_over_ignored_files(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("echo 'main' > main.txt")
+        os.system("../../calp add main.txt")
+        os.system("../../calp commit -m 'first'")
+        os.system("../../calp checkout -b feature")
+        os.system("mkdir out && echo 'tracked' > out/y.txt && echo 'tracked' > x.log")
+        os.system("../../calp add x.log out")
+        os.system("../../calp commit -m 'feature'")
+        os.system("../../calp checkout master")
+        os.system("printf '*.log\\nout\\n' > .calpignore")
+        os.system("../../calp add .calpignore")
+        os.system("../../calp commit -m 'ignore'")
+
+        # Ignored files where feature has a file and a directory
+        os.system("echo 'local' > x.log && echo 'local' > out")
+        self.assertEqual(os.system("../../calp checkout feature"), 0)
+
+        self.assertEqual(get_reference("HEAD"), get_reference("refs/heads/feature"))
+        with open("x.log") as file:
+            self.assertEqual(file.read(), "tracked\n")
+        with open("out/y.txt") as file:
+            self.assertEqual(file.read(), "tracked\n")
+        self.assertFalse(os.path.exists(".calpignore"))
+        STATUS = status()
+        self.assertEqual((STATUS["modified"], STATUS["deleted"], STATUS["untracked"]), ([], [], []))
+
+    def test_watch_changed_paths(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("mkdir -p A build")
+        os.system("echo 'a' > A/a.txt")
+        os.system("echo 'b' > b.txt")
+        os.system("echo 'build/' > .calpignore")
+        os.system("../../calp add A b.txt .calpignore")
+        os.system("../../calp commit -m 'first'")
+
+        repo = find_repository()
+        for watcher in [InotifyWatcher(repo), PollingWatcher(repo, interval=0.1)]:
+            STATUS = status()
+            try:
+                time.sleep(0.05)
+                os.system("echo 'new a' > A/a.txt")
+                os.system("rm b.txt")
+                os.system("mkdir -p C && echo 'c' > C/c.txt")
+                os.system("echo 'out' > build/out.o")
+                paths = watcher.wait(timeout=5)
+            finally:
+                watcher.close()
+
+            # build is ignored, the inotify watcher reports the new directory itself
+            self.assertTrue({"A/a.txt", "b.txt"} <= paths)
+            self.assertTrue({"C", "C/c.txt"} & paths)
+            self.assertFalse(any(path.startswith("build") for path in paths))
+
+            # Only the changed paths are checked again
+            STATUS = update_status(STATUS, status(sorted(paths)), paths)
+            self.assertEqual(STATUS, status())
+            self.assertEqual(
+                STATUS, {"deleted": ["b.txt"], "modified": ["A/a.txt"], "untracked": ["C/c.txt"]}
+            )
+            os.system("echo 'a' > A/a.txt && echo 'b' > b.txt && rm -r C")
+
+        # Files written in a directory created after the watcher started
+        watcher = InotifyWatcher(repo)
+        try:
+            os.system("mkdir -p D/E")
+            watcher.wait(timeout=5)
+            os.system("echo 'e' > D/E/e.txt")
+            self.assertIn("D/E/e.txt", watcher.wait(timeout=5))
+            # A commit changes the index and the branch
+            os.system("../../calp add D")
+            os.system("../../calp commit -m 'second'")
+            paths = watcher.wait(timeout=5)
+            self.assertTrue({f"{GITDIR}/index", f"{GITDIR}/refs/heads/master"} <= paths)
+        finally:
+            watcher.close()
+
+    def test_untracked_cache(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("mkdir -p A/B")
+        os.system("echo 'a' > A/a.txt")
+        os.system("echo 'b' > A/B/b.txt")
+        os.system("echo '# nothing' > A/.calpignore")
+        os.system("../../calp add A")
+        os.system("../../calp commit -m 'first'")
+        # Directories changed in the same clock tick as the index are listed again
+        time.sleep(0.05)
+
+        status()
+        counters.clear()
+        self.assertEqual(status()["untracked"], [])
+        # ".", A and A/B
+        self.assertEqual(counters["directories listed from the untracked cache"], 3)
+
+        time.sleep(0.05)
+        os.system("echo 'new' > A/B/new.txt")
+        counters.clear()
+        self.assertEqual(status()["untracked"], ["A/B/new.txt"])
+        self.assertEqual(counters["directories listed from the untracked cache"], 2)
+
+        # Editing a .calpignore doesn't change the mtime of its directory
+        time.sleep(0.05)
+        with open("A/.calpignore", "w") as file:
+            file.write("new.txt\n")
+        self.assertEqual(status()["untracked"], [])
+
+        os.system("rm -r A/B")
+        STATUS = status()
+        self.assertEqual((STATUS["deleted"], STATUS["untracked"]), (["A/B/b.txt"], []))
+
+    def test_object_transaction(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("echo 'a' > a.txt")
+        os.system("../../calp add a.txt")
+        os.system("../../calp commit -m 'first'")
+        # Every object renamed into place, no temporary file left
+        for _, _, files in os.walk(f"{GITDIR}/objects"):
+            self.assertEqual([name for name in files if name.startswith("tmp_obj_")], [])
+        repo = find_repository()
+        self.assertEqual(read_object(repo, get_reference("HEAD")).get_message(), "first")
+
+        os.system("echo 'c' > c.txt")
+        with object_transaction(repo):
+            sha = hash_object("blob", "c.txt", repo=repo)
+            # Read from the temporary file until the transaction ends
+            self.assertFalse(os.path.exists(f"{GITDIR}/objects/{sha[:2]}/{sha[2:]}"))
+            self.assertEqual(read_object(repo, sha).serialize(), b"c\n")
+        self.assertTrue(os.path.exists(f"{GITDIR}/objects/{sha[:2]}/{sha[2:]}"))
+
+        os.system("echo 'b' > b.txt")
+        with suppress(KeyboardInterrupt), object_transaction(repo):
+            sha = hash_object("blob", "b.txt", repo=repo)
+            raise KeyboardInterrupt
+        self.assertFalse(os.path.exists(f"{GITDIR}/objects/{sha[:2]}/{sha[2:]}"))
+        self.assertEqual([name for name in os.listdir(f"{GITDIR}/objects") if "tmp" in name], [])
+
+        repo.conf.read_dict({"core": {"fsync": "always"}})
+        with self.assertRaises(Exception):
+            hash_object("blob", "b.txt", repo=repo)
+
+    def test_racy_entries_smudged_at_write(self):
+        self.assertTrue(os.path.exists(ABSOLUTE_PATH))
+        os.chdir(ABSOLUTE_PATH)
+
+        os.system("../../calp init")
+        os.system("echo 'a' > a.txt")
+        os.system("echo 'b' > b.txt")
+        # a.txt is modified before the index is written, b.txt "after" it
+        time.sleep(0.05)
+        future = time.time() + 3600
+        os.utime("b.txt", (future, future))
+        os.system("../../calp add a.txt b.txt")
+
+        entries = {entry.path: entry for entry in read_entries()}
+        self.assertEqual(entries["a.txt"].mtime_ns, os.stat("a.txt").st_mtime_ns)
+        self.assertEqual(entries["b.txt"].mtime_ns, 0)
+
+        # Copied by the next writes as they are
+        os.system("echo 'c' > c.txt")
+        os.system("../../calp add c.txt")
+        entries = {entry.path: entry for entry in read_entries()}
+        self.assertEqual(entries["a.txt"].mtime_ns, os.stat("a.txt").st_mtime_ns)
+        self.assertEqual(entries["b.txt"].mtime_ns, 0)
+        self.assertEqual(status()["modified"], [])